@@ -10,7 +10,6 @@ import torch.backends.cudnn as cudnn
 from torch.optim import Adam
 from torch.autograd import Variable
 from torchvision.utils import save_image
-from tensorboardX import SummaryWriter
 
 sys.path.append(os.pardir)
 from models import vgg
@@ -19,6 +18,11 @@ from common.dataset.dataset import FaceDataset
 from common.dataset.sampler import InfiniteSamplerWrapper
 from common.utils.config import Config
 from common.utils.poly_lr_scheduler import poly_lr_scheduler
+from common.utils.logger import Logger
+from common.utils.checkpoint import CheckpointManager
+from common.utils.metrics import StepMetrics, LossMeter
+from common.utils.profiler import ProfilerWindow
+from common.utils.memory_format import memory_format_from_cfg
 
 def parse_args():
     parser = argparse.ArgumentParser(description='DCGAN')
@@ -56,7 +60,7 @@ def main():
     logdir = os.path.join(out, 'log')
     if not os.path.exists(logdir):
         os.makedirs(logdir)
-    writer = SummaryWriter(log_dir=logdir)
+    logger = Logger(logdir)
 
     # Set device
     cuda = torch.cuda.is_available()
@@ -71,7 +75,9 @@ def main():
     VGG.load_state_dict(torch.load(args.vgg))
     VGG = torch.nn.Sequential(*list(VGG.children())[:31])
     model = Net(VGG)
-    model.to(device)
+    # optional: channels-last (NHWC) encoder/decoder, and batches converted as they arrive
+    memory_format = memory_format_from_cfg(cfg)
+    model.to(device, memory_format=memory_format)
  
     # Prepare dataset
     content_dataset = FaceDataset(cfg, cfg.train.content_dataset)
@@ -96,48 +102,69 @@ def main():
 
     opt = Adam(model.decoder.parameters(), lr=cfg.train.parameters.lr, betas=(0.5, 0.999))
 
+    metrics_file = cfg.train.metrics_file if hasattr(cfg.train, 'metrics_file') else 'metrics.jsonl'
+    metrics_interval = cfg.train.metrics_interval if hasattr(cfg.train, 'metrics_interval') else cfg.train.print_interval
+    metrics = StepMetrics(os.path.join(out, metrics_file), device=device)
+    profiler = ProfilerWindow.from_cfg(cfg, out)
+    checkpoints = CheckpointManager.from_cfg(cfg, os.path.join(out, 'checkpoint'))
+    losses = LossMeter()
+    loss_means = {}
+
     iteration = 0
     batchsize = cfg.train.batchsize
     iterations_per_epoch = len(content_loader)
     epochs = cfg.train.iterations // iterations_per_epoch
     for epoch in range(epochs):
-        for i, batch in enumerate(content_loader):
+        for i, batch in enumerate(metrics.iterate(content_loader)):
             model.train()
 
-            content_images = Variable(batch).to(device)
-            style_images = Variable(next(style_iter)).to(device)
-
-            loss_c, loss_s = model(content_images, style_images)
-            loss = cfg.train.parameters.lam_c * loss_c + cfg.train.parameters.lam_s * loss_s
+            with metrics.phase('data'):
+                content_images = Variable(batch).to(device, memory_format=memory_format)
+                style_images = Variable(next(style_iter)).to(device, memory_format=memory_format)
 
-            opt.zero_grad()
-            loss.backward()
-            opt.step()
+            with metrics.phase('g_fwd_bwd'):
+                loss_c, loss_s = model(content_images, style_images)
+                loss = cfg.train.parameters.lam_c * loss_c + cfg.train.parameters.lam_s * loss_s
 
-            writer.add_scalar('loss_content', loss_c.item(), iteration+1)
-            writer.add_scalar('loss_style', loss_s.item(), iteration+1)
+                opt.zero_grad()
+                loss.backward()
+            with metrics.phase('optim'):
+                opt.step()
+                losses.update(loss_content=loss_c, loss_style=loss_s)
 
             lr = poly_lr_scheduler(opt, cfg.train.parameters.lr, iteration, lr_decay_iter=10, max_iter=cfg.train.iterations)
             iteration += 1
 
             if iteration % cfg.train.print_interval == 0:
-                print(f'Epoch:[{epoch}][{iteration}/{cfg.train.iterations}]  loss content:{loss_c.item():.5f} loss style:{loss_s.item():.5f}')
+                loss_means = losses.means()
+                print(f'Epoch:[{epoch}][{iteration}/{cfg.train.iterations}]  loss content:{loss_means["loss_content"]:.5f} loss style:{loss_means["loss_style"]:.5f}')
+                for tag, value in loss_means.items():
+                    logger.scalar_summary(tag, value, iteration)
 
             if iteration % cfg.train.save_interval == 0: 
-                if not os.path.exists(os.path.join(out, 'checkpoint')):
-                    os.makedirs(os.path.join(out, 'checkpoint'))
-                path = os.path.join(out, 'checkpoint', f'iter_{iteration:04d}.pth.tar')
-                state = {'state_dict':model.state_dict(),
-                         'opt_state_dict':opt.state_dict(),
-                         'iteration':iteration,
-                        }
-                torch.save(state, path)
+                with metrics.phase('checkpoint'):
+                    state = {'state_dict':model.state_dict(),
+                             'opt_state_dict':opt.state_dict(),
+                             'iteration':iteration,
+                            }
+                    checkpoints.save(state, f'iter_{iteration:04d}.pth.tar', step=iteration)
 
             if iteration % cfg.train.preview_interval == 0:
-                if not os.path.exists(os.path.join(out, 'preview')):
-                    os.makedirs(os.path.join(out, 'preview'))
-                sample = generate_sample(model, content_images, style_images) 
-                save_image(sample.data.cpu(), os.path.join(out, 'preview', f'iter_{iteration:04d}.png'))
+                with metrics.phase('preview'):
+                    if not os.path.exists(os.path.join(out, 'preview')):
+                        os.makedirs(os.path.join(out, 'preview'))
+                    sample = generate_sample(model, content_images, style_images) 
+                    save_image(sample.data.cpu(), os.path.join(out, 'preview', f'iter_{iteration:04d}.png'))
+
+            metrics.step(batchsize)
+            if iteration % metrics_interval == 0:
+                metrics.flush(iteration, epoch=epoch, **loss_means)
+            profiler.step(iteration)
+
+    # stop and export a capture window still open at the end
+    profiler.close()
+    # the last writes run in the background; close() waits and re-raises a failed one
+    checkpoints.close()
 
 def generate_sample(model, content_images, style_images):
     model.eval()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import copy
+import time
+import argparse
+
+import numpy as np
+import torch
+
+sys.path.append(os.pardir)
+from common.modules.resblocks import ResGenBlock, ResDisBlock, OptimizedBlock, set_fused_resample
+from common.modules.batchnorm import set_fused_norm, fold_conditional_norms
+from common.utils.benchmark import environment_info, write_results
+
+KINDS = ['gen', 'gen_cond', 'dis']
+FUSIONS = ['resample', 'norm']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='resblock benchmark: fused resampling convolutions and conditional BatchNorm against the plain blocks')
+    parser.add_argument('--kinds', type=str, nargs='+', default=KINDS, choices=KINDS,
+                        help='SAGAN generator blocks (BatchNorm), SN-projection ones (conditional BatchNorm), discriminator blocks')
+    parser.add_argument('--fuse', type=str, nargs='+', default=FUSIONS, choices=FUSIONS,
+                        help='up/downsampling folded into the convs, conditional BatchNorm + ReLU as one scale and shift')
+    parser.add_argument('--base', type=int, default=64, help='channel base of the SAGAN/SN-projection 128px models')
+    parser.add_argument('--n_classes', type=int, default=10)
+    parser.add_argument('--batchsize', type=int, default=8)
+    parser.add_argument('--steps', type=int, default=5, help='timed forward/backward passes per block and variant')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--tolerance', type=float, default=1e-10, help='largest relative difference (in float64) --check accepts')
+    parser.add_argument('--check', action='store_true', help='exit with an error if a fused block is not equivalent')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--gpu', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None, help='json output path (stdout if omitted)')
+    args = parser.parse_args()
+    return args
+
+
+def block_cases(kind, base, n_classes):
+    """(name, constructor, input shape, n_classes) of the resampling blocks of the 128px models."""
+    cases = []
+    if kind in ['gen', 'gen_cond']:
+        norm, classes = ('batch', 0) if kind == 'gen' else ('c_batch', n_classes)
+        for i, (cin, cout, size) in enumerate([(16, 16, 4), (16, 8, 8), (8, 4, 16), (4, 2, 32), (2, 1, 64)]):
+            make = lambda cin=cin, cout=cout: ResGenBlock(base * cin, base * cout, upsample=True, n_classes=classes, norm=norm)
+            cases.append((f'{kind}.block{i+2}', make, (base * cin, size, size), classes))
+    else:
+        cases.append(('dis.block1', lambda: OptimizedBlock(3, base, norm='spectral'), (3, 128, 128), 0))
+        for i, (cin, cout, size) in enumerate([(1, 2, 64), (2, 4, 32), (4, 8, 16), (8, 16, 8)]):
+            make = lambda cin=cin, cout=cout: ResDisBlock(base * cin, base * cout, downsample=True, norm='spectral')
+            cases.append((f'dis.block{i+2}', make, (base * cin, size, size), 0))
+    return cases
+
+
+def rel_diff(a, b, scale=None):
+    scale = a.abs().max() if scale is None else scale
+    return ((a - b).abs().max() / scale.clamp(min=1e-12)).item()
+
+
+def saved_mb(fn):
+    """MB of the distinct tensors the autograd graph of `fn()` keeps for the backward."""
+    storages = {}
+    def pack(t):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return sum(storages.values()) / 1024. ** 2, out
+
+
+def flops(fn):
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        return None
+    counter = FlopCounterMode(display=False)
+    with counter:
+        fn()
+    return counter.get_total_flops()
+
+
+def fuse(block, fusions):
+    """Apply `fusions` to `block`; the number of fused blocks/layers."""
+    count = 0
+    if 'resample' in fusions:
+        count += set_fused_resample(block)
+    if 'norm' in fusions:
+        count += set_fused_norm(block)
+    return count
+
+
+def run_case(name, make, shape, n_classes, args, device):
+    torch.manual_seed(args.seed)
+    plain = make().to(device).train()
+    fused = copy.deepcopy(plain)
+    fuse(fused, args.fuse)
+    x = torch.randn(args.batchsize, *shape, device=device)
+    y = torch.randint(0, n_classes, (args.batchsize,), device=device) if n_classes > 0 else None
+
+    def forward(block, x):
+        return block(x, y) if n_classes > 0 else block(x)
+
+    with torch.no_grad():
+        grad_out = torch.randn_like(forward(copy.deepcopy(plain), x))
+
+    def step(block, dtype):
+        xi = x.to(dtype).requires_grad_()
+        out = forward(block, xi)
+        (out * grad_out.to(dtype)).sum().backward()
+        return out.detach(), xi.grad
+
+    # one identical step through both, in float64: in float32 a value rounded
+    # across zero flips a ReLU and masks its gradient differently. Outputs,
+    # gradients and the updated state (BatchNorm statistics, spectral-norm
+    # vectors) have to agree
+    check_p, check_f = copy.deepcopy(plain).double(), copy.deepcopy(fused).double()
+    out_p, gx_p = step(check_p, torch.float64)
+    out_f, gx_f = step(check_f, torch.float64)
+    # relative to the largest gradient of the block: the bias of a conv followed
+    # by BatchNorm has a gradient of zero up to rounding
+    pairs = [(p.grad, f.grad) for p, f in zip(check_p.parameters(), check_f.parameters()) if p.grad is not None]
+    scale = max(p.abs().max() for p, _ in pairs)
+    grads = [rel_diff(p, f, scale) for p, f in pairs]
+    state = [(p - f).abs().max().item() for p, f in zip(list(check_p.buffers()) + [p for p in check_p.parameters() if not p.requires_grad],
+                                                        list(check_f.buffers()) + [p for p in check_f.parameters() if not p.requires_grad])
+             if p.is_floating_point()]
+    saved_p, _ = saved_mb(lambda: forward(plain, x.clone().requires_grad_()))
+    saved_f, _ = saved_mb(lambda: forward(fused, x.clone().requires_grad_()))
+    result = {'block': name,
+              'in_shape': list(shape),
+              'out_shape': list(out_p.shape[1:]),
+              'output_rel_diff': rel_diff(out_p, out_f),
+              'input_grad_rel_diff': rel_diff(gx_p, gx_f),
+              'param_grad_rel_diff': max(grads),
+              'state_max_diff': max(state, default=0.),
+              'saved_mb': {'plain': saved_p, 'fused': saved_f},
+             }
+
+    # inference after that step: the fused block with its conditional BatchNorms folded into per-class tables
+    with torch.no_grad():
+        check_p.eval()
+        fold_conditional_norms(check_f)
+        result['eval_rel_diff'] = rel_diff(forward(check_p, x.double()), forward(check_f, x.double()))
+    result['equivalent'] = max(result['output_rel_diff'], result['input_grad_rel_diff'], result['param_grad_rel_diff'],
+                               result['eval_rel_diff']) <= args.tolerance
+
+    for variant, block in [('plain', plain), ('fused', fused)]:
+        def fwd_bwd():
+            xi = x.clone().requires_grad_()
+            (forward(block, xi) * grad_out).sum().backward()
+        count = flops(fwd_bwd)
+        result.setdefault('gflops', {})[variant] = count / 1e9 if count is not None else None
+        for _ in range(args.warmup):
+            fwd_bwd()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            fwd_bwd()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        result.setdefault('ms_per_fwd_bwd', {})[variant] = (time.perf_counter() - start) / args.steps * 1e3
+    result['speedup'] = result['ms_per_fwd_bwd']['plain'] / result['ms_per_fwd_bwd']['fused']
+    result['saved_memory_ratio'] = saved_f / saved_p
+    return result
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(f'cuda:{args.gpu}') if args.gpu >= 0 and torch.cuda.is_available() else torch.device('cpu')
+
+    results = []
+    for kind in args.kinds:
+        for name, make, shape, n_classes in block_cases(kind, args.base, args.n_classes):
+            if fuse(make(), args.fuse) == 0:
+                print(f'# {name}: nothing to fuse', file=sys.stderr)
+                continue
+            print(f'# {name}', file=sys.stderr)
+            results.append(run_case(name, make, shape, n_classes, args, device))
+
+    write_results({'benchmark': 'blocks', 'env': environment_info(), 'args': vars(args), 'results': results}, args.out)
+    failed = [r['block'] for r in results if not r['equivalent']]
+    if args.check and failed:
+        sys.exit(f'fused blocks differ from the plain ones: {failed}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import shutil
+import argparse
+import itertools
+import tempfile
+
+import numpy as np
+import cv2
+import torch
+from easydict import EasyDict as edict
+
+sys.path.append(os.pardir)
+from common.dataset.dataset import FaceDataset, MultiClassFaceDataset
+from common.utils.config import Config
+from common.utils.benchmark import summarize_latency, rss_mb, children_pids, environment_info, write_results
+from progressive.dataset.dataset import FaceDataset as ProgressiveFaceDataset
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='data pipeline benchmark')
+    parser.add_argument('--root', type=str, default=None, help='synthetic corpus directory (temporary if omitted)')
+    parser.add_argument('--n_images', type=int, default=256)
+    parser.add_argument('--n_classes', type=int, default=4)
+    parser.add_argument('--min_size', type=int, default=240)
+    parser.add_argument('--max_size', type=int, default=320)
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--pggan_resolutions', type=int, nargs='+', default=[4, 8, 16, 32, 64, 128, 256])
+    parser.add_argument('--datasets', type=str, nargs='+', default=['face', 'multiclass', 'progressive'],
+                        choices=['face', 'multiclass', 'progressive'])
+    parser.add_argument('--samples', type=int, default=64, help='samples timed one by one in the main process')
+    parser.add_argument('--batches', type=int, default=8, help='batches timed through the DataLoader')
+    parser.add_argument('--batchsize', type=int, default=16)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None, help='json output path (stdout if omitted)')
+    args = parser.parse_args()
+    return args
+
+
+def make_corpus(root, n_images, n_classes, min_size, max_size, seed=0):
+    """Write a synthetic image corpus: one directory per class plus a danbooru style list file."""
+    rng = np.random.RandomState(seed)
+    list_file = os.path.join(root, 'list.txt')
+    lines = []
+    for i in range(n_images):
+        cls = i % n_classes
+        class_dir = os.path.join(root, f'class{cls}')
+        if not os.path.exists(class_dir):
+            os.makedirs(class_dir)
+        h, w = rng.randint(min_size, max_size + 1, size=2)
+        # smooth colour gradients plus noise so that the files decode like real illustrations
+        yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+        base = np.stack([xx / w, yy / h, (xx + yy) / (w + h)], axis=2) * 255 * rng.rand(1, 1, 3)
+        image = np.clip(base + rng.normal(0, 16, size=(h, w, 3)), 0, 255).astype(np.uint8)
+        ext = 'png' if i % 2 == 0 else 'jpg'
+        path = os.path.join(class_dir, f'{i:06d}.{ext}')
+        cv2.imwrite(path, image)
+        lines.append(f'{path} {cls}')
+    with open(list_file, 'w') as f:
+        f.write(','.join(f'tag{t}' for t in range(n_classes)) + '\n')
+        f.write('\n'.join(lines) + '\n')
+    class_dirs = [os.path.join(root, f'class{t}') for t in range(n_classes)]
+    return list_file, class_dirs
+
+
+def make_cfg(target_size, transform, crop_size=None, dataset_list=None):
+    train = dict(target_size=target_size, transform=dict(transform))
+    if crop_size is not None:
+        train['crop_size'] = crop_size
+    if dataset_list is not None:
+        train['dataset_list'] = dataset_list
+    return Config(edict(dict(train=train)))
+
+
+def transform_grid(include_crop):
+    options = dict(rotation=[None, (-10, 10)],
+                   rgb_jitter=[None, [(0.8, 1.2), (0.8, 1.2), (0.8, 1.2)]])
+    if include_crop:
+        options['crop_size'] = [None, 200]
+    keys = sorted(options)
+    for values in itertools.product(*[options[k] for k in keys]):
+        yield {k: v for k, v in zip(keys, values) if v is not None}
+
+
+def time_samples(dataset, n):
+    latencies = []
+    start = time.perf_counter()
+    for i in range(n):
+        t0 = time.perf_counter()
+        dataset[i % len(dataset)]
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    result = summarize_latency(latencies)
+    result['images_per_sec'] = n / elapsed
+    return result
+
+
+def time_loader(dataset, batchsize, num_workers, n_batches):
+    loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=batchsize,
+            shuffle=True,
+            num_workers=num_workers,
+            drop_last=True)
+    n_batches = min(n_batches, len(loader))
+    worker_rss = {}
+    loader_iter = iter(loader)
+    # the first batch pays for the worker start-up, keep it out of the steady state figure
+    t0 = time.perf_counter()
+    next(loader_iter)
+    first_batch = time.perf_counter() - t0
+    waits = []
+    start = time.perf_counter()
+    for b in range(n_batches - 1):
+        t0 = time.perf_counter()
+        next(loader_iter)
+        waits.append(time.perf_counter() - t0)
+        for pid in children_pids():
+            rss = rss_mb(pid)
+            if rss is not None:
+                worker_rss[pid] = max(rss, worker_rss.get(pid, 0.))
+    elapsed = time.perf_counter() - start
+    del loader_iter
+    result = {'batchsize': batchsize,
+              'num_workers': num_workers,
+              'first_batch_s': first_batch,
+              'images_per_sec': (n_batches - 1) * batchsize / elapsed if n_batches > 1 else None,
+              'batch_wait': summarize_latency(waits),
+              'main_rss_mb': rss_mb(),
+              'worker_rss_mb_max': max(worker_rss.values()) if worker_rss else None,
+              'worker_rss_mb_sum': sum(worker_rss.values()) if worker_rss else None,
+             }
+    return result
+
+
+def run_case(name, dataset, args, **info):
+    print(f'# {name} {info}', file=sys.stderr)
+    result = {'dataset': name, 'len': len(dataset)}
+    result.update(info)
+    result['single'] = time_samples(dataset, args.samples)
+    result['loader'] = time_loader(dataset, args.batchsize, args.num_workers, args.batches)
+    return result
+
+
+def main():
+    args = parse_args()
+    np.random.seed(args.seed)
+
+    root = args.root if args.root is not None else tempfile.mkdtemp(prefix='bench_dataset_')
+    if not os.path.exists(root):
+        os.makedirs(root)
+    list_file, class_dirs = make_corpus(root, args.n_images, args.n_classes, args.min_size, args.max_size, args.seed)
+
+    results = []
+    try:
+        if 'face' in args.datasets:
+            for resolution in args.resolutions:
+                for transform in transform_grid(include_crop=True):
+                    crop_size = transform.pop('crop_size', None)
+                    cfg = make_cfg(resolution, transform, crop_size=crop_size)
+                    dataset = FaceDataset(cfg, class_dirs[0])
+                    results.append(run_case('common.FaceDataset', dataset, args, resolution=resolution,
+                                            transform=sorted(transform), crop_size=crop_size))
+
+        if 'multiclass' in args.datasets:
+            for source, dataset_list in [('list', list_file), ('dirs', class_dirs)]:
+                for resolution in args.resolutions:
+                    for transform in transform_grid(include_crop=False):
+                        cfg = make_cfg(resolution, transform, dataset_list=dataset_list)
+                        t0 = time.perf_counter()
+                        dataset = MultiClassFaceDataset(cfg)
+                        init_s = time.perf_counter() - t0
+                        results.append(run_case('common.MultiClassFaceDataset', dataset, args, resolution=resolution,
+                                                transform=sorted(transform), source=source, init_s=init_s))
+
+        if 'progressive' in args.datasets:
+            for resolution in args.pggan_resolutions:
+                dataset = ProgressiveFaceDataset(class_dirs[0])
+                dataset.setsize([resolution, resolution])
+                results.append(run_case('progressive.FaceDataset', dataset, args, resolution=resolution, transform=[]))
+    finally:
+        if args.root is None:
+            shutil.rmtree(root)
+
+    write_results({'benchmark': 'dataset', 'env': environment_info(), 'args': vars(args), 'results': results}, args.out)
+
+if __name__ == '__main__':
+    main()
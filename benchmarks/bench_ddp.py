@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import copy
+import time
+import socket
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import torch
+import torch.distributed as torch_dist
+from torch.utils.data.distributed import DistributedSampler
+
+sys.path.append(os.pardir)
+from common.utils.benchmark import SectionTimer, environment_info, write_results
+from common.utils.distributed import Distributed
+from common.utils.accumulation import GradientAccumulation
+from bench_train import build_gan, gan_iteration, synthetic_data, PGGAN_RESOLUTIONS
+
+FAMILIES = ['dcgan64', 'dcgan128', 'sagan128', 'sn_projection64'] + [f'pggan{r}' for r in PGGAN_RESOLUTIONS]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='data-parallel (torchrun/DDP) training benchmark and consistency check')
+    parser.add_argument('--families', type=str, nargs='+', default=['dcgan64', 'sn_projection64'], choices=FAMILIES)
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--steps', type=int, default=5, help='timed iterations per run')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed iterations per run')
+    parser.add_argument('--batchsize', type=int, default=8, help='per-rank batch size')
+    parser.add_argument('--accumulation_steps', type=int, default=1, help='micro-batches per optimizer step, all-reduced once')
+    parser.add_argument('--mbstat', choices=['rank', 'global'], default='rank',
+                        help='PGGAN minibatch stddev over each rank\'s share or over the global batch')
+    parser.add_argument('--threads', type=int, default=None, help='torch threads per rank (default: cores / world size)')
+    parser.add_argument('--check', action='store_true',
+                        help='also check gradient averaging, cross-rank state consistency and dataset sharding')
+    parser.add_argument('--gpu', type=int, default=-1, help='>= 0 to run one rank per CUDA device with NCCL')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None, help='json output path (stdout if omitted)')
+    args = parser.parse_args()
+    return args
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def set_mbstat_across_ranks(model, across_ranks):
+    for module in model.modules():
+        if hasattr(module, 'across_ranks'):
+            module.across_ranks = across_ranks
+
+
+def check_gradients(m, dist, device):
+    """Max difference between the DDP-averaged D gradient of the per-rank shards and
+    the mean of the per-shard gradients of plain copies of D, all computed on every rank.
+    With minibatch statistics over all ranks the reference is one copy on the whole batch."""
+    generator = torch.Generator().manual_seed(1234)
+    batchsize = m['batchsize']
+    x = torch.rand(batchsize * dist.world_size, 3, m['resolution'], m['resolution'], generator=generator) * 2 - 1
+    y = torch.randint(0, max(m['n_classes'], 1), (x.shape[0],), generator=generator) if m['n_classes'] > 0 else None
+    x = x.to(device)
+    y = y.to(device) if y is not None else None
+    shards = [slice(r * batchsize, (r + 1) * batchsize) for r in range(dist.world_size)]
+    global_stats = any(getattr(module, 'across_ranks', False) for module in m['dis'].modules())
+    reference_shards = [slice(None)] if global_stats else shards
+
+    # one copy at a time, taken before the DDP forward moves the spectral-norm vectors
+    reference = {}
+    for shard in reference_shards:
+        plain = copy.deepcopy(m['dis'])
+        set_mbstat_across_ranks(plain, False)
+        d = m['call_dis'](plain, x[shard], y[shard] if y is not None else None)
+        d.mean().backward()
+        for name, p in plain.named_parameters():
+            if p.grad is not None:
+                reference[name] = reference.get(name, 0.) + p.grad / len(reference_shards)
+        del plain
+
+    m['opt_dis'].zero_grad()
+    shard = shards[dist.rank]
+    m['dis_fn'](x[shard], y[shard] if y is not None else None).mean().backward()
+    diff = max((p.grad - reference[name]).abs().max().item() for name, p in m['dis'].named_parameters() if p.grad is not None)
+    m['opt_dis'].zero_grad()
+    return diff
+
+
+def state_divergence(model, dist):
+    """Max difference to rank 0 over (trainable parameters, other state) of `model`."""
+    diffs = []
+    for tensors in [[p for p in model.parameters() if p.requires_grad],
+                    [p for p in model.parameters() if not p.requires_grad] + list(model.buffers())]:
+        diff = torch.zeros((), dtype=torch.float64, device=dist.device)
+        # one tensor at a time, so the check fits next to a large model
+        for t in tensors:
+            rank0 = t.detach().clone()
+            torch_dist.broadcast(rank0, 0)
+            diff = torch.max(diff, (t.detach() - rank0).abs().max().double())
+        torch_dist.all_reduce(diff, op=torch_dist.ReduceOp.MAX)
+        diffs.append(diff.item())
+    return diffs
+
+
+def check_sharding(dist, n=103):
+    """Per-rank DistributedSampler shards must be disjoint and of equal size."""
+    sampler = DistributedSampler(list(range(n)), num_replicas=dist.world_size, rank=dist.rank, shuffle=True, drop_last=True)
+    indices = torch.tensor(list(sampler), dtype=torch.long)
+    gathered = [torch.zeros_like(indices) for _ in range(dist.world_size)]
+    torch_dist.all_gather(gathered, indices)
+    union = torch.cat(gathered)
+    return len(set(union.tolist())) == len(union) and len(union) == n // dist.world_size * dist.world_size
+
+
+def run_rank(rank, world_size, port, family, args, queue):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), WORLD_SIZE=str(world_size),
+                      RANK=str(rank), LOCAL_RANK=str(rank))
+    torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // world_size))
+    dist = Distributed(args.gpu)
+    device = dist.device
+    try:
+        torch.manual_seed(args.seed)
+        np.random.seed(args.seed)
+        m = build_gan(family, device, args.batchsize)
+        m['fused_g_forward'] = False
+        # a progressive network leaves the layers of the other levels unused
+        progressive = family.startswith('pggan')
+        if progressive:
+            set_mbstat_across_ranks(m['dis'], args.mbstat == 'global')
+        m['gen_fwd'] = dist.wrap(m['gen'], find_unused_parameters=progressive)
+        m['dis_fwd'] = dist.wrap(m['dis'], find_unused_parameters=progressive)
+        m['joint_gp'] = True
+        m['accumulation'] = GradientAccumulation(args.accumulation_steps)
+        m['accumulation'].adjust_batchnorm(m['gen'], m['dis'])
+        result = {}
+        if args.check and dist.enabled:
+            result['grad_max_diff'] = check_gradients(m, dist, device)
+            result['sharding_ok'] = check_sharding(dist)
+
+        # every rank draws its own shard of (synthetic) real images
+        torch.manual_seed(args.seed + rank)
+        data = synthetic_data(m['batchsize'], m['resolution'], m['n_classes'])
+        timer = SectionTimer(sync=device.type == 'cuda')
+        for _ in range(args.warmup):
+            gan_iteration(m, data, timer, device)
+            dist.sync_states(m['gen'], m['dis'])
+        dist.barrier()
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            gan_iteration(m, data, timer, device)
+            dist.sync_states(m['gen'], m['dis'])
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        dist.barrier()
+        elapsed = time.perf_counter() - start
+
+        if args.check and dist.enabled:
+            for name in ['gen', 'dis']:
+                params, state = state_divergence(m[name], dist)
+                result[f'{name}_param_max_diff'] = params
+                result[f'{name}_state_max_diff'] = state
+        result.update({'family': family,
+                       'world_size': world_size,
+                       'backend': dist.backend,
+                       'batchsize_per_rank': m['batchsize'],
+                       'global_batchsize': m['batchsize'] * world_size,
+                       'mbstat': args.mbstat if progressive else None,
+                       'accumulation_steps': args.accumulation_steps,
+                       'steps': args.steps,
+                       'it_per_s': args.steps / elapsed,
+                       'images_per_s': args.steps * m['batchsize'] * world_size / elapsed,
+                      })
+        if rank == 0:
+            queue.put(result)
+    except Exception as e:
+        if rank == 0:
+            queue.put({'family': family, 'world_size': world_size, 'error': repr(e)})
+        raise
+    finally:
+        dist.close()
+
+
+def run(family, world_size, args):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    port = free_port()
+    procs = [ctx.Process(target=run_rank, args=(rank, world_size, port, family, args, queue)) for rank in range(world_size)]
+    for p in procs:
+        p.start()
+    result = queue.get()
+    for p in procs:
+        p.join()
+    return result
+
+
+def main():
+    args = parse_args()
+
+    results = []
+    for family in args.families:
+        runs = []
+        for world_size in args.world_sizes:
+            print(f'# {family} x{world_size}', file=sys.stderr)
+            runs.append(run(family, world_size, args))
+        base = runs[0]
+        for r in runs:
+            if 'error' not in r and 'error' not in base:
+                # throughput in images/s relative to perfect scaling from the first world size
+                r['scaling_efficiency'] = r['images_per_s'] / (base['images_per_s'] * r['world_size'] / base['world_size'])
+        results += runs
+
+    write_results({'benchmark': 'ddp', 'env': environment_info(), 'args': vars(args), 'results': results}, args.out)
+
+if __name__ == '__main__':
+    main()
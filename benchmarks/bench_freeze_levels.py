@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import copy
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.pardir)
+sys.path.append(os.path.join(os.pardir, 'progressive'))
+from common.utils.config import Config
+from common.utils.freezing import LevelFreezing
+from common.functions.gradient_penalty import gradient_penalty
+from common.utils.benchmark import summarize_latency, environment_info, write_results
+
+CONFIG = '../progressive/configs/danbooru/pggan256-wgan-gp.py'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='PGGAN frozen lower levels: step time and quality proxies at the top level, '
+                                                 'against training every level')
+    parser.add_argument('--config', type=str, default=CONFIG)
+    parser.add_argument('--resolution', type=int, default=64, help='the level trained with the stabilized ones frozen')
+    parser.add_argument('--z_dim', type=int, default=64, help='generator width (get_nf scales with z_dim); the config\'s if 0')
+    parser.add_argument('--d_f_map', type=int, default=1024, help='discriminator initial_f_map; the config\'s if 0')
+    parser.add_argument('--margin', type=int, default=2, help='levels below the current one that stay trainable')
+    parser.add_argument('--every', type=int, nargs='+', default=[0, 4], help='schedules to compare: 0 freezes, k trains every k-th step')
+    parser.add_argument('--batchsize', type=int, default=8)
+    parser.add_argument('--warmup_steps', type=int, default=20, help='steps per lower level, all trainable, shared by every schedule')
+    parser.add_argument('--steps', type=int, default=30, help='timed steps at the top level per schedule')
+    parser.add_argument('--n_eval', type=int, default=64, help='fakes and reals the quality proxies compare')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--gpu', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None, help='json output path (stdout if omitted)')
+    args = parser.parse_args()
+    return args
+
+
+def build(args, device):
+    from models import old_model
+    cfg = Config.from_file(args.config)
+    if args.z_dim:
+        cfg.models.generator.z_dim = args.z_dim
+    if args.d_f_map:
+        cfg.models.discriminator.initial_f_map = args.d_f_map
+    cfg.models.discriminator.sigmoid_at_end = False
+    G = old_model.Generator(model_cfg=cfg.models.generator, target_size=args.resolution).to(device).train()
+    D = old_model.Discriminator(model_cfg=cfg.models.discriminator, target_size=args.resolution).to(device).train()
+    p = cfg.train.parameters
+    opt_G = torch.optim.Adam(G.parameters(), lr=p.g_lr, betas=(p.beta1, p.beta2))
+    opt_D = torch.optim.Adam(D.parameters(), lr=p.d_lr, betas=(p.beta1, p.beta2))
+    return G, D, opt_G, opt_D, cfg.models.generator.z_dim, p.lambda_gp
+
+
+def real_pool(n, resolution, seed, device):
+    # smooth random images with some finer detail: structure at every level, unlike white noise
+    generator = torch.Generator().manual_seed(seed)
+    coarse = F.interpolate(torch.randn(n, 3, 4, 4, generator=generator), size=resolution, mode='bilinear', align_corners=False)
+    fine = F.interpolate(torch.randn(n, 3, resolution // 4, resolution // 4, generator=generator), size=resolution, mode='bilinear', align_corners=False)
+    return torch.tanh(coarse + 0.3 * fine).to(device)
+
+
+def downscale(x, resolution):
+    return F.avg_pool2d(x, x.size(-1) // resolution) if x.size(-1) > resolution else x
+
+
+def sliced_wasserstein(a, b, n_proj=128, seed=0):
+    # mean over random directions of the 1-d Wasserstein distance between the projected images
+    a, b = a.flatten(1), b.flatten(1)
+    directions = torch.randn(a.size(1), n_proj, generator=torch.Generator().manual_seed(seed)).to(a)
+    directions = directions / directions.norm(dim=0, keepdim=True)
+    pa, pb = (a @ directions).sort(0)[0], (b @ directions).sort(0)[0]
+    return (pa - pb).abs().mean().item()
+
+
+def train_step(models, real, level, z_dim, lambda_gp, device, freezing=None, step=0):
+    G, D, opt_G, opt_D = models
+    if freezing is not None:
+        freezing.apply(G, D, 2 ** (level + 1), step)
+    z = torch.randn(real.size(0), z_dim, device=device)
+    start = time.perf_counter()
+    opt_D.zero_grad()
+    with torch.no_grad():
+        fake = G(z, cur_level=level)
+    d_real, d_fake = D(real, cur_level=level), D(fake, cur_level=level)
+    gp = gradient_penalty(real, fake, lambda x: D(x, cur_level=level), device)
+    # the trainer's WGAN-GP loss, with its drift term
+    (d_fake.mean() - d_real.mean() + 0.001 * (d_real ** 2).mean() + lambda_gp * gp).backward()
+    opt_D.step()
+    d_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    opt_G.zero_grad()
+    (- D(G(z, cur_level=level), cur_level=level).mean()).backward()
+    opt_G.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return d_time, time.perf_counter() - start, (d_real.mean() - d_fake.mean()).item(), gp.item()
+
+
+def run_schedule(snapshot, every, pool, args, device):
+    models = copy.deepcopy(snapshot[:4])
+    z_dim, lambda_gp = snapshot[4:]
+    G, D, opt_G, opt_D = models
+    level = int(np.log2(args.resolution)) - 1
+    freezing = LevelFreezing(margin=args.margin, every=every, min_resolution=args.resolution) if every is not None else None
+    before = {id(p): p.detach().clone() for p in list(G.parameters()) + list(D.parameters())}
+    moments = {id(p): state['exp_avg_sq'].clone() for opt in [opt_G, opt_D] for p, state in opt.state.items()}
+
+    # the same batches and noise for every schedule
+    torch.manual_seed(args.seed + 1)
+    d_times, g_times, w_dists, gps = [], [], [], []
+    for step in range(args.steps):
+        real = pool[torch.randint(0, pool.size(0), (args.batchsize,))]
+        d_time, g_time, w_dist, gp = train_step(models, real, level, z_dim, lambda_gp, device, freezing, step)
+        if step > 0:
+            d_times.append(d_time)
+            g_times.append(g_time)
+        w_dists.append(w_dist)
+        gps.append(gp)
+
+    blocks = [block for model in [G, D] for r, block in model.checkpoint_blocks()
+              if freezing is not None and r <= freezing.frozen_resolution(args.resolution)]
+    params = [p for block in blocks for p in block.parameters()]
+    result = {'schedule': 'off' if every is None else ('frozen' if every == 0 else f'every {every}'),
+              'frozen_blocks': len(blocks),
+              'frozen_params': sum(p.numel() for p in params),
+              # how far the stabilized blocks moved: 0 when frozen
+              'frozen_weight_drift': max([(p.detach() - before[id(p)]).abs().max().item() for p in params], default=None),
+              # and their Adam moments: 0 when the optimizer skipped them
+              'frozen_moment_drift': max([(opt.state[p]['exp_avg_sq'] - moments[id(p)]).abs().max().item()
+                                          for opt in [opt_G, opt_D] for p in params if p in opt.state], default=None),
+              'd_step': summarize_latency(d_times),
+              'g_step': summarize_latency(g_times),
+              # quality proxies over the last half of the steps
+              'w_distance': float(np.mean(w_dists[len(w_dists) // 2:])),
+              'gradient_penalty': float(np.mean(gps[len(gps) // 2:])),
+             }
+    with torch.no_grad():
+        z = torch.randn(args.n_eval, z_dim, generator=torch.Generator().manual_seed(args.seed + 2)).to(device)
+        fake = G(z, cur_level=level)
+    result['swd'] = sliced_wasserstein(fake, pool[:args.n_eval], seed=args.seed)
+    # per level: the coarse structure is what the frozen blocks produce
+    result['swd_per_resolution'] = {r: sliced_wasserstein(downscale(fake, r), downscale(pool[:args.n_eval], r), seed=args.seed)
+                                    for r in [args.resolution // 4, args.resolution // 2, args.resolution] if r >= 4}
+    return result, fake
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(f'cuda:{args.gpu}') if args.gpu >= 0 and torch.cuda.is_available() else torch.device('cpu')
+
+    torch.manual_seed(args.seed)
+    G, D, opt_G, opt_D, z_dim, lambda_gp = build(args, device)
+    pool = real_pool(max(args.n_eval, 4 * args.batchsize), args.resolution, args.seed, device)
+    # the lower levels trained (briefly) as the schedule would leave them
+    top = int(np.log2(args.resolution)) - 1
+    for level in range(1, top):
+        print(f'# warmup {2 ** (level + 1)}px', file=sys.stderr)
+        for _ in range(args.warmup_steps):
+            real = downscale(pool[torch.randint(0, pool.size(0), (args.batchsize,))], 2 ** (level + 1))
+            train_step((G, D, opt_G, opt_D), real, level, z_dim, lambda_gp, device)
+    snapshot = (G, D, opt_G, opt_D, z_dim, lambda_gp)
+
+    results = []
+    for every in [None] + args.every:
+        print(f'# {args.resolution}px every={every}', file=sys.stderr)
+        result, fake = run_schedule(snapshot, every, pool, args, device)
+        if every is None:
+            reference = fake
+        # how far the schedule moved the samples of fixed noise from those of training every level
+        result['fake_diff_from_off'] = (fake - reference).abs().mean().item()
+        results.append(result)
+    base = results[0]['d_step']['mean_ms'] + results[0]['g_step']['mean_ms']
+    for r in results:
+        r['speedup'] = base / (r['d_step']['mean_ms'] + r['g_step']['mean_ms'])
+
+    write_results({'benchmark': 'freeze_levels', 'env': environment_info(), 'args': vars(args), 'results': results}, args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import argparse
+import itertools
+
+import numpy as np
+import torch
+
+sys.path.append(os.pardir)
+sys.path.append(os.path.join(os.pardir, 'progressive'))
+from common.utils.config import Config
+from common.utils.benchmark import summarize_latency, environment_info, write_results
+
+CONFIG = '../progressive/configs/danbooru/pggan256-wgan-gp.py'
+MODES = ['grad', 'no_grad', 'inference_mode']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='PGGAN generator inference benchmark: threads and autograd mode per level')
+    parser.add_argument('--config', type=str, default=CONFIG)
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--batchsize', type=int, default=16, help='images per forward (progressive/inference.py: --row squared)')
+    parser.add_argument('--threads', type=int, nargs='+', default=None,
+                        help='intra-op thread counts to try (default: 1 and every power of two up to the cpu count)')
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES,
+                        help='a plain forward (the former inference.py), under no_grad, under inference_mode')
+    parser.add_argument('--steps', type=int, default=10, help='timed forwards per setting')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--gpu', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None, help='json output path (stdout if omitted)')
+    args = parser.parse_args()
+    return args
+
+
+def default_threads():
+    counts = [1]
+    while counts[-1] * 2 <= os.cpu_count():
+        counts.append(counts[-1] * 2)
+    if counts[-1] != os.cpu_count():
+        counts.append(os.cpu_count())
+    return counts
+
+
+def mode_context(mode):
+    if mode == 'grad':
+        return torch.enable_grad()
+    if mode == 'no_grad':
+        return torch.no_grad()
+    return getattr(torch, 'inference_mode', torch.no_grad)()
+
+
+def run_case(G, z_dim, resolution, threads, mode, args, device):
+    torch.set_num_threads(threads)
+    cur_level = int(np.log2(resolution)) - 1
+    z = torch.randn(args.batchsize, z_dim, device=device)
+    latencies = []
+    with mode_context(mode):
+        for i in range(args.warmup + args.steps):
+            start = time.perf_counter()
+            fake = G(z, cur_level=cur_level)
+            fake.cpu()
+            if i >= args.warmup:
+                latencies.append(time.perf_counter() - start)
+    result = {'resolution': resolution,
+              'threads': threads,
+              'mode': mode,
+              'latency': summarize_latency(latencies),
+              'images_per_s': args.batchsize * len(latencies) / sum(latencies),
+             }
+    return result
+
+
+def main():
+    args = parse_args()
+    device = torch.device(f'cuda:{args.gpu}') if args.gpu >= 0 and torch.cuda.is_available() else torch.device('cpu')
+    threads = args.threads if args.threads is not None else default_threads()
+
+    from models import old_model
+    cfg = Config.from_file(args.config)
+    torch.manual_seed(args.seed)
+    G = old_model.Generator(model_cfg=cfg.models.generator, target_size=cfg.train.target_size).to(device).eval()
+
+    results = []
+    for resolution, n, mode in itertools.product(args.resolutions, threads, args.modes):
+        print(f'# {resolution}px threads={n} {mode}', file=sys.stderr)
+        results.append(run_case(G, cfg.models.generator.z_dim, resolution, n, mode, args, device))
+
+    # the fastest setting per resolution, and its speedup over a plain forward on the most threads
+    best = {}
+    for resolution in args.resolutions:
+        rows = [r for r in results if r['resolution'] == resolution]
+        top = max(rows, key=lambda r: r['images_per_s'])
+        base = [r for r in rows if r['mode'] == 'grad' and r['threads'] == max(threads)]
+        best[resolution] = {'threads': top['threads'], 'mode': top['mode'], 'images_per_s': top['images_per_s'],
+                            'speedup': top['images_per_s'] / base[0]['images_per_s'] if base else None}
+
+    write_results({'benchmark': 'pggan_inference', 'env': environment_info(), 'args': vars(args),
+                   'results': results, 'best': best}, args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import copy
+import time
+import argparse
+
+import numpy as np
+import torch
+
+sys.path.append(os.pardir)
+sys.path.append(os.path.join(os.pardir, 'progressive'))
+from common.utils.config import Config
+from common.utils.benchmark import environment_info, write_results
+from bench_blocks import rel_diff, saved_mb
+
+CONFIG = '../progressive/configs/danbooru/pggan256-wgan-gp.py'
+NETS = ['gen', 'dis']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='PGGAN layer benchmark: fused PixelNorm, equalized learning rate and minibatch stddev against the original layers, per level')
+    parser.add_argument('--nets', type=str, nargs='+', default=NETS, choices=NETS)
+    parser.add_argument('--wscale', type=int, nargs='+', default=[0, 1], choices=[0, 1],
+                        help='build the models without/with equalized learning rate (use_wscale)')
+    parser.add_argument('--max_resolution', type=int, default=64, help='benchmark the levels up to this resolution')
+    parser.add_argument('--batchsize', type=int, default=8)
+    parser.add_argument('--steps', type=int, default=5, help='timed forward/backward passes per level and variant')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--tolerance', type=float, default=1e-10, help='largest relative difference (in float64) --check accepts')
+    parser.add_argument('--check', action='store_true', help='exit with an error if a fused model is not equivalent')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--gpu', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None, help='json output path (stdout if omitted)')
+    args = parser.parse_args()
+    return args
+
+
+def build(net, wscale):
+    # progressive.models.model holds no model classes in this tree; old_model is the live pair
+    from models import old_model
+    cfg = Config.from_file(CONFIG)
+    model_cfg = cfg.models.generator if net == 'gen' else cfg.models.discriminator
+    model_cfg.use_wscale = bool(wscale)
+    if net == 'gen':
+        return old_model.Generator(model_cfg=model_cfg, target_size=cfg.train.target_size), model_cfg.z_dim
+    model_cfg.sigmoid_at_end = cfg.train.loss_type in ['ls', 'gan']
+    return old_model.Discriminator(model_cfg=model_cfg, target_size=cfg.train.target_size), None
+
+
+def run_case(net, wscale, level, args, device):
+    from models.base_model import set_fused_layers
+    torch.manual_seed(args.seed)
+    model, z_dim = build(net, wscale)
+    plain = model.to(device).train()
+    set_fused_layers(plain, False)
+    fused = copy.deepcopy(plain)
+    n_layers = set_fused_layers(fused)
+    resolution = 2 ** (level + 1)
+    shape = (z_dim,) if net == 'gen' else (3, resolution, resolution)
+    x = torch.randn(args.batchsize, *shape, device=device)
+    forward = lambda model, x: model(x, cur_level=level)
+
+    with torch.no_grad():
+        grad_out = torch.randn_like(forward(plain, x))
+
+    def step(model, dtype):
+        xi = x.to(dtype).requires_grad_()
+        out = forward(model, xi)
+        (out * grad_out.to(dtype)).sum().backward()
+        return out.detach(), xi.grad
+
+    def penalty_grads(model, dtype):
+        # the gradient penalty differentiates the input gradient once more
+        model.zero_grad()
+        xi = x.to(dtype).requires_grad_()
+        grad, = torch.autograd.grad(forward(model, xi).sum(), xi, create_graph=True)
+        (grad.flatten(1).norm(dim=1) - 1).pow(2).mean().backward()
+        return [p.grad for p in model.parameters() if p.grad is not None]
+
+    # one identical step through both models, in float64
+    check_p, check_f = copy.deepcopy(plain).double(), copy.deepcopy(fused).double()
+    out_p, gx_p = step(check_p, torch.float64)
+    out_f, gx_f = step(check_f, torch.float64)
+    pairs = [(p.grad, f.grad) for p, f in zip(check_p.parameters(), check_f.parameters()) if p.grad is not None]
+    scale = max(p.abs().max() for p, _ in pairs)
+    saved_p, _ = saved_mb(lambda: forward(plain, x.clone().requires_grad_()))
+    saved_f, _ = saved_mb(lambda: forward(fused, x.clone().requires_grad_()))
+    result = {'net': net,
+              'use_wscale': bool(wscale),
+              'level': level,
+              'resolution': resolution,
+              'fused_layers': n_layers,
+              'output_rel_diff': rel_diff(out_p, out_f),
+              'input_grad_rel_diff': rel_diff(gx_p, gx_f),
+              'param_grad_rel_diff': max(rel_diff(p, f, scale) for p, f in pairs),
+              'saved_mb': {'plain': saved_p, 'fused': saved_f},
+             }
+    diffs = [result['output_rel_diff'], result['input_grad_rel_diff'], result['param_grad_rel_diff']]
+    if net == 'dis':
+        pairs = list(zip(penalty_grads(check_p, torch.float64), penalty_grads(check_f, torch.float64)))
+        scale = max(p.abs().max() for p, _ in pairs)
+        result['penalty_grad_rel_diff'] = max(rel_diff(p, f, scale) for p, f in pairs)
+        diffs.append(result['penalty_grad_rel_diff'])
+    result['equivalent'] = max(diffs) <= args.tolerance
+
+    for variant, model in [('plain', plain), ('fused', fused)]:
+        def fwd_bwd():
+            xi = x.clone().requires_grad_()
+            (forward(model, xi) * grad_out).sum().backward()
+        for _ in range(args.warmup):
+            fwd_bwd()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            fwd_bwd()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        result.setdefault('ms_per_fwd_bwd', {})[variant] = (time.perf_counter() - start) / args.steps * 1e3
+    result['speedup'] = result['ms_per_fwd_bwd']['plain'] / result['ms_per_fwd_bwd']['fused']
+    result['saved_memory_ratio'] = saved_f / saved_p
+    return result
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(f'cuda:{args.gpu}') if args.gpu >= 0 and torch.cuda.is_available() else torch.device('cpu')
+
+    results = []
+    for wscale in args.wscale:
+        for level in range(1, int(np.log2(args.max_resolution))):
+            for net in args.nets:
+                print(f'# {net} level {level} use_wscale={bool(wscale)}', file=sys.stderr)
+                results.append(run_case(net, wscale, level, args, device))
+
+    write_results({'benchmark': 'pggan_layers', 'env': environment_info(), 'args': vars(args), 'results': results}, args.out)
+    failed = [(r['net'], r['level'], r['use_wscale']) for r in results if not r['equivalent']]
+    if args.check and failed:
+        sys.exit(f'fused layers differ from the original ones: {failed}')
+
+if __name__ == '__main__':
+    main()
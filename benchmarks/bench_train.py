@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import copy
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.optim import Adam
+
+sys.path.append(os.pardir)
+sys.path.append(os.path.join(os.pardir, 'progressive'))
+from common.utils.config import Config
+from common.utils.benchmark import SectionTimer, peak_rss_mb, environment_info, write_results
+from common.functions.gradient_penalty import gradient_penalty
+from common.utils.accumulation import GradientAccumulation
+from common.modules.activation_checkpoint import set_checkpoint
+from common.utils.memory_format import find_conversions
+
+PGGAN_RESOLUTIONS = [4, 8, 16, 32, 64, 128, 256]
+FAMILIES = ['dcgan64', 'dcgan128', 'sagan128', 'sn_projection64'] + \
+           [f'pggan{r}' for r in PGGAN_RESOLUTIONS] + ['adain']
+SECTIONS = ['data', 'd_step', 'gp', 'g_step']
+
+CONFIGS = {'dcgan': '../dcgan/configs/danbooru/dcgan128-wgan-gp.py',
+           'sagan': '../sagan/configs/danbooru/sagan128-wgan-gp.py',
+           'sn_projection': '../sn_projection/configs/danbooru/sn_projection64-hinge.py',
+           'pggan': '../progressive/configs/danbooru/pggan256-wgan-gp.py',
+           'adain': '../AdaIN/configs/coco2art.py',
+          }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='end-to-end training throughput benchmark')
+    parser.add_argument('--families', type=str, nargs='+', default=FAMILIES, choices=FAMILIES)
+    parser.add_argument('--steps', type=int, default=10, help='timed iterations per family')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed iterations per family')
+    parser.add_argument('--batchsize', type=int, default=None, help='override the config (or PGGAN level) batch size')
+    parser.add_argument('--pggan_phase', choices=['stabilize', 'fade_in'], default='stabilize')
+    parser.add_argument('--fused_g_forward', action='store_true', help='reuse the D step fake batch for the G step')
+    parser.add_argument('--accumulation_steps', type=int, default=1, help='micro-batches per optimizer step (same batch size)')
+    parser.add_argument('--check_accumulation', action='store_true',
+                        help='compare whole-batch and accumulated D gradients and BatchNorm statistics')
+    parser.add_argument('--compile', choices=['off', 'on', 'compare'], default='off',
+                        help='torch.compile the model forwards; "compare" runs every family eagerly and compiled')
+    parser.add_argument('--compile_mode', type=str, default=None, help='torch.compile mode (default, reduce-overhead, max-autotune)')
+    parser.add_argument('--activation_checkpoint', choices=['off', 'on', 'compare'], default='off',
+                        help='recompute block activations in the backward (SAGAN, PGGAN); "compare" runs with and without')
+    parser.add_argument('--checkpoint_resolution', type=int, default=None,
+                        help='checkpoint only the blocks at or above this resolution (default: all)')
+    parser.add_argument('--channels_last', choices=['off', 'on', 'compare'], default='off',
+                        help='channels-last (NHWC) models and batches; "compare" runs in both layouts')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--gpu', type=int, default=-1)
+    parser.add_argument('--no_isolate', action='store_true', help='run all families in this process')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None, help='json output path (stdout if omitted)')
+    args = parser.parse_args()
+    return args
+
+
+def pggan_batchsize(resolution):
+    # same schedule as PGGAN.get_bs
+    R = int(np.log2(resolution))
+    if R < 7:
+        bs = 32 / 2**(max(0, R-4))
+    else:
+        bs = 8 / 2**(min(2, R-6))
+    return int(bs)
+
+
+def synthetic_data(batchsize, resolution, n_classes=0, pool=4):
+    """Cycle over a small pool of in-memory batches in [-1, 1]."""
+    images = [torch.rand(batchsize, 3, resolution, resolution) * 2 - 1 for _ in range(pool)]
+    labels = [torch.randint(0, max(n_classes, 1), (batchsize,), dtype=torch.long) for _ in range(pool)]
+    i = 0
+    while True:
+        yield images[i % pool], (labels[i % pool] if n_classes > 0 else None)
+        i += 1
+
+
+def build_gan(family, device, batchsize):
+    """Return the models, optimizers and loss settings of one GAN family."""
+    m = {'n_classes': 0, 'n_dis': 1, 'drift': 0.}
+    if family.startswith('dcgan'):
+        from dcgan.models import dcgan
+        cfg = Config.from_file(CONFIGS['dcgan'])
+        resolution = int(family[len('dcgan'):])
+        gen = getattr(dcgan, f'Generator{resolution}')(z_dim=cfg.models.generator.z_dim, norm=cfg.models.generator.norm)
+        dis = getattr(dcgan, f'Discriminator{resolution}')(norm=cfg.models.discriminator.norm, use_sigmoid=cfg.models.discriminator.use_sigmoid)
+        betas = (0.5, 0.999)
+        m.update(z_dim=cfg.models.generator.z_dim, drift=0.1)
+        call_gen = lambda gen, z, y: gen(z)
+        call_dis = lambda dis, x, y=None: dis(x)
+    elif family == 'sagan128':
+        from sagan.models import sagan
+        cfg = Config.from_file(CONFIGS['sagan'])
+        resolution = cfg.train.target_size
+        gen = getattr(sagan, cfg.models.generator.name)(z_dim=cfg.models.generator.z_dim, norm=cfg.models.generator.norm)
+        dis = getattr(sagan, cfg.models.discriminator.name)(norm=cfg.models.discriminator.norm)
+        betas = (cfg.train.parameters.adam_beta1, cfg.train.parameters.adam_beta2)
+        m.update(z_dim=cfg.models.generator.z_dim, n_dis=cfg.train.discriminator_iter, drift=0.1)
+        call_gen = lambda gen, z, y: gen(z)[0]
+        call_dis = lambda dis, x, y=None: dis(x)
+    elif family == 'sn_projection64':
+        from sn_projection.models import sn_projection
+        cfg = Config.from_file(CONFIGS['sn_projection'])
+        resolution = cfg.train.target_size
+        gen = getattr(sn_projection, cfg.models.generator.name)(z_dim=cfg.models.generator.z_dim, norm=cfg.models.generator.norm, n_classes=cfg.train.n_classes)
+        dis = getattr(sn_projection, cfg.models.discriminator.name)(norm=cfg.models.discriminator.norm, n_classes=cfg.train.n_classes)
+        betas = (0., 0.999)
+        m.update(z_dim=cfg.models.generator.z_dim, n_dis=cfg.train.discriminator_iter, n_classes=cfg.train.n_classes)
+        call_gen = lambda gen, z, y: gen(z, y=y)
+        call_dis = lambda dis, x, y=None: dis(x, y=y)
+    elif family.startswith('pggan'):
+        # progressive.models.model holds no model classes in this tree; old_model is
+        # the Generator/Discriminator pair that training and inference actually build
+        from models import old_model
+        cfg = Config.from_file(CONFIGS['pggan'])
+        cfg.models.discriminator.sigmoid_at_end = cfg.train.loss_type in ['ls', 'gan']
+        resolution = int(family[len('pggan'):])
+        gen = old_model.Generator(model_cfg=cfg.models.generator, target_size=cfg.train.target_size)
+        dis = old_model.Discriminator(model_cfg=cfg.models.discriminator, target_size=cfg.train.target_size)
+        betas = (cfg.train.parameters.beta1, cfg.train.parameters.beta2)
+        cur_level = int(np.log2(resolution)) - 1
+        m.update(z_dim=cfg.models.generator.z_dim, drift=0.001, cur_level=cur_level)
+        call_gen = lambda gen, z, y: gen(z, cur_level=m['cur_level'])
+        call_dis = lambda dis, x, y=None: dis(x, cur_level=m['cur_level'])
+        if batchsize is None:
+            batchsize = pggan_batchsize(resolution)
+    else:
+        raise ValueError(f'unknown family {family}')
+
+    gen.to(device)
+    dis.to(device)
+    gen.train()
+    dis.train()
+    m['gen'], m['dis'] = gen, dis
+    # the training forwards go through gen_fwd/dis_fwd, which callers may replace by
+    # wrapped (e.g. DDP) modules; the gradient penalty needs a double backward, which
+    # neither compiled graphs nor DDP support, so it always calls the plain D
+    m['gen_fwd'], m['dis_fwd'] = gen, dis
+    m['gen_fn'] = lambda z, y: call_gen(m['gen_fwd'], z, y)
+    m['dis_fn'] = lambda x, y=None: call_dis(m['dis_fwd'], x, y)
+    m['dis_gp_fn'] = lambda x, y=None: call_dis(dis, x, y)
+    m['call_gen'], m['call_dis'] = call_gen, call_dis
+    m['joint_gp'] = False
+    m['accumulation'] = GradientAccumulation()
+    m['loss_type'] = cfg.train.loss_type
+    m['lambda_gp'] = cfg.train.parameters.lambda_gp if hasattr(cfg.train.parameters, 'lambda_gp') else 10
+    m['opt_gen'] = Adam(gen.parameters(), lr=cfg.train.parameters.g_lr, betas=betas)
+    m['opt_dis'] = Adam(dis.parameters(), lr=cfg.train.parameters.d_lr, betas=betas)
+    m['resolution'] = resolution
+    m['batchsize'] = batchsize if batchsize is not None else cfg.train.batchsize
+    m['memory_format'] = torch.preserve_format
+    return m
+
+
+def d_adv_loss(loss_type, d_real, d_fake):
+    if loss_type == 'ls':
+        return torch.mean((d_real - 1) ** 2) + torch.mean(d_fake ** 2)
+    elif loss_type == 'hinge':
+        return F.relu(1.0 - d_real).mean() + F.relu(1.0 + d_fake).mean()
+    return torch.mean(d_fake) - torch.mean(d_real)
+
+
+def g_adv_loss(loss_type, d_fake):
+    if loss_type == 'ls':
+        return torch.mean((d_fake - 1) ** 2)
+    return - torch.mean(d_fake)
+
+
+def gan_iteration(m, data, timer, device):
+    gen_fn, dis_fn = m['gen_fn'], m['dis_fn']
+    accumulation = m['accumulation']
+    batchsize = accumulation.micro_batchsize(m['batchsize'])
+    # the fused G forward would keep the graphs of all micro-batches
+    fused_g_forward = m['fused_g_forward'] and not accumulation.enabled
+    for j in range(m['n_dis']):
+        with timer('data'):
+            x_batch, y_batch = next(data)
+            x_batch = x_batch.to(device, memory_format=m['memory_format'])
+            y_batch = y_batch.to(device) if y_batch is not None else None
+
+        m['opt_gen'].zero_grad()
+        m['opt_dis'].zero_grad()
+        for k, (x_real, y) in enumerate(accumulation.split(x_batch, y_batch)):
+            with accumulation.no_sync(k, m['dis_fwd']):
+                with timer('d_step'):
+                    z = torch.randn(batchsize, m['z_dim'], device=device)
+                    if fused_g_forward and j == 0:
+                        y_g = y
+                        x_fake_g = gen_fn(z, y)
+                        x_fake = x_fake_g.detach()
+                    else:
+                        with torch.no_grad():
+                            x_fake = gen_fn(z, y).detach()
+                    d_real = dis_fn(x_real, y)
+                    d_fake = dis_fn(x_fake, y)
+                    d_loss = d_adv_loss(m['loss_type'], d_real, d_fake)
+                    if m['loss_type'] == 'wgan-gp':
+                        d_loss = d_loss + m['drift'] * torch.mean(d_real * d_real)
+                    if not m['joint_gp']:
+                        accumulation.scale(d_loss).backward()
+
+                # the penalty is backpropagated on its own so that its double backward is
+                # timed separately; gradients accumulate to the same total as in the trainers.
+                # Under DDP only one backward per forward is all-reduced, so there
+                # (`joint_gp`) it joins d_loss for a single backward as in the trainers
+                if m['loss_type'] == 'wgan-gp':
+                    with timer('gp'):
+                        d_loss_gp = gradient_penalty(x_real, x_fake, m['dis_gp_fn'], device, y=y)
+                        if m['joint_gp']:
+                            d_loss = d_loss + m['lambda_gp'] * d_loss_gp
+                        else:
+                            accumulation.scale(m['lambda_gp'] * d_loss_gp).backward()
+                if m['joint_gp']:
+                    with timer('d_step'):
+                        accumulation.scale(d_loss).backward()
+
+        with timer('d_step'):
+            m['opt_dis'].step()
+
+    with timer('g_step'):
+        m['opt_gen'].zero_grad()
+        m['opt_dis'].zero_grad()
+        for k in range(accumulation.steps):
+            with accumulation.no_sync(k, m['gen_fwd'], m['dis_fwd']):
+                if fused_g_forward:
+                    d_fake = dis_fn(x_fake_g, y_g)
+                else:
+                    z = torch.randn(batchsize, m['z_dim'], device=device)
+                    y = torch.randint(0, m['n_classes'], (batchsize,), dtype=torch.long, device=device) if m['n_classes'] > 0 else None
+                    d_fake = dis_fn(gen_fn(z, y), y)
+                g_loss = g_adv_loss(m['loss_type'], d_fake)
+                accumulation.scale(g_loss).backward()
+        m['opt_gen'].step()
+
+
+def check_accumulation(m, device, seed=0):
+    """Whole batch against accumulated micro-batches, on one batch of real and fake images.
+
+    `grad_rel_diff` compares the D gradients of the adversarial loss plus the
+    gradient penalty (max difference over max magnitude), with D in eval mode
+    so that BatchNorm does not tie the samples together (SAGAN's attention
+    softmax and PGGAN's minibatch stddev still do, so their difference is not
+    expected to vanish). `bn_mean_max_diff`/`bn_var_max_diff` compare the
+    G and D BatchNorm running statistics after one training forward of the
+    batch and after the micro-batch forwards with the adjusted momentum.
+    """
+    accumulation = m['accumulation']
+    generator = torch.Generator().manual_seed(seed)
+    x_real = (torch.rand(m['batchsize'], 3, m['resolution'], m['resolution'], generator=generator) * 2 - 1).to(device)
+    y = torch.randint(0, max(m['n_classes'], 1), (m['batchsize'],), generator=generator).to(device) if m['n_classes'] > 0 else None
+    z = torch.randn(m['batchsize'], m['z_dim'], generator=generator).to(device)
+    with torch.no_grad():
+        x_fake = m['gen_fn'](z, y).detach()
+
+    def d_grads(micro_batches, scale):
+        dis = copy.deepcopy(m['dis']).eval()
+        torch.manual_seed(seed)
+        for x_r, x_f, y_k in micro_batches:
+            d_real = m['call_dis'](dis, x_r, y_k)
+            d_loss = d_adv_loss(m['loss_type'], d_real, m['call_dis'](dis, x_f, y_k))
+            if m['loss_type'] == 'wgan-gp':
+                d_loss = d_loss + m['drift'] * torch.mean(d_real * d_real)
+                d_loss = d_loss + m['lambda_gp'] * gradient_penalty(x_r, x_f, lambda x, y=None: m['call_dis'](dis, x, y), device, y=y_k)
+            scale(d_loss).backward()
+        return {name: p.grad for name, p in dis.named_parameters() if p.grad is not None}
+
+    whole = d_grads([(x_real, x_fake, y)], lambda loss: loss)
+    accumulated = d_grads(accumulation.split(x_real, x_fake, y), accumulation.scale)
+    result = {'grad_rel_diff': max((whole[name] - accumulated[name]).abs().max().item() for name in whole) /
+                               max(g.abs().max().item() for g in whole.values())}
+
+    def bn_stats(micro_batches, steps):
+        gen, dis = copy.deepcopy(m['gen']).train(), copy.deepcopy(m['dis']).train()
+        GradientAccumulation(steps).adjust_batchnorm(gen, dis)
+        with torch.no_grad():
+            for x_r, z_k, y_k in micro_batches:
+                m['call_gen'](gen, z_k, y_k)
+                m['call_dis'](dis, x_r, y_k)
+        return [(b.running_mean, b.running_var) for b in list(gen.modules()) + list(dis.modules())
+                if getattr(b, 'running_mean', None) is not None]
+
+    whole = bn_stats([(x_real, z, y)], 1)
+    accumulated = bn_stats(accumulation.split(x_real, z, y), accumulation.steps)
+    result['bn_mean_max_diff'] = max(((a[0] - b[0]).abs().max().item() for a, b in zip(whole, accumulated)), default=None)
+    result['bn_var_max_diff'] = max(((a[1] - b[1]).abs().max().item() for a, b in zip(whole, accumulated)), default=None)
+    return result
+
+
+def build_adain(device, batchsize):
+    from AdaIN.models import vgg
+    from AdaIN.models.net import Net
+    cfg = Config.from_file(CONFIGS['adain'])
+    VGG = torch.nn.Sequential(*list(vgg.VGG.children())[:31])
+    model = Net(VGG).to(device)
+    model.train()
+    opt = Adam(model.decoder.parameters(), lr=cfg.train.parameters.lr, betas=(0.5, 0.999))
+    return {'model': model, 'opt': opt, 'cfg': cfg, 'gen': model.decoder,
+            'resolution': cfg.train.target_size,
+            'batchsize': batchsize if batchsize is not None else cfg.train.batchsize,
+            'memory_format': torch.preserve_format}
+
+
+def adain_iteration(m, data, timer, device):
+    cfg = m['cfg']
+    with timer('data'):
+        content_images = next(data)[0].to(device, memory_format=m['memory_format'])
+        style_images = next(data)[0].to(device, memory_format=m['memory_format'])
+    with timer('g_step'):
+        loss_c, loss_s = m['model'](content_images, style_images)
+        loss = cfg.train.parameters.lam_c * loss_c + cfg.train.parameters.lam_s * loss_s
+        m['opt'].zero_grad()
+        loss.backward()
+        m['opt'].step()
+
+
+def compile_forwards(m, args):
+    options = {'mode': args.compile_mode} if args.compile_mode is not None else {}
+    if 'model' in m:
+        m['model'] = torch.compile(m['model'], **options)
+    else:
+        m['gen_fn'] = torch.compile(m['gen_fn'], **options)
+        m['dis_fn'] = torch.compile(m['dis_fn'], **options)
+
+
+def run_family(family, args, compiled=False, checkpoint=False, channels_last=False):
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(f'cuda:{args.gpu}') if args.gpu >= 0 and torch.cuda.is_available() else torch.device('cpu')
+
+    if family == 'adain':
+        m = build_adain(device, args.batchsize)
+        iteration = adain_iteration
+        n_params = {'decoder': sum(p.numel() for p in m['model'].decoder.parameters())}
+    else:
+        m = build_gan(family, device, args.batchsize)
+        if family.startswith('pggan') and args.pggan_phase == 'fade_in':
+            m['cur_level'] = m['cur_level'] - 0.5
+        m['fused_g_forward'] = args.fused_g_forward
+        m['accumulation'] = GradientAccumulation(args.accumulation_steps)
+        m['accumulation'].adjust_batchnorm(m['gen'], m['dis'])
+        iteration = gan_iteration
+        if checkpoint and hasattr(m['gen'], 'checkpoint_blocks'):
+            setting = args.checkpoint_resolution if args.checkpoint_resolution is not None else True
+            m['checkpointed_blocks'] = {'gen': set_checkpoint(m['gen'], setting), 'dis': set_checkpoint(m['dis'], setting)}
+        n_params = {'gen': sum(p.numel() for p in m['gen'].parameters()),
+                    'dis': sum(p.numel() for p in m['dis'].parameters())}
+    accumulation_check = check_accumulation(m, device, args.seed) if args.check_accumulation and 'dis' in m else None
+    data = synthetic_data(m['batchsize'], m['resolution'], m.get('n_classes', 0))
+    conversions = None
+    if channels_last:
+        models = {'model': m['model']} if 'model' in m else {'gen': m['gen'], 'dis': m['dis']}
+        for model in models.values():
+            model.to(memory_format=torch.channels_last)
+        m['memory_format'] = torch.channels_last
+        # one untimed iteration that lists the layers handing on NCHW tensors
+        conversions = find_conversions(models, lambda: iteration(m, data, SectionTimer(), device))
+    if compiled:
+        compile_forwards(m, args)
+
+    # with compile on, the warmup includes tracing and code generation
+    timer = SectionTimer(sync=device.type == 'cuda')
+    start = time.perf_counter()
+    for _ in range(args.warmup):
+        iteration(m, data, timer, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    warmup_s = time.perf_counter() - start
+    timer.reset()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        iteration(m, data, timer, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    time_split = {}
+    for name in SECTIONS:
+        total = timer.totals.get(name, 0.)
+        time_split[name] = {'ms_per_it': total / args.steps * 1e3, 'fraction': total / elapsed}
+    result = {'family': family,
+              'device': str(device),
+              'resolution': m['resolution'],
+              'batchsize': m['batchsize'],
+              'n_dis': m.get('n_dis', 0),
+              'accumulation_steps': m['accumulation'].steps if 'accumulation' in m else 1,
+              'steps': args.steps,
+              'compiled': compiled,
+              'activation_checkpoint': checkpoint,
+              'checkpointed_blocks': m.get('checkpointed_blocks'),
+              'channels_last': channels_last,
+              'layout_conversions': conversions,
+              'warmup_s': warmup_s,
+              'params': n_params,
+              'it_per_s': args.steps / elapsed,
+              'images_per_s': args.steps * m['batchsize'] / elapsed,
+              'time_split': time_split,
+              'peak_rss_mb': peak_rss_mb(),
+              'cuda_peak_mb': torch.cuda.max_memory_allocated(device) / 1024. ** 2 if device.type == 'cuda' else None,
+             }
+    if family.startswith('pggan'):
+        result['cur_level'] = m['cur_level']
+    if accumulation_check is not None:
+        result['accumulation_check'] = accumulation_check
+    return result
+
+
+def _run_family_worker(family, args, variant, queue):
+    try:
+        queue.put(run_family(family, args, **variant))
+    except Exception as e:
+        queue.put({'family': family, 'error': repr(e)})
+
+
+def main():
+    args = parse_args()
+
+    # every combination of the on/off/compare switches
+    options = {'compiled': args.compile, 'checkpoint': args.activation_checkpoint, 'channels_last': args.channels_last}
+    modes = [{'off': [False], 'on': [True], 'compare': [False, True]}[options[name]] for name in options]
+    labels = {'compiled': 'compiled', 'checkpoint': 'checkpointed', 'channels_last': 'channels-last'}
+    results = []
+    for family in args.families:
+        runs = {}
+        for key in itertools.product(*modes):
+            variant = dict(zip(options, key))
+            print(f'# {family}' + ''.join(f' ({labels[name]})' for name in options if variant[name]), file=sys.stderr)
+            if args.no_isolate:
+                runs[key] = run_family(family, args, **variant)
+            else:
+                # one fresh process per run so that peak memory is not inherited
+                ctx = mp.get_context('spawn')
+                queue = ctx.Queue()
+                p = ctx.Process(target=_run_family_worker, args=(family, args, variant, queue))
+                p.start()
+                runs[key] = queue.get()
+                p.join()
+        for i, name in enumerate(options):
+            # each run against the one that differs from it only in this switch
+            for key in runs:
+                base_key = key[:i] + (False,) + key[i+1:]
+                if not key[i] or base_key not in runs or 'error' in runs[key] or 'error' in runs[base_key]:
+                    continue
+                base, r = runs[base_key], runs[key]
+                if name == 'compiled':
+                    r['compile_speedup'] = r['it_per_s'] / base['it_per_s']
+                elif name == 'channels_last':
+                    r['channels_last_speedup'] = r['it_per_s'] / base['it_per_s']
+                else:
+                    # the time-versus-memory trade-off of recomputing the activations
+                    memory = 'cuda_peak_mb' if r['cuda_peak_mb'] is not None else 'peak_rss_mb'
+                    r['checkpoint_slowdown'] = base['it_per_s'] / r['it_per_s']
+                    r['checkpoint_saved_mb'] = base[memory] - r[memory]
+                    r['checkpoint_saved_fraction'] = r['checkpoint_saved_mb'] / base[memory]
+        results += list(runs.values())
+
+    write_results({'benchmark': 'train', 'env': environment_info(), 'args': vars(args), 'results': results}, args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import glob
+import random
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import cv2
+import torch
+from easydict import EasyDict as edict
+
+# absolute: the runs chdir into a scratch directory (the engine logs to ./logs)
+sys.path.append(os.path.abspath(os.pardir))
+sys.path.append(os.path.abspath(os.path.join(os.pardir, 'progressive')))
+from common.utils.config import Config
+from common.utils.distributed import Distributed
+from pggan import PGGAN
+from dataset.dataset import FaceDataset
+from utils.randomnoisegenerator import RandomNoiseGenerator
+# progressive.models.model holds no model classes in this tree; old_model is the live pair
+from models import old_model
+
+VARIANTS = ['plain', 'features']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='PGGAN engine smoke check on CPU: PGGAN.train from 4x4 through the fade-in to 8x8, '
+                                                 'then resumed from a checkpoint of the fade-in, which has to end with the same weights')
+    parser.add_argument('--variants', type=str, nargs='+', default=VARIANTS, choices=VARIANTS,
+                        help='the plain engine, and with gradient accumulation, the EMA generator, frozen lower levels, '
+                             'GDrop noise (with its own generator) and equalized learning rate')
+    parser.add_argument('--target_size', type=int, default=8)
+    parser.add_argument('--images', type=int, default=16, help='random images in the scratch dataset')
+    parser.add_argument('--resume_from', type=str, default='fade_in', help='phase of the checkpoint to resume from (the first one saved)')
+    parser.add_argument('--tolerance', type=float, default=0., help='largest weight difference between the resumed and the uninterrupted run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args()
+    return args
+
+
+def make_cfg(args, variant, root, out):
+    cfg = edict(dict(
+        models=dict(generator=dict(z_dim=32, normalize_z=False, use_batchnorm=False, use_wscale=False, use_pixelnorm=True,
+                                   tanh_at_end=False, activation='leaky_relu'),
+                    discriminator=dict(initial_f_map=128, use_wscale=False, use_gdrop=True, use_layernorm=False,
+                                       add_noise=False, sigmoid_at_end=False)),
+        train=dict(dataset=os.path.join(root, 'data'), out=out, target_size=args.target_size, loss_type='wgan-gp',
+                   save_interval=2, print_interval=1000, preview_interval=1000,
+                   rampup_kimg=0.1, rampdown_kimg=0.1, total_kimg=1,
+                   stabilizing_kimg=0.024, transition_kimg=0.024,
+                   batch_sizes=[4] * 8, async_checkpoint=False, keep_checkpoints=100,
+                   parameters=dict(g_lr=0.001, d_lr=0.001, beta1=0., beta2=0.99, lambda_gp=10, lambda_d_fake=1.0)),
+    ))
+    if variant == 'features':
+        cfg.models.generator.use_wscale = cfg.models.discriminator.use_wscale = True
+        cfg.models.discriminator.add_noise = True
+        cfg.train.gdrop_seed = args.seed
+        cfg.train.accumulation_steps = [2] * 8
+        cfg.train.ema = dict(decay=0.9)
+        # the 4x4 blocks train every other step once the 8x8 level is reached
+        cfg.train.freeze_levels = dict(margin=1, every=2, min_resolution=8)
+    return Config(cfg)
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def run(cfg, seed, resume=None):
+    """Train with the engine from scratch (or from `resume`); returns it once done."""
+    seed_all(seed)
+    G = old_model.Generator(model_cfg=cfg.models.generator, target_size=cfg.train.target_size)
+    D = old_model.Discriminator(model_cfg=cfg.models.discriminator, target_size=cfg.train.target_size)
+    z_generator = RandomNoiseGenerator(cfg.models.generator.z_dim, 'gaussian')
+    pggan = PGGAN(G, D, FaceDataset(cfg.train.dataset), z_generator, -1, cfg, resume, dist=Distributed(-1))
+    pggan.train()
+    return pggan
+
+
+def max_diff(a, b):
+    return max(((a[k].double() - b[k].double()).abs().max().item() for k in a if a[k].is_floating_point()), default=0.)
+
+
+def main():
+    args = parse_args()
+    root = tempfile.mkdtemp(prefix='check_pggan_')
+    os.chdir(root)
+    os.makedirs('data')
+    generator = np.random.RandomState(args.seed)
+    for i in range(args.images):
+        cv2.imwrite(os.path.join('data', f'{i:03d}.png'), generator.randint(0, 256, (4 * args.target_size,) * 2 + (3,), dtype=np.uint8))
+
+    failed = []
+    for variant in args.variants:
+        print(f'# {variant}: uninterrupted run', file=sys.stderr)
+        full = run(make_cfg(args, variant, root, os.path.join(root, variant, 'full')), args.seed)
+        checkpoints = sorted(glob.glob(os.path.join(root, variant, 'full', 'checkpoint', f'*-{args.resume_from}-*.pth')))
+        assert checkpoints, f'no {args.resume_from} checkpoint was saved'
+
+        # other seeds: everything the resumed run draws has to come from the checkpoint
+        print(f'# {variant}: resumed from {os.path.basename(checkpoints[0])}', file=sys.stderr)
+        resumed = run(make_cfg(args, variant, root, os.path.join(root, variant, 'resumed')), args.seed + 1, resume=checkpoints[0])
+
+        diffs = {'G': max_diff(full.G.state_dict(), resumed.G.state_dict()),
+                 'D': max_diff(full.D.state_dict(), resumed.D.state_dict())}
+        if full.ema is not None:
+            diffs['G_ema'] = max_diff(full.ema.state_dict(), resumed.ema.state_dict())
+        print(f'{variant}: resumed against uninterrupted, max weight difference: {diffs}')
+        if max(diffs.values()) > args.tolerance:
+            failed.append(variant)
+    if not args.keep:
+        os.chdir(os.sep)
+        shutil.rmtree(root)
+    if failed:
+        sys.exit(f'the resumed runs do not reproduce the uninterrupted ones: {failed}')
+
+if __name__ == '__main__':
+    main()
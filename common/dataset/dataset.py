@@ -6,6 +6,7 @@ import cv2
 import torch
 from torch.utils.data import Dataset
 import common.utils.transforms as tf
+from common.dataset.tag_index import TagListIndex
 
 class FaceDataset(Dataset):
 
@@ -85,19 +86,13 @@ class MultiClassFaceDataset(Dataset):
 
         if not isinstance(root_path_list, list) and os.path.isfile(root_path_list):
         ## danbooru face dataset
-            with open(root_path_list, 'r') as f:
-                line = f.readline().strip()
-                self.tag_list = line.split(',')
-                n_classes = len(self.tag_list)
-                self.image_path_list = [[] for t in range(n_classes)]
-                self.classes = [t for t in range(n_classes)]
-                self.len_list = [0 for t in range(n_classes)]
-                line = f.readline().strip()
-                while(line):
-                    image_path, cls = line.split(' ')
-                    self.image_path_list[int(cls)].append(image_path)
-                    self.len_list[int(cls)] += 1
-                    line = f.readline().strip()
+            use_cache = cfg.train.dataset_index_cache if hasattr(cfg.train, 'dataset_index_cache') else True
+            self.index = TagListIndex(root_path_list, cache=use_cache)
+            self.tag_list = self.index.tag_list
+            n_classes = len(self.tag_list)
+            self.image_path_list = [self.index.class_paths(t) for t in range(n_classes)]
+            self.classes = [t for t in range(n_classes)]
+            self.len_list = [int(n) for n in self.index.len_list]
         ## million face dataset
         else:
             self.image_path_list, self.classes, self.len_list = [],[],[]
@@ -0,0 +1,193 @@
+import os
+import json
+import shutil
+import tempfile
+from array import array
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+
+class ClassPaths(object):
+    """Read-only sequence of the image paths of one class, backed by the index arrays."""
+
+    def __init__(self, index, cls):
+        self.index = index
+        self.cls = cls
+
+    def __len__(self):
+        return int(self.index.len_list[self.cls])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'index {idx} out of range for class {self.cls}')
+        return self.index.path(self.index.class_start[self.cls] + idx)
+
+
+class TagListIndex(object):
+    """Array-backed index of a danbooru tag-list file.
+
+    The list file has the comma separated tag names on its first line followed
+    by one `image_path class` entry per line. It is parsed in a single streaming
+    pass into flat NumPy arrays (a byte blob of all paths with their offsets, the
+    class of every entry and the per-class sizes). The arrays are cached next to
+    the list file in `<list_file>.index/` and memory-mapped on load, so DataLoader
+    workers share the pages instead of holding millions of Python strings.
+    """
+
+    def __init__(self, list_file, cache=True, mmap=True):
+        self.list_file = list_file
+        self.cache = cache
+        self.mmap = mmap
+        self._load()
+
+    @property
+    def cache_dir(self):
+        return self.list_file + '.index'
+
+    def __len__(self):
+        return len(self.classes)
+
+    def path(self, i):
+        """Path of the i-th entry in class order."""
+        i = self.order[i]
+        return bytes(self.paths[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def class_paths(self, cls):
+        return ClassPaths(self, cls)
+
+    def _source_stat(self):
+        st = os.stat(self.list_file)
+        return {'version': INDEX_VERSION, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def _load(self):
+        arrays = None
+        if self.cache:
+            arrays = self._read_cache()
+        if arrays is None:
+            arrays = parse_tag_list(self.list_file)
+            if self.cache:
+                self._write_cache(arrays)
+                cached = self._read_cache()
+                arrays = cached if cached is not None else arrays
+        self.tag_list = arrays['tag_list']
+        self.paths = arrays['paths']
+        self.offsets = arrays['offsets']
+        self.classes = arrays['classes']
+        self.order = arrays['order']
+        self.class_start = arrays['class_start']
+        self.len_list = arrays['len_list']
+
+    def _read_cache(self):
+        meta_file = os.path.join(self.cache_dir, 'meta.json')
+        if not os.path.isfile(meta_file):
+            return None
+        try:
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+            if meta['source'] != self._source_stat():
+                return None
+            mmap_mode = 'r' if self.mmap else None
+            arrays = {name: np.load(os.path.join(self.cache_dir, name + '.npy'), mmap_mode=mmap_mode)
+                      for name in _ARRAY_NAMES}
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        arrays['tag_list'] = meta['tag_list']
+        return arrays
+
+    def _write_cache(self, arrays):
+        # Several processes (DataLoader workers, torchrun ranks) may build the index at
+        # once. Each writes a directory of its own and publishes it with one rename, and
+        # an outdated index is moved aside with one rename before that: a reader sees a
+        # whole index or none, never one being written or removed.
+        parent = os.path.dirname(os.path.abspath(self.list_file))
+        try:
+            tmp_dir = tempfile.mkdtemp(prefix='.index-', dir=parent)
+        except (IOError, OSError):
+            print(f'=> cannot write tag-list index next to {self.list_file}, keeping it in memory')
+            return
+        stale_dir = None
+        try:
+            for name in _ARRAY_NAMES:
+                np.save(os.path.join(tmp_dir, name + '.npy'), arrays[name])
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump({'source': self._source_stat(), 'tag_list': arrays['tag_list']}, f)
+            if os.path.exists(self.cache_dir):
+                if self._read_cache() is not None:
+                    # another process published an up-to-date index meanwhile
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return
+                stale_dir = tempfile.mkdtemp(prefix='.index-stale-', dir=parent)
+                try:
+                    os.rename(self.cache_dir, os.path.join(stale_dir, 'index'))
+                except (IOError, OSError):
+                    # moved aside by another process first
+                    pass
+            os.rename(tmp_dir, self.cache_dir)
+        except (IOError, OSError):
+            # another process may have published the index first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        finally:
+            if stale_dir is not None:
+                shutil.rmtree(stale_dir, ignore_errors=True)
+
+    def __getstate__(self):
+        # memory maps are re-opened in the worker instead of being pickled by value
+        if self.mmap and self.cache and os.path.isdir(self.cache_dir):
+            return {'list_file': self.list_file, 'cache': self.cache, 'mmap': self.mmap}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'paths' not in state:
+            self._load()
+
+
+_ARRAY_NAMES = ['paths', 'offsets', 'classes', 'order', 'class_start', 'len_list']
+
+
+def parse_tag_list(list_file, chunk_bytes=1 << 24):
+    """Stream a danbooru tag-list file into flat arrays.
+
+    Lines are consumed in chunks of about `chunk_bytes`; paths are appended to a
+    single bytearray and offsets/classes to typed arrays, so no per-entry Python
+    object outlives its chunk. As with the original reader, parsing stops at the
+    first empty line.
+    """
+    blob = bytearray()
+    offsets = array('q', [0])
+    classes = array('l')
+    with open(list_file, 'rb') as f:
+        tag_list = f.readline().strip().decode('utf-8').split(',')
+        done = False
+        while not done:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    done = True
+                    break
+                image_path, cls = line.rsplit(b' ', 1)
+                blob += image_path
+                offsets.append(len(blob))
+                classes.append(int(cls))
+
+    n_classes = len(tag_list)
+    classes = np.frombuffer(classes, dtype=np.dtype('l')).astype(np.int32) if len(classes) else np.zeros(0, dtype=np.int32)
+    if len(classes) and (classes.min() < 0 or classes.max() >= n_classes):
+        raise ValueError(f'{list_file} has class ids outside [0, {n_classes})')
+    len_list = np.bincount(classes, minlength=n_classes).astype(np.int64)
+    class_start = np.concatenate([[0], np.cumsum(len_list)]).astype(np.int64)
+    return {'tag_list': tag_list,
+            'paths': np.frombuffer(bytes(blob), dtype=np.uint8),
+            'offsets': np.frombuffer(offsets, dtype=np.int64).copy(),
+            'classes': classes,
+            'order': np.argsort(classes, kind='stable').astype(np.int64),
+            'class_start': class_start,
+            'len_list': len_list,
+           }
@@ -0,0 +1,58 @@
+import torch
+from torch.autograd.function import once_differentiable
+
+from .statistics import batch_stats
+
+
+def cond_batch_norm(input, weight, bias, eps, relu=False):
+    """Batch-statistics BatchNorm of `input` with a per-sample affine, `weight` and
+    `bias` of shape (N, C), and an optional ReLU, in one pass over the input after
+    the statistics: `out = max(input * scale + shift, 0)` with the per-sample,
+    per-channel `scale = weight / std` and `shift = bias - mean * scale`.
+
+    The backward is written out (the BatchNorm gradient with the affine and the
+    ReLU mask folded in), so it keeps only the input and the output instead of
+    every intermediate. Nothing syncs with the host. Returns the output and the
+    batch mean and biased variance per channel, for the running statistics.
+    """
+    return _CondBatchNorm.apply(input, weight, bias, eps, relu)
+
+
+class _CondBatchNorm(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input, weight, bias, eps, relu):
+        mean, var = batch_stats(input)
+        invstd = torch.rsqrt(var + eps)
+        shape = list(weight.shape) + (input.dim() - 2) * [1]
+        scale = weight * invstd
+        shift = bias - mean * scale
+        out = torch.addcmul(shift.reshape(shape), input, scale.reshape(shape))
+        if relu:
+            out = out.clamp_min_(0)
+        ctx.relu = relu
+        ctx.save_for_backward(input, out, weight, mean, invstd)
+        ctx.mark_non_differentiable(mean, var)
+        return out, mean, var
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_out, grad_mean, grad_var):
+        input, out, weight, mean, invstd = ctx.saved_tensors
+        if ctx.relu:
+            grad_out = torch.ops.aten.threshold_backward(grad_out, out, 0)
+        dims = list(range(2, input.dim()))
+        n = input.numel() // input.size(1)
+        # per sample and channel: sum of the gradient, and of the gradient times x_hat
+        grad_bias = grad_out.sum(dims)
+        grad_weight = invstd * ((grad_out * input).sum(dims) - mean * grad_bias)
+        # grad_input = invstd * (weight * g - mean(weight * g) - x_hat * mean(weight * g * x_hat)),
+        # the means over the batch and the pixels of each channel, as a * g + b * input + c
+        mean_g = (weight * grad_bias).sum(0) / n
+        mean_gx = (weight * grad_weight).sum(0) / n
+        a = invstd * weight
+        b = -invstd * invstd * mean_gx
+        c = -invstd * mean_g - b * mean
+        shape = [1, input.size(1)] + len(dims) * [1]
+        grad_input = torch.addcmul(torch.addcmul(c.reshape(shape), input, b.reshape(shape)),
+                                   grad_out, a.reshape(list(a.shape) + len(dims) * [1]))
+        return grad_input, grad_weight, grad_bias, None, None
@@ -0,0 +1,43 @@
+import torch
+
+
+def gdrop_noise(x, mode, strength, axes, normalize=False, generator=None):
+    """The multiplicative noise of a generalized dropout layer for `x`, drawn
+    on x's device (from `generator` if given, else the default torch
+    generator of that device) without a round trip through the host.
+
+    `strength` may be a float or a 0-dim tensor on the device. The noise has
+    x's size along `axes` and 1 elsewhere. Modes: 'drop' (Bernoulli keep
+    mask scaled by 1 / p), 'mul' ((1 + strength) ** N(0, 1)) and 'prop'
+    (N(1, (strength * sqrt(C))^2)).
+    """
+    shape = [s if axis in axes else 1 for axis, s in enumerate(x.size())]
+    if mode == 'drop':
+        p = 1 - strength
+        rnd = (torch.rand(shape, generator=generator, device=x.device, dtype=x.dtype) < p).to(x.dtype) / p
+    elif mode == 'mul':
+        rnd = (1 + strength) ** torch.randn(shape, generator=generator, device=x.device, dtype=x.dtype)
+    else:
+        coef = strength * x.size(1) ** 0.5
+        rnd = torch.randn(shape, generator=generator, device=x.device, dtype=x.dtype) * coef + 1
+    if normalize:
+        rnd = rnd / rnd.norm()
+    return rnd
+
+
+def gdrop_layers(model):
+    """The generalized dropout layers of `model` (modules with a noise `strength` and `generator`)."""
+    return [m for m in model.modules() if hasattr(m, 'strength') and hasattr(m, 'generator')]
+
+
+def seed_gdrop(model, seed, device=None):
+    """Draw the noise of every generalized dropout layer of `model` from one
+    torch generator on `device` (default: that of the model's parameters),
+    seeded with `seed`, instead of the default generator. Returns it."""
+    if device is None:
+        device = next(model.parameters()).device
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    for layer in gdrop_layers(model):
+        layer.generator = generator
+    return generator
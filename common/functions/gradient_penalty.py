@@ -16,7 +16,7 @@ def gradient_penalty(x_real, x_fake, dis, device, y=None):
                                create_graph=True,
                                only_inputs=True)[0]
 
-    grad = grad.view(grad.shape[0], -1)
+    grad = grad.reshape(grad.shape[0], -1)
     grad_norm = torch.sqrt(torch.sum(grad ** 2, dim=1))
     d_loss_gp = torch.mean((grad_norm - 1) ** 2)
 
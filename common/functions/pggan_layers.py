@@ -0,0 +1,62 @@
+import torch
+import torch.nn.functional as F
+
+from .statistics import batch_stats
+
+
+def pixel_norm(x, eps=1e-8):
+    """Pixelwise feature vector normalization, `x / sqrt(mean(x ** 2 over C) + eps)`,
+    as one reduction and one multiply (no division by a broadcast square root)."""
+    if hasattr(F, 'rms_norm') and x.dim() == 4 and not x.is_contiguous() \
+            and x.is_contiguous(memory_format=torch.channels_last):
+        # channels innermost: the native RMSNorm over the last dim is a single fused pass
+        return F.rms_norm(x.movedim(1, -1), (x.size(1),), eps=eps).movedim(-1, 1)
+    return x * torch.rsqrt(x.pow(2).mean(1, keepdim=True) + eps)
+
+
+def wscaled_conv(conv, x, scale, bias=None):
+    """`conv(x)` with its weight times the equalized learning rate `scale` (a
+    0-dim tensor or a number), plus `bias`: the scale goes into the weight when
+    that is the smaller tensor (the high resolution levels), else into the
+    output in the same pass as the bias."""
+    weight = conv.weight
+    if weight.numel() <= x.numel() // x.size(1) * weight.size(0):
+        return conv._conv_forward(x, weight * scale, bias)
+    out = conv._conv_forward(x, weight, None)
+    if bias is None:
+        return out * scale
+    return torch.addcmul(bias.view(1, -1, *(out.dim() - 2) * [1]), out, torch.as_tensor(scale, dtype=out.dtype, device=out.device))
+
+
+def minibatch_stddev(x, eps=1e-8):
+    """`sqrt(var + eps)` of `x` over the minibatch (dim 0), keeping dim 0, from a
+    single statistics pass. Twice differentiable, for the gradient penalty."""
+    return _MinibatchStddev.apply(x, eps)
+
+
+def _columns(x):
+    # an (N, rest) view of x in its memory order, and the dims of `rest`
+    order = sorted(range(1, x.dim()), key=lambda d: -x.stride(d))
+    flat = x.permute(0, *order)
+    if not flat.is_contiguous():
+        flat = flat.contiguous()
+    return flat.reshape(x.size(0), -1), [x.size(d) for d in order], order
+
+
+class _MinibatchStddev(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, eps):
+        # the statistics of the columns of an (N, rest) view are those over the batch
+        flat, sizes, order = _columns(x)
+        _, var = batch_stats(flat)
+        inverse = [order.index(d) + 1 for d in range(1, x.dim())]
+        std = torch.sqrt(var + eps).view(1, *sizes).permute(0, *inverse)
+        ctx.save_for_backward(x, std)
+        return std
+
+    @staticmethod
+    def backward(ctx, grad_std):
+        # d std / d x = (x - mean) / (N * std), in differentiable ops on x and on
+        # std (an output of this function), so a double backward is exact
+        x, std = ctx.saved_tensors
+        return grad_std * (x - x.mean(0, keepdim=True)) / (x.size(0) * std), None
@@ -0,0 +1,32 @@
+import torch
+import torch.nn.functional as F
+
+# Per axis, the taps of a 3x3 kernel (padding 1) that land on each tap of
+# the fused 4x4 kernel. Nearest 2x upsampling: an even output pixel 2i sees
+# x[i-1] once and x[i] twice, an odd one x[i] twice and x[i+1] once, which a
+# stride-2 transposed conv (out[2i + k - 1] += x[i] * w[k]) spreads as
+# w[k] = (w2, w1 + w2, w0 + w1, w0).
+_UPSAMPLE_TAPS = [[0., 0., 1.], [0., 1., 1.], [1., 1., 0.], [1., 0., 0.]]
+# 2x2 average pooling: out[i] is the mean of the conv outputs 2i and 2i + 1,
+# i.e. a stride-2 conv over x[2i - 1 .. 2i + 2] with w = (w0, w0 + w1, w1 + w2, w2) / 2.
+_POOL_TAPS = [[.5, 0., 0.], [.5, .5, 0.], [0., .5, .5], [0., 0., .5]]
+
+
+def upsample_conv2d(x, weight, bias=None):
+    """`F.conv2d(F.interpolate(x, scale_factor=2), weight, bias, padding=1)` for a
+    3x3 `weight`, as one stride-2 transposed conv with a derived 4x4 kernel:
+    16 instead of 36 multiply-adds per input pixel, and the upsampled map is
+    neither computed nor kept for the backward."""
+    taps = weight.new_tensor(_UPSAMPLE_TAPS)
+    # transposed conv weights are (in, out, kh, kw)
+    w = torch.einsum('ph,qw,oihw->iopq', taps, taps, weight)
+    return F.conv_transpose2d(x, w, bias, stride=2, padding=1)
+
+
+def conv2d_avg_pool(x, weight, bias=None):
+    """`F.avg_pool2d(F.conv2d(x, weight, bias, padding=1), 2)` for a 3x3 `weight`,
+    as one stride-2 conv with a derived 4x4 kernel: 4 instead of 9
+    multiply-adds per input pixel, without the full-resolution output."""
+    taps = weight.new_tensor(_POOL_TAPS)
+    w = torch.einsum('ph,qw,oihw->oipq', taps, taps, weight)
+    return F.conv2d(x, w, bias, stride=2, padding=1)
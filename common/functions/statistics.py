@@ -3,7 +3,16 @@ import torch
 def calc_mean_std(x, epsilon=1e-5):
     assert (len(x.size()) == 4)
     N, C = x.size()[:2]
-    x_var = x.view(N, C, -1).var(dim=2) + epsilon
+    x_var = x.reshape(N, C, -1).var(dim=2) + epsilon
     x_std = x_var.sqrt().view(N, C, 1, 1)
-    x_mean = x.view(N, C, -1).mean(dim=2).view(N, C, 1, 1)
+    x_mean = x.reshape(N, C, -1).mean(dim=2).view(N, C, 1, 1)
     return x_mean, x_std
+
+
+def batch_stats(input):
+    """Per-channel mean and biased variance of `input` (N, C, ...) over all other dims."""
+    # native fused statistics pass; the generic reduction is several times slower on the CPU
+    if hasattr(torch, 'batch_norm_update_stats'):
+        return torch.batch_norm_update_stats(input, None, None, 0.)
+    var, mean = torch.var_mean(input, dim=[0] + list(range(2, input.dim())), unbiased=False)
+    return mean, var
@@ -0,0 +1,105 @@
+import contextlib
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+def checkpointed(module, *args):
+    """`module(*args)`, under activation checkpointing when `module.checkpoint` is set.
+
+    While training with grad enabled, the activations inside `module` are not
+    kept for the backward but recomputed from its inputs when the backward
+    reaches it. The non-reentrant checkpoint supports the double backward of
+    the gradient penalty. The recomputation replays the torch RNG, sets the
+    noise layers back as they were (PGGAN's GDrop strength, which the next
+    forward reassigns, and seeded generator) and starts from the module state
+    the original forward saw (BatchNorm statistics, spectral-norm vectors);
+    all of it is put back afterwards, so it computes the same activations and
+    leaves no trace.
+    Forwards traced by torch.compile run the module plainly.
+    """
+    if not getattr(module, 'checkpoint', False) or not module.training or not torch.is_grad_enabled() or _compiling():
+        return module(*args)
+    recompute = _Recompute(module)
+    return checkpoint(module, *args, use_reentrant=False, context_fn=lambda: (contextlib.nullcontext(), recompute))
+
+
+def set_checkpoint(model, setting):
+    """Mark the blocks of `model` (its `checkpoint_blocks()`, (resolution, block)
+    pairs) for checkpointing: all of them for True, those at or above the
+    resolution for a number, none for False/None. Returns the marked count."""
+    count = 0
+    for resolution, block in model.checkpoint_blocks():
+        block.checkpoint = setting is True or (bool(setting) and resolution >= setting)
+        count += block.checkpoint
+    return count
+
+
+def checkpoint_from_cfg(cfg, gen, dis):
+    """Apply the optional `cfg.train.activation_checkpoint`: True, a minimum
+    resolution, or a dict with `generator` and `discriminator` settings."""
+    if not hasattr(cfg.train, 'activation_checkpoint') or not cfg.train.activation_checkpoint:
+        return
+    c = cfg.train.activation_checkpoint
+    if isinstance(c, dict):
+        settings = [c['generator'] if 'generator' in c else None, c['discriminator'] if 'discriminator' in c else None]
+    else:
+        settings = [c, c]
+    for name, model, setting in zip(['generator', 'discriminator'], [gen, dis], settings):
+        print(f'activation checkpointing: {set_checkpoint(model, setting)} {name} blocks')
+
+
+class _Recompute(object):
+    # entered for every recomputation: the gradient penalty's backward and the
+    # loss backward through it may each recompute the same forward
+    def __init__(self, module):
+        self.module = module
+        self.state = _state(module)
+        self.noise = _noise_state(module)
+
+    def __enter__(self):
+        self.current, self.current_noise = _state(self.module), _noise_state(self.module)
+        _load(self.state)
+        _load_noise_state(self.noise)
+
+    def __exit__(self, *exc):
+        _load(self.current)
+        _load_noise_state(self.current_noise)
+        self.current = self.current_noise = None
+
+
+def _state(module):
+    # buffers and frozen parameters, the state a forward may update in place
+    # (not the weights of a frozen progressive-growing level, which none does)
+    tensors = list(module.buffers()) + [p for p in module.parameters()
+                                        if not p.requires_grad and not getattr(p, 'level_frozen', False)]
+    return [(t, t.detach().clone()) for t in tensors]
+
+
+def _load(state):
+    with torch.no_grad():
+        for t, saved in state:
+            t.copy_(saved)
+
+
+def _noise_state(module):
+    # the strengths of the noise layers and the states of their own generators
+    # (the default generators are replayed by the checkpoint itself)
+    layers = [m for m in module.modules() if hasattr(m, 'strength') and hasattr(m, 'generator')]
+    generators = []
+    for m in layers:
+        if isinstance(m.generator, torch.Generator) and all(m.generator is not g for g, _ in generators):
+            generators.append((m.generator, m.generator.get_state()))
+    return [(m, m.strength) for m in layers], generators
+
+
+def _load_noise_state(state):
+    strengths, generators = state
+    for m, strength in strengths:
+        m.strength = strength
+    for g, g_state in generators:
+        g.set_state(g_state)
+
+
+def _compiling():
+    return hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling') and torch.compiler.is_compiling()
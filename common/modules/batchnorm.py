@@ -1,5 +1,8 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+from common.functions.cond_batch_norm import cond_batch_norm
 
 class BatchNorm2d(nn.BatchNorm2d):
     def reset_parameters(self):
@@ -8,6 +11,52 @@ class BatchNorm2d(nn.BatchNorm2d):
             self.weight.data.fill_(1.0)
             self.bias.data.zero_()
 
+def set_fused_norm(model, enabled=True):
+    """Switch the `CategoricalConditionalBatchNorm` layers of `model` to the fused
+    path: the same normalization, class affine and activation up to rounding,
+    computed as one per-sample scale and shift with the ReLU in the same pass
+    (see `common.functions.cond_batch_norm`). Returns the number of layers."""
+    count = 0
+    for module in model.modules():
+        if isinstance(module, CategoricalConditionalBatchNorm):
+            module.fused = enabled
+            count += 1
+    return count
+
+
+def fold_conditional_norms(model, cats=None):
+    """`fold` every `CategoricalConditionalBatchNorm` of `model` (in eval mode) for
+    inference, for all classes or one fixed class `cats`. Returns the count."""
+    model.eval()
+    count = 0
+    for module in model.modules():
+        if isinstance(module, CategoricalConditionalBatchNorm):
+            module.fold(cats)
+            count += 1
+    return count
+
+
+def _reduce_dims(input):
+    return [0] + list(range(2, input.dim()))
+
+
+def _rows(table, cats):
+    # per-sample rows of a (num_cats, C) table, or one row broadcast over the batch
+    # for an int class or an already selected (C,) row
+    if table.dim() == 2:
+        table = table[cats] if isinstance(cats, int) else table.index_select(0, cats)
+    return table
+
+
+def _scale_shift(input, scale, shift, activation):
+    shape = [-1 if scale.dim() == 2 else 1, input.size(1)] + (input.dim() - 2) * [1]
+    out = torch.addcmul(shift.reshape(shape), input, scale.reshape(shape))
+    if activation is F.relu:
+        # the multiply-add's backward needs its inputs, not its output
+        return F.relu(out, inplace=True)
+    return activation(out) if activation is not None else out
+
+
 class CategoricalConditionalBatchNorm(nn.Module):
     # as in the chainer SN-GAN implementation, we keep per-cat weight and bias
     def __init__(self, num_features, num_cats, eps=2e-5, momentum=0.1, affine=True,
@@ -33,6 +82,9 @@ class CategoricalConditionalBatchNorm(nn.Module):
             self.register_parameter('running_mean', None)
             self.register_parameter('running_var', None)
             self.register_parameter('num_batches_tracked', None)
+        # the fused path (`set_fused_norm`) and the eval tables (`fold`)
+        self.fused = False
+        self.tables = None
         self.reset_parameters()
 
     def reset_running_stats(self):
@@ -47,27 +99,91 @@ class CategoricalConditionalBatchNorm(nn.Module):
             self.weight.data.fill_(1.0)
             self.bias.data.zero_()
 
-    def forward(self, input, cats):
-        exponential_average_factor = 0.0
+    def train(self, mode=True):
+        # folded tables hold the running statistics of the moment they were built
+        if mode:
+            self.tables = None
+        return super().train(mode)
 
-        if self.training and self.track_running_stats:
+    def forward(self, input, cats, activation=None):
+        """Normalize `input`, apply the affine of each sample's class in `cats`
+        (a LongTensor, or an int for one class) and then `activation`."""
+        if self.tables is not None and not self.training:
+            scale, shift = self.tables
+            return _scale_shift(input, _rows(scale, cats), _rows(shift, cats), activation)
+        if self.fused:
+            return self._fused_forward(input, cats, activation)
+
+        update = self.training and self.track_running_stats
+        if update:
             self.num_batches_tracked += 1
-            if self.momentum is None:  # use cumulative moving average
-                exponential_average_factor = 1.0 / self.num_batches_tracked.item()
-            else:  # use exponential moving average
-                exponential_average_factor = self.momentum
-
-        out = torch.nn.functional.batch_norm(
-            input, self.running_mean, self.running_var, None, None,
-            self.training or not self.track_running_stats,
-            exponential_average_factor, self.eps)
+        if update and self.momentum is None:
+            # cumulative moving average: the factor is 1 / num_batches_tracked, which stays on the device
+            var, mean = torch.var_mean(input, dim=_reduce_dims(input), unbiased=False)
+            self._update_running_stats(mean, var, input.numel() // input.size(1))
+            out = F.batch_norm(input, None, None, None, None, True, 0., self.eps)
+        else:
+            out = F.batch_norm(
+                input, self.running_mean, self.running_var, None, None,
+                self.training or not self.track_running_stats,
+                self.momentum if update else 0., self.eps)
         if self.affine:
-            shape = [input.size(0), self.num_features] + (input.dim() - 2) * [1]
-            weight = self.weight.index_select(0, cats).view(shape)
-            bias = self.bias.index_select(0, cats).view(shape)
+            shape = [-1 if isinstance(cats, torch.Tensor) else 1, self.num_features] + (input.dim() - 2) * [1]
+            weight = _rows(self.weight, cats).view(shape)
+            bias = _rows(self.bias, cats).view(shape)
             out = out * weight + bias
+        if activation is not None:
+            out = activation(out)
         return out
 
+    def _fused_forward(self, input, cats, activation):
+        # the normalization and the class affine are one scale and shift per
+        # sample and channel, applied in a single pass together with a ReLU
+        if not self.training and self.track_running_stats:
+            invstd = torch.rsqrt(self.running_var + self.eps)
+            weight = _rows(self.weight, cats) if self.affine else 1.
+            bias = _rows(self.bias, cats) if self.affine else 0.
+            return _scale_shift(input, weight * invstd, bias - self.running_mean * weight * invstd, activation)
+        size = (input.size(0), self.num_features)
+        if self.affine:
+            weight, bias = _rows(self.weight, cats).expand(size), _rows(self.bias, cats).expand(size)
+        else:
+            weight, bias = input.new_ones(size), input.new_zeros(size)
+        out, mean, var = cond_batch_norm(input, weight, bias, self.eps, relu=activation is F.relu)
+        if self.training and self.track_running_stats:
+            self.num_batches_tracked += 1
+            self._update_running_stats(mean, var, input.numel() // input.size(1))
+        if activation is not None and activation is not F.relu:
+            out = activation(out)
+        return out
+
+    def _update_running_stats(self, mean, var, n):
+        factor = self.momentum if self.momentum is not None else 1.0 / self.num_batches_tracked
+        with torch.no_grad():
+            self.running_mean.copy_(factor * mean + (1 - factor) * self.running_mean)
+            self.running_var.copy_(factor * var * (n / (n - 1)) + (1 - factor) * self.running_var)
+
+    def fold(self, cats=None):
+        """Precompute the eval-mode (scale, shift) tables, (num_cats, num_features)
+        or the rows of one fixed class `cats`, from the running statistics and
+        the class affine. Until the next `train()` an eval forward is then one
+        multiply-add (+ activation) with no statistics, gathers or rsqrt; with
+        a fixed class it ignores the `cats` it is given. Call it after moving
+        the layer to its device. Returns the tables."""
+        assert self.track_running_stats, 'folding needs running statistics'
+        with torch.no_grad():
+            invstd = torch.rsqrt(self.running_var + self.eps)
+            if self.affine:
+                scale = self.weight * invstd
+                shift = self.bias - self.running_mean * scale
+            else:
+                scale = invstd.expand(self.num_cats, -1)
+                shift = -self.running_mean * scale
+            if cats is not None:
+                scale, shift = scale[cats], shift[cats]
+            self.tables = (scale.clone(), shift.clone())
+        return self.tables
+
     def extra_repr(self):
         return '{num_features}, num_cats={num_cats}, eps={eps}, momentum={momentum}, affine={affine}, ' \
                'track_running_stats={track_running_stats}'.format(**self.__dict__)
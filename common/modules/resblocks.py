@@ -4,6 +4,42 @@ from torch.nn.utils import spectral_norm
 
 from common.modules.spectral_norm import SpectralNorm
 from common.modules.batchnorm import CategoricalConditionalBatchNorm
+from common.functions.resample_conv import upsample_conv2d, conv2d_avg_pool
+
+
+def set_fused_resample(model, enabled=True):
+    """Fold the 2x upsampling/average pooling of the resblocks of `model` into
+    their convolutions (see `common.functions.resample_conv`). The result is
+    the same up to rounding and the parameters do not change, so it can be
+    switched on and off at any time. Returns the number of fused blocks."""
+    count = 0
+    for module in model.modules():
+        if isinstance(module, (ResGenBlock, ResDisBlock, OptimizedBlock)):
+            module.fused = enabled and module.can_fuse()
+            count += module.fused
+    return count
+
+
+def fused_resample_from_cfg(cfg, gen, dis):
+    """Apply the optional `cfg.train.fused_resample` flag to both models."""
+    if not hasattr(cfg.train, 'fused_resample') or not cfg.train.fused_resample:
+        return
+    for name, model in [('generator', gen), ('discriminator', dis)]:
+        print(f'fused resampling: {set_fused_resample(model)} {name} blocks')
+
+
+def _conv_params(conv):
+    # the weight and bias a forward of `conv` would use, spectrally normalized if wrapped
+    if isinstance(conv, SpectralNorm):
+        conv._update_u_v()
+        conv = conv.module
+    return conv.weight, conv.bias
+
+
+def _fusable(conv):
+    conv = conv.module if isinstance(conv, SpectralNorm) else conv
+    return conv.kernel_size == (3, 3) and conv.stride == (1, 1) and conv.padding == (1, 1)
+
 
 class ResGenBlock(nn.Module):
     def __init__(self, in_channels, out_channels, hidden_channels=None, ksize=3, stride=1, pad=1, activation=F.relu, upsample=False, n_classes=0, norm=None):
@@ -13,6 +49,7 @@ class ResGenBlock(nn.Module):
         self.learnable_sc = in_channels != out_channels or upsample
         self.n_classes = n_classes
         self.norm = norm
+        self.fused = False
 
         hidden_channels = out_channels if hidden_channels is None else hidden_channels
 
@@ -41,29 +78,39 @@ class ResGenBlock(nn.Module):
             if norm == 'spectral' or norm == 'spectral+batch':
                 self.conv_sc = SpectralNorm(self.conv_sc)
 
+    def can_fuse(self):
+        return self.upsample and _fusable(self.conv1)
+
     def forward(self, x, y=None):
         assert not (y is None and self.norm=='c_batch') 
         h = x
         if self.norm == 'c_batch':
-            h = self.activation(self.norm1(h, y)) 
+            h = self.norm1(h, y, activation=self.activation)
         elif self.norm == 'batch' or self.norm == 'spectral+batch':
             h = self.activation(self.norm1(h)) 
         else:
             self.activation(h)
-        if self.upsample:
-            h = F.upsample(h, scale_factor=2)
-        h = self.conv1(h)
+        if self.fused:
+            h = upsample_conv2d(h, *_conv_params(self.conv1))
+        else:
+            if self.upsample:
+                h = F.upsample(h, scale_factor=2)
+            h = self.conv1(h)
         if self.norm == 'c_batch':
-            h = self.activation(self.norm2(h, y))
+            h = self.norm2(h, y, activation=self.activation)
         elif self.norm == 'batch' or self.norm == 'spectral+batch':
             h = self.activation(self.norm2(h))
         else:
             self.activation(h)
         h = self.conv2(h)
         if self.learnable_sc:
-            if self.upsample:
-                x = F.upsample(x, scale_factor=2)
-            res = self.conv_sc(x)
+            if self.fused:
+                # a 1x1 conv commutes with nearest upsampling
+                res = F.interpolate(self.conv_sc(x), scale_factor=2)
+            else:
+                if self.upsample:
+                    x = F.upsample(x, scale_factor=2)
+                res = self.conv_sc(x)
         else:
             res = x
         return h + res
@@ -75,6 +122,7 @@ class ResDisBlock(nn.Module):
         self.downsample = downsample
         self.learnable_sc = in_channels != out_channels or downsample
         self.norm = norm
+        self.fused = False
 
         hidden_channels = in_channels if hidden_channels is None else hidden_channels
 
@@ -96,16 +144,25 @@ class ResDisBlock(nn.Module):
             if norm == 'spectral':
                 self.conv_sc = SpectralNorm(self.conv_sc)
 
+    def can_fuse(self):
+        return self.downsample and _fusable(self.conv2)
+
     def forward(self, x):
         use_norm = self.norm != None
         h = x
         h = self.activation(h)
         h = self.conv1(h)
         h = self.activation(h)
-        h = self.conv2(h)
-        if self.downsample:
-            h = F.avg_pool2d(h, 2)
-        if self.learnable_sc:
+        if self.fused:
+            h = conv2d_avg_pool(h, *_conv_params(self.conv2))
+        else:
+            h = self.conv2(h)
+            if self.downsample:
+                h = F.avg_pool2d(h, 2)
+        if self.fused and self.learnable_sc:
+            # a 1x1 conv commutes with average pooling
+            res = self.conv_sc(F.avg_pool2d(x, 2))
+        elif self.learnable_sc:
             res = self.conv_sc(x)
             if self.downsample:
                 res = F.avg_pool2d(res, 2)
@@ -118,6 +175,7 @@ class OptimizedBlock(nn.Module):
         super(OptimizedBlock, self).__init__()
         self.activation = activation
         self.norm = norm
+        self.fused = False
 
         self.conv1 = nn.Conv2d(in_channels, out_channels, ksize, stride, pad)
         nn.init.xavier_uniform_(self.conv1.weight, gain=(2**0.5))
@@ -138,14 +196,21 @@ class OptimizedBlock(nn.Module):
             conv_sc = self.conv_sc
             self.conv_sc = SpectralNorm(conv_sc)
 
+    def can_fuse(self):
+        return _fusable(self.conv2)
+
     def forward(self, x):
         h = x
         h = self.conv1(h)
         h = self.activation(h)
-        h = self.conv2(h)
-        h = F.avg_pool2d(h, 2)
-        res = self.conv_sc(x)
-        res = F.avg_pool2d(res, 2)
+        if self.fused:
+            h = conv2d_avg_pool(h, *_conv_params(self.conv2))
+            res = self.conv_sc(F.avg_pool2d(x, 2))
+        else:
+            h = self.conv2(h)
+            h = F.avg_pool2d(h, 2)
+            res = self.conv_sc(x)
+            res = F.avg_pool2d(res, 2)
         return h + res
 
 
@@ -6,6 +6,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 
 from common.modules.spectral_norm import SpectralNorm
+from common.utils.memory_format import like
 
 class Attension_Layer(nn.Module):
     def __init__(self, in_ch, activation=F.relu, channel_reduce=8, norm=None):
@@ -29,21 +30,22 @@ class Attension_Layer(nn.Module):
         location_num = wi * hi
         downsampled_num = location_num // 4
 
-        theta = self.theta_conv(x).view(bs, ch // 8, location_num).permute(0, 2, 1)
+        # reshape rather than view: the feature maps may be channels-last
+        theta = self.theta_conv(x).reshape(bs, ch // 8, location_num).permute(0, 2, 1)
 
         phi = self.phi_conv(x)
         phi = F.max_pool2d(phi, 2)
-        phi = phi.view(bs, ch // 8, downsampled_num)
+        phi = phi.reshape(bs, ch // 8, downsampled_num)
 
         energy = torch.bmm(theta, phi)
         attn = F.softmax(energy)
 
         g = self.g_conv(x)
         g = F.max_pool2d(g, 2)
-        g = g.view(bs, downsampled_num, ch//2)
+        g = g.reshape(bs, downsampled_num, ch//2)
 
         attn_g = torch.bmm(attn, g)
-        attn_g = attn_g.view(bs, ch // 2, wi, hi)
+        attn_g = like(attn_g.view(bs, ch // 2, wi, hi), x)
         attn_g = self.last_conv(attn_g)
 
         attn_g = self.gamma * attn_g + x
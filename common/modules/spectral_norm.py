@@ -26,12 +26,19 @@ class SpectralNorm(nn.Module):
         w = getattr(self.module, self.name + "_bar")
 
         height = w.data.shape[0]
-        for _ in range(self.power_iterations):
-            v.data = l2normalize(torch.mv(torch.t(w.view(height,-1).data), u.data))
-            u.data = l2normalize(torch.mv(w.view(height,-1).data, v.data))
+        # in-place copies under no_grad rather than rebinding `.data`, which not
+        # every torch.compile release can trace without a graph break per layer
+        with torch.no_grad():
+            for _ in range(self.power_iterations):
+                v.copy_(l2normalize(torch.mv(torch.t(w.reshape(height,-1)), u)))
+                u.copy_(l2normalize(torch.mv(w.reshape(height,-1), v)))
+            # sigma's graph keeps its own u, v: the next forward (e.g. the
+            # gradient penalty's) updates the parameters in place again
+            u, v = u.clone(), v.clone()
 
         # sigma = torch.dot(u.data, torch.mv(w.view(height,-1).data, v.data))
-        sigma = u.dot(w.view(height, -1).mv(v))
+        # reshape: a channels-last conv weight has no (height, -1) view
+        sigma = u.dot(w.reshape(height, -1).mv(v))
         setattr(self.module, self.name, w / sigma.expand_as(w))
 
     def _made_params(self):
@@ -0,0 +1,86 @@
+import contextlib
+
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+
+class GradientAccumulation(object):
+    """Virtual batches: every optimizer step accumulates the gradients of
+    `steps` micro-batches.
+
+    A batch is split into equal micro-batches that are forwarded and
+    backpropagated one after another, so only one micro-batch of activations
+    is alive at a time. Every micro-batch loss (a mean, as all the GAN losses
+    and the gradient penalty are) is divided by `steps`, which makes the
+    accumulated gradient that of the whole batch. Under DDP the all-reduce
+    waits for the last micro-batch.
+
+    BatchNorm layers (and the conditional ones) normalize with micro-batch
+    statistics; their momentum is lowered so that the running statistics
+    move by as much per optimizer step as with the whole batch.
+    """
+
+    def __init__(self, steps=1):
+        assert steps >= 1
+        self.steps = steps
+
+    @staticmethod
+    def from_cfg(cfg):
+        """Build from the optional `cfg.train.accumulation_steps` (1 if absent)."""
+        return GradientAccumulation(cfg.train.accumulation_steps if hasattr(cfg.train, 'accumulation_steps') else 1)
+
+    @property
+    def enabled(self):
+        return self.steps > 1
+
+    def micro_batchsize(self, batchsize):
+        assert batchsize % self.steps == 0, f'batch size {batchsize} does not split into {self.steps} micro-batches'
+        return batchsize // self.steps
+
+    def split(self, *tensors):
+        """Micro-batches of `tensors` (None passes through), one tuple per micro-batch."""
+        batchsize = next(t for t in tensors if t is not None).size(0)
+        micro = self.micro_batchsize(batchsize)
+        chunks = [t.split(micro) if t is not None else [None] * self.steps for t in tensors]
+        return list(zip(*chunks))
+
+    def scale(self, loss):
+        return loss / self.steps if self.enabled else loss
+
+    @contextlib.contextmanager
+    def no_sync(self, k, *modules):
+        """Skip the DDP all-reduce of the `modules` for every micro-batch `k` but the last.
+
+        The forward as well as the backward of the micro-batch have to run inside.
+        """
+        with contextlib.ExitStack() as stack:
+            if k < self.steps - 1:
+                for module in modules:
+                    module = _unwrap(module)
+                    if isinstance(module, DistributedDataParallel):
+                        stack.enter_context(module.no_sync())
+            yield
+
+    def adjust_batchnorm(self, *models):
+        """Per micro-batch momentum 1 - (1 - momentum) ** (1 / steps) for every BatchNorm layer.
+
+        The configured momentum is kept in `base_momentum`, so a later call
+        with other steps (the next PGGAN level) starts from it again.
+        """
+        for model in models:
+            for module in model.modules():
+                if hasattr(module, 'running_mean') and getattr(module, 'momentum', None) is not None:
+                    if not hasattr(module, 'base_momentum'):
+                        if not self.enabled:
+                            continue
+                        module.base_momentum = module.momentum
+                    module.momentum = 1. - (1. - module.base_momentum) ** (1. / self.steps) if self.enabled else module.base_momentum
+
+
+def _unwrap(module):
+    # torch.compile'd modules and compile.LevelCompiled hold the module they run
+    module = getattr(module, '_orig_mod', module)
+    if not isinstance(module, torch.nn.Module):
+        module = getattr(module, 'model', module)
+        module = getattr(module, '_orig_mod', module)
+    return module
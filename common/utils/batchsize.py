@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import hashlib
+
+import torch
+
+from common.functions.gradient_penalty import gradient_penalty
+from common.utils.benchmark import peak_rss_mb
+from common.utils.checkpoint import rng_state, set_rng_state, _write_atomic
+
+
+def device_name(device):
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return device.type
+
+
+def adam_state_mb(*models):
+    """Memory of the two Adam moments of the trainable parameters of `models`."""
+    return sum(2 * p.numel() * p.element_size() for m in models for p in m.parameters() if p.requires_grad) / 1024. ** 2
+
+
+def gan_trial(gen_fn, dis_fn, models, z_dim, resolution, device, n_classes=0, gp=True, levels=None):
+    """One D (+ gradient penalty) and G forward/backward at batch size `bs`, as a
+    `BatchSizeFinder` trial. `gen_fn(z, y)`/`dis_fn(x, y)` call the plain modules
+    (a trial on a DDP module would wait for the other ranks); `resolution` is
+    the image size, or a function of the level for progressive models, which
+    run the trial once per entry of `levels` (passed as `cur_level`)."""
+    def step(bs):
+        for level in (levels if levels is not None else [None]):
+            kwargs = {} if level is None else {'cur_level': level}
+            size = resolution(level) if callable(resolution) else resolution
+            z = torch.randn(bs, z_dim, device=device)
+            y = torch.randint(0, n_classes, (bs,), dtype=torch.long, device=device) if n_classes > 0 else None
+            x_real = torch.rand(bs, 3, size, size, device=device) * 2 - 1
+            x_fake = gen_fn(z, y, **kwargs)
+            d_real = dis_fn(x_real, y, **kwargs)
+            d_loss = torch.mean(dis_fn(x_fake.detach(), y, **kwargs)) - torch.mean(d_real)
+            if gp:
+                d_loss = d_loss + gradient_penalty(x_real, x_fake, lambda x, y=None: dis_fn(x, y, **kwargs), device, y=y)
+            d_loss.backward()
+            del d_loss, d_real
+            g_loss = - torch.mean(dis_fn(x_fake, y, **kwargs))
+            g_loss.backward()
+            del g_loss, x_fake
+            for m in models:
+                m.zero_grad(set_to_none=True)
+    return step
+
+
+class BatchSizeFinder(object):
+    """Largest batch size whose training step fits in a memory budget.
+
+    A trial (`gan_trial`) runs at growing batch sizes, doubling from
+    `min_batchsize` (2, as BatchNorm needs two samples to train) until it
+    exceeds `budget_mb` (or runs out of memory), then bisects between the last size that fit and the first that did not. The
+    peak is what the step allocates on a CUDA device, or the peak resident
+    set size of the process on the CPU (Linux, where the high-water mark can
+    be reset); `reserved_mb` (the optimizer state, which the trial does not
+    allocate) and `margin` of the budget are kept free. Model buffers, the
+    spectral-norm vectors and the RNG are restored after probing, so the
+    trials leave no trace in training.
+
+    Results are cached in a JSON file keyed by the config text, the device
+    name and the budget, so a run on the same machine does not probe again.
+    """
+
+    def __init__(self, device, budget_mb, reserved_mb=0., margin=0.1, min_batchsize=2, max_batchsize=256,
+                 cache=None, key=''):
+        self.device = torch.device(device)
+        self.budget_mb = budget_mb
+        self.reserved_mb = reserved_mb
+        self.margin = margin
+        self.min_batchsize = min_batchsize
+        self.max_batchsize = max_batchsize
+        self.cache = cache
+        self.key = f'{key}/{device_name(self.device)}/{budget_mb}'
+
+    @staticmethod
+    def from_cfg(cfg, device, models=()):
+        """Build from the optional `cfg.train.auto_batchsize` dict (budget_mb, margin,
+        min, max, cache), or return None. The Adam state of `models` is reserved."""
+        if not hasattr(cfg.train, 'auto_batchsize') or not cfg.train.auto_batchsize:
+            return None
+        a = cfg.train.auto_batchsize
+        text = cfg._text if cfg.filename else json.dumps(cfg._config_dict, sort_keys=True, default=str)
+        return BatchSizeFinder(device, a['budget_mb'],
+                               reserved_mb=adam_state_mb(*models),
+                               margin=a['margin'] if 'margin' in a else 0.1,
+                               min_batchsize=a['min'] if 'min' in a else 2,
+                               max_batchsize=a['max'] if 'max' in a else 256,
+                               cache=a['cache'] if 'cache' in a else os.path.join(cfg.train.out, 'batchsize.json'),
+                               key=hashlib.sha1(text.encode('utf-8')).hexdigest()[:16])
+
+    def find(self, trial, models, name='train', dist=None):
+        """Largest safe batch size for `trial` (cached under `name`). Under data
+        parallelism rank 0 probes and the others take its result."""
+        if dist is not None and not dist.is_main:
+            return dist.broadcast_object(None)
+        key = f'{self.key}/{name}'
+        entries = self._read_cache()
+        if key in entries:
+            result = entries[key]['batchsize']
+        else:
+            result, peaks = self.probe(trial, models)
+            entries = self._read_cache()
+            entries[key] = {'batchsize': result, 'peak_mb': peaks, 'reserved_mb': self.reserved_mb,
+                            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+            if self.cache is not None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.cache)), exist_ok=True)
+                _write_atomic(self.cache, lambda f: f.write(json.dumps(entries, indent=1, sort_keys=True).encode('utf-8')))
+        print(f'{name}: batch size {result} fits {self.budget_mb} MB on {device_name(self.device)}')
+        return dist.broadcast_object(result) if dist is not None else result
+
+    def probe(self, trial, models):
+        """(largest fitting batch size, {batch size: peak MB}) of the trial."""
+        limit = self.budget_mb * (1. - self.margin) - self.reserved_mb
+        state = [{k: v.clone() for k, v in m.state_dict(keep_vars=True).items()
+                  if not (isinstance(v, torch.nn.Parameter) and v.requires_grad)} for m in models]
+        rng = rng_state()
+        peaks = {}
+        def fits(bs):
+            peaks[bs] = self.measure(trial, bs)
+            return peaks[bs] is not None and peaks[bs] <= limit
+
+        good, bad = None, None
+        bs = self.min_batchsize
+        while bs <= self.max_batchsize:
+            if not fits(bs):
+                bad = bs
+                break
+            good = bs
+            bs *= 2
+        if good is not None and bad is None and good < self.max_batchsize:
+            if fits(self.max_batchsize):
+                good = self.max_batchsize
+            else:
+                bad = self.max_batchsize
+        while good is not None and bad is not None and bad - good > 1:
+            mid = (good + bad) // 2
+            if fits(mid):
+                good = mid
+            else:
+                bad = mid
+
+        for m, s in zip(models, state):
+            m.load_state_dict(s, strict=False)
+            m.zero_grad(set_to_none=True)
+        set_rng_state(rng)
+        assert good is not None, f'batch size {self.min_batchsize} does not fit {self.budget_mb} MB'
+        return good, {str(k): v for k, v in sorted(peaks.items())}
+
+    def measure(self, trial, bs):
+        """Peak memory in MB of one trial at batch size `bs`, None when out of memory."""
+        cuda = self.device.type == 'cuda'
+        if cuda:
+            torch.cuda.synchronize(self.device)
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            _reset_peak_rss()
+        try:
+            trial(bs)
+        except (RuntimeError, MemoryError) as e:
+            if not is_out_of_memory(e):
+                raise
+            return None
+        finally:
+            if cuda:
+                torch.cuda.synchronize(self.device)
+        if cuda:
+            peak = torch.cuda.max_memory_allocated(self.device) / 1024. ** 2
+            torch.cuda.empty_cache()
+            return peak
+        return peak_rss_mb()
+
+    def _read_cache(self):
+        if self.cache is None or not os.path.exists(self.cache):
+            return {}
+        with open(self.cache, 'r') as f:
+            return json.load(f)
+
+
+def is_out_of_memory(e):
+    """Whether the exception `e` is an allocation failure: CUDA out of memory, the
+    CPU allocator's "can't allocate memory" or a Python MemoryError."""
+    if isinstance(e, MemoryError):
+        return True
+    if hasattr(torch.cuda, 'OutOfMemoryError') and isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and any(m in str(e) for m in ['out of memory', "can't allocate memory"])
+
+
+def _reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets the VmHWM high-water mark
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        raise RuntimeError('peak memory of a CPU trial needs a resettable VmHWM (Linux)')
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import platform
+
+import numpy as np
+import torch
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    return float(np.percentile(np.asarray(values, dtype=np.float64), q))
+
+
+def summarize_latency(latencies):
+    """Summarize a list of per-call latencies given in seconds, reported in ms."""
+    return {'count': len(latencies),
+            'mean_ms': float(np.mean(latencies)) * 1e3 if latencies else None,
+            'p50_ms': percentile(latencies, 50) * 1e3 if latencies else None,
+            'p99_ms': percentile(latencies, 99) * 1e3 if latencies else None,
+           }
+
+
+def rss_mb(pid=None):
+    """Resident set size of a process in MB, read from /proc (None if unavailable)."""
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """High-water mark of the resident set size of this process in MB."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024. if sys.platform != 'darwin' else peak / 1024. ** 2
+    except ImportError:
+        return None
+
+
+def children_pids(pid=None):
+    """Pids of the direct children of a process (e.g. DataLoader workers)."""
+    pid = os.getpid() if pid is None else pid
+    pids = []
+    if not os.path.isdir('/proc'):
+        return pids
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'r') as f:
+                # the command name may contain spaces, so split after the closing paren
+                fields = f.read().rsplit(')', 1)[1].split()
+            if int(fields[1]) == pid:
+                pids.append(int(name))
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    return pids
+
+
+def environment_info():
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'cuda': torch.cuda.is_available(),
+           }
+
+
+def write_results(results, path=None):
+    """Dump benchmark results as JSON to `path`, or to stdout when path is None."""
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if path is None:
+        print(text)
+    else:
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+        print(f'saving results to {path}')
+
+
+class SectionTimer(object):
+    """Accumulates wall time per named section, e.g. `with timer('d_step'): ...`.
+
+    With `sync=True` CUDA work is synchronized at the section boundaries so that
+    asynchronous kernels are attributed to the section that launched them; only
+    benchmarks should pay for that.
+    """
+
+    def __init__(self, sync=False):
+        self.sync = sync and torch.cuda.is_available()
+        self.totals = {}
+        self._name = None
+        self._stack = []
+
+    def __call__(self, name):
+        self._name = name
+        return self
+
+    def __enter__(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        self._stack.append((self._name, time.perf_counter()))
+        return self
+
+    def __exit__(self, *exc):
+        if self.sync:
+            torch.cuda.synchronize()
+        name, start = self._stack.pop()
+        self.totals[name] = self.totals.get(name, 0.) + time.perf_counter() - start
+        return False
+
+    def reset(self):
+        self.totals = {}
@@ -0,0 +1,187 @@
+import os
+import json
+import random
+import threading
+
+import numpy as np
+import torch
+
+INDEX_FILE = 'checkpoints.json'
+LATEST_FILE = 'latest'
+
+
+def snapshot(state):
+    """Copy every tensor of a (nested) state dict to CPU memory."""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def rng_state():
+    """RNG states of random, NumPy, torch and every CUDA device, in a form torch.load accepts."""
+    np_state = np.random.get_state()
+    state = {'python': random.getstate(),
+             'numpy': (np_state[0], torch.from_numpy(np_state[1].astype(np.int64)), np_state[2], np_state[3], np_state[4]),
+             'torch': torch.get_rng_state(),
+            }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def generator_artifact(state_dict, model_cfg, fp16=False, ema_state_dict=None, **meta):
+    """Generator-only inference state with the model config embedded.
+
+    `model_cfg` is the `cfg.models.generator` section. The EMA weights, if any,
+    are stored next to the raw ones; floating point weights are stored as fp16
+    when `fp16` is set and cast back by `load_state_dict`.
+    """
+    def cast(sd):
+        if not fp16:
+            return sd
+        return type(sd)((k, v.half() if v.is_floating_point() else v) for k, v in sd.items())
+
+    state = {'gen_state_dict': cast(state_dict),
+             'model_cfg': json.loads(json.dumps(model_cfg)),
+             'fp16': fp16,
+            }
+    if ema_state_dict is not None:
+        state['gen_ema_state_dict'] = cast(ema_state_dict)
+    state.update(meta)
+    return state
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """torch.load that memory-maps the file where supported, so only the tensors used are read."""
+    try:
+        return torch.load(path, map_location=map_location, mmap=True)
+    except (TypeError, RuntimeError):
+        # older torch, or a file in the legacy (non-zip) format
+        return torch.load(path, map_location=map_location)
+
+
+def _write_atomic(path, write):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager(object):
+    """Writes checkpoints off the training thread and prunes old ones.
+
+    `save(state, name)` snapshots the state dict to CPU on the caller's thread
+    and serializes it on a background thread into `<directory>/<name>` through a
+    temporary file and an atomic rename, so a crash never leaves a truncated
+    checkpoint behind. At most one write is in flight; the next `save` waits for
+    it. After each write the `latest` pointer file is updated and all but the
+    last `keep_last` checkpoints are deleted, except milestones (every
+    `milestone_interval` steps or saved with `milestone=True`). The bookkeeping
+    lives in `checkpoints.json`; files it does not list are never touched.
+    """
+
+    def __init__(self, directory, keep_last=5, milestone_interval=None, async_save=True):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.milestone_interval = milestone_interval
+        self.async_save = async_save
+        self._thread = None
+        self._error = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def from_cfg(cfg, directory):
+        keep_last = cfg.train.keep_checkpoints if hasattr(cfg.train, 'keep_checkpoints') else 5
+        milestone_interval = cfg.train.milestone_interval if hasattr(cfg.train, 'milestone_interval') else None
+        async_save = cfg.train.async_checkpoint if hasattr(cfg.train, 'async_checkpoint') else True
+        return CheckpointManager(directory, keep_last, milestone_interval, async_save)
+
+    def save(self, state, name, step=None, milestone=False):
+        self.wait()
+        if self.milestone_interval and step is not None and step % self.milestone_interval == 0:
+            milestone = True
+        state = snapshot(state)
+        if self.async_save:
+            self._thread = threading.Thread(target=self._write, args=(state, name, step, milestone))
+            self._thread.start()
+        else:
+            self._write(state, name, step, milestone)
+        return os.path.join(self.directory, name)
+
+    def wait(self):
+        """Block until the pending write has finished and re-raise its error."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, state, name, step, milestone):
+        try:
+            _write_atomic(os.path.join(self.directory, name), lambda f: torch.save(state, f))
+            entries = [e for e in self._read_index() if e['name'] != name]
+            entries.append({'name': name, 'step': step, 'milestone': milestone})
+            entries = self._prune(entries)
+            _write_atomic(os.path.join(self.directory, INDEX_FILE), lambda f: f.write(json.dumps(entries, indent=1).encode()))
+            _write_atomic(os.path.join(self.directory, LATEST_FILE), lambda f: f.write(name.encode()))
+        except Exception as e:
+            self._error = e
+
+    def _read_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.isfile(path):
+            return []
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _prune(self, entries):
+        regular = [e for e in entries if not e['milestone']]
+        stale = regular[:-self.keep_last] if self.keep_last else []
+        for e in stale:
+            path = os.path.join(self.directory, e['name'])
+            if os.path.exists(path):
+                os.remove(path)
+        return [e for e in entries if e not in stale]
+
+    def latest(self):
+        """Path of the last completed checkpoint, or None."""
+        path = os.path.join(self.directory, LATEST_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as f:
+            name = f.read().strip()
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def resolve(self, spec, name_format=None):
+        """Map 'latest', a step number (via `name_format`), a file name or a path to a checkpoint path."""
+        if spec is None:
+            return None
+        spec = str(spec)
+        if spec == 'latest':
+            return self.latest()
+        if spec.isdigit() and name_format is not None:
+            spec = name_format.format(int(spec))
+        if os.path.isfile(spec):
+            return spec
+        path = os.path.join(self.directory, spec)
+        return path if os.path.isfile(path) else None
+
+    def close(self):
+        self.wait()
@@ -0,0 +1,89 @@
+import os
+
+import torch
+
+
+def compile_options(cfg, cache_dir=None):
+    """torch.compile arguments from the optional `cfg.train.compile` setting, or None.
+
+    `compile = True` uses the defaults; a dict may set `mode`, `backend`,
+    `dynamic`, `fullgraph` and `cache_dir`. Inductor's FX graph (and, where
+    available, AOT autograd) caches are pointed at `cache_dir` (default
+    `<out>/compile_cache`) so a restarted run reuses the kernels compiled by
+    the previous one instead of compiling them again.
+    """
+    if not hasattr(cfg.train, 'compile') or not cfg.train.compile:
+        return None
+    if not hasattr(torch, 'compile'):
+        print('# torch.compile is not available in this torch version, running eagerly #')
+        return None
+    c = cfg.train.compile if isinstance(cfg.train.compile, dict) else {}
+    options = {k: c[k] for k in ['mode', 'backend', 'dynamic', 'fullgraph'] if k in c}
+    if 'cache_dir' in c:
+        cache_dir = c['cache_dir']
+    elif cache_dir is None:
+        cache_dir = os.path.join(cfg.train.out, 'compile_cache')
+    enable_compile_cache(cache_dir)
+    return options
+
+
+def enable_compile_cache(cache_dir):
+    cache_dir = os.path.abspath(cache_dir)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # inductor resolves its cache directory from the environment on every lookup
+    # (and fills in its /tmp default once imported), so this is set unconditionally
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+    try:
+        from torch._inductor import config as inductor_config
+    except ImportError:
+        return
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, 'autograd_cache'):
+        inductor_config.autograd_cache = True
+
+
+def compile_model(model, options):
+    """`torch.compile(model, **options)`, or `model` itself when `options` is None.
+
+    The compiled module shares parameters, buffers and the state dict keys
+    (under `_orig_mod.`) with `model`, so keep using `model` for optimizers,
+    checkpoints and anything that needs a double backward (the WGAN-GP
+    gradient penalty), which compiled graphs do not support.
+    """
+    if options is None:
+        return model
+    return torch.compile(model, **options)
+
+
+class LevelCompiled(object):
+    """Compiles a PGGAN G or D for the resolution level it is called at.
+
+    `cur_level` is a Python float that selects and blends the output layers,
+    so each value is a different graph. Integer levels (the stabilize phases)
+    are passed to the compiled module as ints, which dynamo guards on, so
+    every level gets its own graph; fade-in levels change every iteration and
+    would recompile each step, so they run eagerly, as do D calls with a
+    GDrop noise strength (a nonzero float or a device tensor).
+    """
+
+    def __init__(self, model, options, max_levels=16):
+        self.model = model
+        self.options = options
+        self.compiled = None
+        if options is not None:
+            from torch._dynamo import config as dynamo_config
+            dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, max_levels)
+
+    def __call__(self, x, cur_level=None, **kwargs):
+        # a device tensor strength is not tested for zero, which would sync with the host
+        strength = kwargs['gdrop_strength'] if 'gdrop_strength' in kwargs else 0.
+        if self.options is None or cur_level is None or not float(cur_level).is_integer() \
+                or torch.is_tensor(strength) or strength:
+            return self.model(x, cur_level=cur_level, **kwargs)
+        if self.compiled is None:
+            self.compiled = torch.compile(self.model, **self.options)
+        return self.compiled(x, cur_level=int(cur_level), **kwargs)
@@ -0,0 +1,130 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+
+class Distributed(object):
+    """Process group of a data-parallel run launched with torchrun.
+
+    torchrun sets WORLD_SIZE, RANK and LOCAL_RANK. Without them (or with a
+    world size of 1) every method is a no-op and `device` is the one picked by
+    `--gpu`, so the trainers run exactly as before. CUDA runs use NCCL with one
+    device per local rank; CPU runs (`--gpu -1` or no CUDA) use gloo, which
+    lets the whole mode run as CPU processes on one machine:
+
+        torchrun --nproc_per_node 2 train_dcgan.py <config> --gpu -1
+
+    `cfg.train.batchsize` stays the per-rank batch size (PGGAN splits its
+    per-level global batch sizes across ranks instead).
+    """
+
+    def __init__(self, gpu=0, backend=None):
+        self.world_size = int(os.environ['WORLD_SIZE']) if 'WORLD_SIZE' in os.environ else 1
+        self.rank = int(os.environ['RANK']) if 'RANK' in os.environ else 0
+        self.local_rank = int(os.environ['LOCAL_RANK']) if 'LOCAL_RANK' in os.environ else 0
+        self.enabled = self.world_size > 1
+        cuda = torch.cuda.is_available() and gpu >= 0
+        if self.enabled:
+            self.device = torch.device(f'cuda:{self.local_rank}') if cuda else torch.device('cpu')
+            if cuda:
+                torch.cuda.set_device(self.device)
+            self.backend = backend or ('nccl' if cuda else 'gloo')
+            dist.init_process_group(self.backend)
+        else:
+            self.device = torch.device(f'cuda:{gpu}') if cuda else torch.device('cpu')
+            self.backend = None
+
+    @property
+    def is_main(self):
+        return self.rank == 0
+
+    def wrap(self, model, find_unused_parameters=False):
+        """DistributedDataParallel around `model` (the module itself when not distributed).
+
+        Buffers are not broadcast on every forward; `sync_states` averages them
+        once per iteration instead. DDP then leaves them out of its initial
+        broadcast of the weights, so rank 0's are broadcast here (the
+        equalized learning rate scales, drawn with each rank's own weights).
+        Models that leave some parameters out of a forward (the inactive
+        levels of a progressive network) need `find_unused_parameters`.
+        """
+        if not self.enabled:
+            return model
+        buffers = list(model.buffers())
+        for dtype in sorted(set(b.dtype for b in buffers), key=str):
+            group = [b for b in buffers if b.dtype == dtype]
+            flat = _flatten_dense_tensors(group)
+            dist.broadcast(flat, 0)
+            with torch.no_grad():
+                for b, synced in zip(group, _unflatten_dense_tensors(flat, group)):
+                    b.copy_(synced)
+        device_ids = [self.device] if self.device.type == 'cuda' else None
+        return DistributedDataParallel(model, device_ids=device_ids, broadcast_buffers=False,
+                                       find_unused_parameters=find_unused_parameters)
+
+    def sampler(self, dataset, shuffle=True, seed=0):
+        """Per-rank shard of `dataset`, or None when not distributed."""
+        if not self.enabled:
+            return None
+        return DistributedSampler(dataset, num_replicas=self.world_size, rank=self.rank,
+                                  shuffle=shuffle, seed=seed, drop_last=True)
+
+    @torch.no_grad()
+    def sync_states(self, *models):
+        """Bring the state that gradients do not synchronize back in step across ranks.
+
+        Floating point buffers (BatchNorm running statistics, which every rank
+        estimates from its own shard) are averaged. Parameters without gradients
+        (the spectral-norm `u`/`v` vectors, updated in place by every forward)
+        and integer buffers are taken from rank 0; frozen levels (`level_frozen`,
+        see LevelFreezing) do not change and are skipped. Tensors are coalesced
+        into one collective per kind and dtype.
+        """
+        if not self.enabled:
+            return
+        averaged, broadcast = [], []
+        for model in models:
+            for b in model.buffers():
+                (averaged if b.is_floating_point() else broadcast).append(b)
+            broadcast += [p for p in model.parameters() if not p.requires_grad and not getattr(p, 'level_frozen', False)]
+        for tensors, average in [(averaged, True), (broadcast, False)]:
+            for dtype in sorted(set(t.dtype for t in tensors), key=str):
+                group = [t for t in tensors if t.dtype == dtype]
+                flat = _flatten_dense_tensors(group)
+                if average:
+                    dist.all_reduce(flat)
+                    flat /= self.world_size
+                else:
+                    dist.broadcast(flat, 0)
+                for t, synced in zip(group, _unflatten_dense_tensors(flat, group)):
+                    t.copy_(synced)
+
+    def average(self, values):
+        """Mean over ranks of a dict of Python floats (e.g. `LossMeter.means()`)."""
+        if not self.enabled or not values:
+            return values
+        names = sorted(values)
+        flat = torch.tensor([values[name] for name in names], dtype=torch.float64,
+                            device=self.device if self.backend == 'nccl' else 'cpu')
+        dist.all_reduce(flat)
+        return dict(zip(names, (flat / self.world_size).tolist()))
+
+    def broadcast_object(self, obj, src=0):
+        """`obj` as held by rank `src` (any picklable object, e.g. a shuffled file list)."""
+        if not self.enabled:
+            return obj
+        objects = [obj]
+        dist.broadcast_object_list(objects, src=src, device=self.device if self.backend == 'nccl' else None)
+        return objects[0]
+
+    def barrier(self):
+        if self.enabled:
+            dist.barrier()
+
+    def close(self):
+        if self.enabled and dist.is_initialized():
+            dist.destroy_process_group()
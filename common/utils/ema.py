@@ -0,0 +1,71 @@
+import copy
+
+import torch
+
+
+class EMA(object):
+    """Exponential moving average of a generator's weights.
+
+    Keeps a frozen copy of `model` (on `device`, e.g. 'cpu' to save accelerator
+    memory) whose trainable parameters follow
+    `ema = decay * ema + (1 - decay) * param` through one multi-tensor
+    (`torch._foreach_*`) update per step. Until `start` steps the copy just
+    tracks the raw weights. Buffers and non-trainable parameters (BatchNorm
+    statistics, the spectral-norm u/v vectors) are copied as they are.
+    """
+
+    def __init__(self, model, decay=0.999, start=0, device=None):
+        self.model = model
+        self.decay = decay
+        self.start = start
+        self.device = device
+        self.shadow = copy.deepcopy(model)
+        if device is not None:
+            self.shadow.to(device)
+        self.shadow.eval()
+        for p in self.shadow.parameters():
+            p.requires_grad_(False)
+        self._pairs()
+
+    @staticmethod
+    def from_cfg(cfg, model):
+        """Build from the optional `cfg.train.ema` dict (decay, start, cpu), or return None."""
+        if not hasattr(cfg.train, 'ema') or not cfg.train.ema:
+            return None
+        e = cfg.train.ema
+        return EMA(model,
+                   decay=e['decay'] if 'decay' in e else 0.999,
+                   start=e['start'] if 'start' in e else 0,
+                   device='cpu' if 'cpu' in e and e['cpu'] else None)
+
+    def _pairs(self):
+        src = dict(self.model.named_parameters())
+        dst = dict(self.shadow.named_parameters())
+        self.trainable = [name for name, p in src.items() if p.requires_grad and p.is_floating_point()]
+        self.ema_params = [dst[name] for name in self.trainable]
+        self.model_params = [src[name] for name in self.trainable]
+        self.copied = [(src[name], dst[name]) for name in src if name not in self.trainable]
+        src_buffers = dict(self.model.named_buffers())
+        self.copied += [(src_buffers[name], b) for name, b in self.shadow.named_buffers()]
+
+    @torch.no_grad()
+    def update(self, step):
+        params = [p.detach() for p in self.model_params]
+        if self.device is not None:
+            params = [p.to(self.device) for p in params]
+        if step < self.start:
+            for dst, src in zip(self.ema_params, params):
+                dst.copy_(src)
+        elif hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(self.ema_params, params, 1. - self.decay)
+        else:
+            torch._foreach_mul_(self.ema_params, self.decay)
+            torch._foreach_add_(self.ema_params, params, alpha=1. - self.decay)
+        for src, dst in self.copied:
+            dst.copy_(src.detach())
+
+    def state_dict(self):
+        return self.shadow.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.shadow.load_state_dict(state_dict)
@@ -0,0 +1,72 @@
+class LevelFreezing(object):
+    """Progressive growing with the stabilized lower levels frozen.
+
+    From the level at `min_resolution` on, the blocks of the generator's and
+    the discriminator's `checkpoint_blocks()` ((resolution, block) pairs)
+    `margin` or more levels below the current resolution stop requiring
+    gradients: the backward skips their weight gradients (G's lowest blocks
+    drop out of it entirely, D still propagates the input gradients through
+    them) and, their gradients being None, the optimizer leaves their
+    weights and moments as they are. With `every` = k > 0 they are trained on
+    every k-th step instead of never. The toRGB/fromRGB layers are left
+    alone: only those of the current levels are used.
+
+    Frozen parameters are marked `level_frozen`, so that the per-step state
+    syncing and the activation checkpointing do not take them for state that
+    a forward updates in place.
+    """
+
+    def __init__(self, margin=2, every=0, min_resolution=128, generator=True, discriminator=True):
+        assert margin >= 1 and every >= 0
+        self.margin = margin
+        self.every = every
+        self.min_resolution = min_resolution
+        self.generator = generator
+        self.discriminator = discriminator
+
+    @staticmethod
+    def from_cfg(cfg):
+        """Build from the optional `cfg.train.freeze_levels` dict (margin, every,
+        min_resolution, generator, discriminator), or return None."""
+        if not hasattr(cfg.train, 'freeze_levels') or not cfg.train.freeze_levels:
+            return None
+        f = cfg.train.freeze_levels
+        return LevelFreezing(margin=f['margin'] if 'margin' in f else 2,
+                             every=f['every'] if 'every' in f else 0,
+                             min_resolution=f['min_resolution'] if 'min_resolution' in f else 128,
+                             generator=f['generator'] if 'generator' in f else True,
+                             discriminator=f['discriminator'] if 'discriminator' in f else True)
+
+    def frozen_resolution(self, resolution):
+        """The resolution at and below which blocks are stabilized at `resolution` (0: none)."""
+        if resolution < self.min_resolution:
+            return 0
+        return resolution // 2 ** self.margin
+
+    def apply(self, gen, dis, resolution, step):
+        """Freeze or thaw the blocks of `gen` and `dis` for a step at `resolution`.
+        Returns the number of frozen blocks."""
+        limit = self.frozen_resolution(resolution)
+        # every k-th step trains them all
+        if self.every > 0 and step % self.every == 0:
+            limit = 0
+        count = 0
+        for model, enabled in [(gen, self.generator), (dis, self.discriminator)]:
+            for r, block in model.checkpoint_blocks():
+                count += set_frozen(block, enabled and r <= limit)
+        return count
+
+
+def set_frozen(block, frozen):
+    """Stop (or resume) training the parameters of `block` that require gradients. Returns `frozen`."""
+    if getattr(block, 'frozen', False) == frozen:
+        return frozen
+    if frozen:
+        block.frozen_params = [p for p in block.parameters() if p.requires_grad]
+    for p in block.frozen_params:
+        p.requires_grad_(not frozen)
+        p.level_frozen = frozen
+        if frozen:
+            p.grad = None
+    block.frozen = frozen
+    return frozen
@@ -0,0 +1,99 @@
+import atexit
+import queue
+import threading
+
+import numpy as np
+import torch
+from tensorboardX import SummaryWriter
+
+
+class Logger(object):
+    """TensorBoard event writer that does its work on a background thread.
+
+    The summary methods only enqueue: tensors are detached on the caller side and
+    histograms are reduced on the tensor's device (`torch.histc` plus the moment
+    sums), so neither a device-to-host copy nor a NumPy histogram runs in the
+    training loop. Tensors with more than `hist_max_elements` values are strided
+    down before the reduction, so histogram statistics describe that subsample.
+    """
+
+    def __init__(self, log_dir, hist_bins=64, hist_max_elements=1 << 16, max_queue=1000):
+        self.writer = SummaryWriter(log_dir)
+        self.hist_bins = hist_bins
+        self.hist_max_elements = hist_max_elements
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        self._closed = False
+        atexit.register(self.close)
+
+    def scalar_summary(self, tag, value, step):
+        """Log a scalar variable (a number or a one-element tensor)."""
+        if torch.is_tensor(value):
+            value = value.detach()
+        self.queue.put(('scalar', tag, value, step))
+
+    def image_summary(self, tag, images, step):
+        """Log a list of HxW or HxWxC images."""
+        for i, img in enumerate(images):
+            if torch.is_tensor(img):
+                img = img.detach()
+            self.queue.put(('image', '%s/%d' % (tag, i), img, step))
+
+    def histo_summary(self, tag, values, step, bins=None):
+        """Log a histogram of the tensor of values."""
+        bins = self.hist_bins if bins is None else bins
+        if not torch.is_tensor(values):
+            values = torch.from_numpy(np.asarray(values))
+        values = values.detach().reshape(-1)
+        if values.numel() == 0:
+            return
+        if values.numel() > self.hist_max_elements:
+            values = values[::(values.numel() + self.hist_max_elements - 1) // self.hist_max_elements]
+        values = values.float()
+        # everything stays on the device until the worker thread reads it back
+        stats = torch.stack([values.min(), values.max(), values.sum(), values.pow(2).sum()])
+        counts = torch.histc(values, bins=bins)
+        self.queue.put(('histo', tag, (stats, counts, values.numel()), step))
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                print(f'=> logger failed to write {item[1]}: {e}')
+            self.queue.task_done()
+
+    def _write(self, kind, tag, value, step):
+        if kind == 'scalar':
+            self.writer.add_scalar(tag, float(value), step)
+        elif kind == 'image':
+            img = value.cpu().numpy() if torch.is_tensor(value) else np.asarray(value)
+            self.writer.add_image(tag, img, step, dataformats='HWC' if img.ndim == 3 else 'HW')
+        elif kind == 'histo':
+            stats, counts, num = value
+            vmin, vmax, vsum, vsum_squares = [float(v) for v in stats.cpu().double().numpy()]
+            counts = counts.cpu().double().numpy()
+            lo, hi = (vmin, vmax) if vmax > vmin else (vmin - 1., vmax + 1.)  # torch.histc widens a degenerate range
+            bucket_limits = np.linspace(lo, hi, len(counts) + 1)[1:]
+            self.writer.add_histogram_raw(tag, min=vmin, max=vmax, num=num,
+                                          sum=vsum, sum_squares=vsum_squares,
+                                          bucket_limits=bucket_limits, bucket_counts=counts,
+                                          global_step=step)
+
+    def flush(self):
+        """Block until every queued summary has been written."""
+        self.queue.join()
+        self.writer.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
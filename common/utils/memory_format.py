@@ -0,0 +1,54 @@
+import torch
+
+
+def memory_format_from_cfg(cfg):
+    """`torch.channels_last` if the optional `cfg.train.channels_last` is set, else `torch.preserve_format`.
+
+    Pass it to `model.to(device, memory_format=...)` once and to `.to(...)`
+    of every input image batch: the convolutions then run on NHWC tensors
+    (oneDNN on the CPU, tensor cores with cuDNN) and hand the layout on to
+    the next layer, so the whole network stays channels-last.
+    """
+    if hasattr(cfg.train, 'channels_last') and cfg.train.channels_last:
+        return torch.channels_last
+    return torch.preserve_format
+
+
+def is_channels_last(x):
+    # tensors with one channel or one pixel are contiguous in both formats
+    return x.dim() == 4 and x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous()
+
+
+def like(out, x):
+    """`out`, made channels-last if `x` is: for the ops (cat with broadcast
+    tensors, bmm results viewed as images) that return NCHW tensors."""
+    if out.dim() == 4 and is_channels_last(x) and not out.is_contiguous(memory_format=torch.channels_last):
+        return out.contiguous(memory_format=torch.channels_last)
+    return out
+
+
+def find_conversions(models, run):
+    """Names of the modules of `models` (a dict of named models) that turned a
+    channels-last input into an NCHW output while `run()` executed (empty
+    when the layout survives the whole network)."""
+    found = []
+    def first_image(values):
+        values = values if isinstance(values, (list, tuple)) else [values]
+        return next((v for v in values if torch.is_tensor(v) and v.dim() == 4), None)
+
+    def hook(name):
+        def check(module, inputs, output):
+            x, out = first_image(inputs), first_image(output)
+            if x is not None and out is not None and is_channels_last(x) \
+                    and not out.is_contiguous(memory_format=torch.channels_last) and name not in found:
+                found.append(name)
+        return check
+
+    handles = [module.register_forward_hook(hook(f'{prefix}.{name}' if name else prefix))
+               for prefix, model in models.items() for name, module in model.named_modules()]
+    try:
+        run()
+    finally:
+        for h in handles:
+            h.remove()
+    return found
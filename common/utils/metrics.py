@@ -0,0 +1,203 @@
+import os
+import csv
+import json
+import time
+
+import numpy as np
+import torch
+
+from common.utils.benchmark import peak_rss_mb
+
+PHASES = ['data', 'd_fwd_bwd', 'gp', 'g_fwd_bwd', 'optim', 'checkpoint', 'preview']
+
+
+class RingBuffer(object):
+    """Fixed-size float buffer keeping the last `size` values."""
+
+    def __init__(self, size):
+        self.data = np.zeros(size, dtype=np.float64)
+        self.size = size
+        self.count = 0
+
+    def push(self, value):
+        self.data[self.count % self.size] = value
+        self.count += 1
+
+    def values(self):
+        return self.data[:min(self.count, self.size)]
+
+    def summary(self):
+        values = self.values()
+        if len(values) == 0:
+            return None
+        return {'mean': float(values.mean()),
+                'p50': float(np.percentile(values, 50)),
+                'p99': float(np.percentile(values, 99)),
+                'max': float(values.max())}
+
+
+class _Phase(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class StepMetrics(object):
+    """Per-phase step timing and throughput for the training loops.
+
+    Wrap each part of an iteration in `with metrics.phase(name):`, call
+    `metrics.step(n_images)` once per iteration and `metrics.flush(iteration)`
+    at the log interval. Phase times are host wall-clock only, so nothing here
+    synchronizes the device: with CUDA, asynchronous kernels are accounted to
+    the phase that waits on them (typically the next loss read or the optimizer
+    step). Per-step values are kept in fixed-size ring buffers and flushed as
+    one JSONL line or CSV row (chosen by the file extension of `path`).
+    """
+
+    def __init__(self, path, window=1000, device=None, enabled=True):
+        self.path = path
+        self.window = window
+        self.device = device
+        self.enabled = enabled and path is not None
+        self.buffers = {name: RingBuffer(window) for name in PHASES + ['step']}
+        self._current = {}
+        self._step_start = None
+        self._last_flush = time.perf_counter()
+        self._images_since_flush = 0
+        self._steps_since_flush = 0
+        self._csv_fields = None
+        if self.enabled:
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NullPhase()
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        self._current[name] = self._current.get(name, 0.) + seconds
+
+    def iterate(self, iterable):
+        """Yield from `iterable`, timing each fetch as the 'data' phase."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase('data'):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self, n_images):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._step_start is not None:
+            self.buffers['step'].push(now - self._step_start)
+        self._step_start = now
+        for name, seconds in self._current.items():
+            if name not in self.buffers:
+                self.buffers[name] = RingBuffer(self.window)
+            self.buffers[name].push(seconds)
+        self._current = {}
+        self._images_since_flush += n_images
+        self._steps_since_flush += 1
+
+    def memory(self):
+        memory = {'peak_rss_mb': peak_rss_mb()}
+        if self.device is not None and torch.device(self.device).type == 'cuda':
+            memory['cuda_peak_mb'] = torch.cuda.max_memory_allocated(self.device) / 1024. ** 2
+        return memory
+
+    def summary(self):
+        now = time.perf_counter()
+        elapsed = now - self._last_flush
+        record = {'time': time.time(),
+                  'steps': self._steps_since_flush,
+                  'images_per_sec': self._images_since_flush / elapsed if elapsed > 0 else None}
+        for name, buffer in self.buffers.items():
+            # empty phases are still reported so that the CSV columns stay fixed
+            stats = buffer.summary() or {}
+            for key in ['mean', 'p50', 'p99', 'max']:
+                record[f'{name}_{key}_ms'] = stats[key] * 1e3 if key in stats else None
+        record.update(self.memory())
+        return record
+
+    def flush(self, iteration, **extra):
+        if not self.enabled or self._steps_since_flush == 0:
+            return None
+        record = {'iteration': iteration}
+        record.update(extra)
+        record.update(self.summary())
+        if self.path.endswith('.csv'):
+            if self._csv_fields is None:
+                self._csv_fields = list(record.keys())
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self._csv_fields, extrasaction='ignore')
+                if f.tell() == 0:
+                    writer.writeheader()
+                writer.writerow(record)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        self._last_flush = time.perf_counter()
+        self._images_since_flush = 0
+        self._steps_since_flush = 0
+        return record
+
+
+class LossMeter(object):
+    """Running means of loss values, accumulated on the device.
+
+    `update(name=loss, ...)` adds the detached losses to per-name running sums
+    without reading them back, so it neither synchronizes the device nor keeps
+    autograd graphs alive. `means()` moves all sums to the host in one batched
+    copy at the log interval and resets them; the returned floats are what the
+    console report, TensorBoard and the metrics file should all show.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def update(self, **losses):
+        for name, value in losses.items():
+            if torch.is_tensor(value):
+                value = value.detach().float().reshape(())
+            else:
+                value = float(value)
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def means(self, reset=True):
+        names = list(self.sums.keys())
+        tensors = [name for name in names if torch.is_tensor(self.sums[name])]
+        values = {name: self.sums[name] for name in names if name not in tensors}
+        if tensors:
+            host = torch.stack([self.sums[name] for name in tensors]).cpu().tolist()
+            values.update(zip(tensors, host))
+        means = {name: values[name] / self.counts[name] for name in names}
+        if reset:
+            self.reset()
+        return means
@@ -0,0 +1,114 @@
+import os
+import signal
+import threading
+
+import torch
+
+
+class ProfilerWindow(object):
+    """On-demand torch.profiler capture windows for a training loop.
+
+    Call `step(iteration)` once per iteration. A window of `steps` iterations is
+    captured when
+      - the iteration reaches `start` (from the config),
+      - the process receives SIGUSR1,
+      - or the sentinel file `<out>/<sentinel>` appears (polled every
+        `poll_interval` iterations and removed once seen).
+    Each window writes a Chrome trace and a per-op summary table to
+    `<out>/profile/`. While no window is active `step` only compares counters,
+    so there is no profiler overhead.
+    """
+
+    def __init__(self, out, start=None, steps=5, sentinel='PROFILE', poll_interval=100, use_signal=True, enabled=True):
+        self.out = out
+        self.start = start
+        self.steps = steps
+        self.sentinel = os.path.join(out, sentinel) if sentinel else None
+        self.poll_interval = max(1, poll_interval)
+        self.enabled = enabled
+        self.profile_dir = os.path.join(out, 'profile')
+        self._requested = None
+        self._prof = None
+        self._remaining = 0
+        self._tag = None
+        self._calls = 0
+        if enabled and use_signal and hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self._on_signal)
+
+    @staticmethod
+    def from_cfg(cfg, out, enabled=True):
+        """Build from the optional `cfg.train.profile` dict (start, steps, sentinel, poll_interval, signal)."""
+        p = cfg.train.profile if hasattr(cfg.train, 'profile') else {}
+        return ProfilerWindow(out,
+                              start=p['start'] if 'start' in p else None,
+                              steps=p['steps'] if 'steps' in p else 5,
+                              sentinel=p['sentinel'] if 'sentinel' in p else 'PROFILE',
+                              poll_interval=p['poll_interval'] if 'poll_interval' in p else 100,
+                              use_signal=p['signal'] if 'signal' in p else True,
+                              enabled=enabled)
+
+    @property
+    def active(self):
+        return self._prof is not None
+
+    def _on_signal(self, signum, frame):
+        self._requested = 'signal'
+
+    def _poll_sentinel(self):
+        if self.sentinel is not None and os.path.exists(self.sentinel):
+            try:
+                os.remove(self.sentinel)
+            except OSError:
+                pass
+            return True
+        return False
+
+    def step(self, iteration, tag=None):
+        if not self.enabled:
+            return
+        self._calls += 1
+        if self._prof is not None:
+            self._prof.step()
+            self._remaining -= 1
+            if self._remaining <= 0:
+                self._stop()
+            return
+
+        trigger = None
+        if self._requested is not None:
+            trigger, self._requested = self._requested, None
+        elif self.start is not None and iteration == self.start:
+            trigger = 'config'
+        elif self._calls % self.poll_interval == 0 and self._poll_sentinel():
+            trigger = 'sentinel'
+        if trigger is not None:
+            self._start(iteration, trigger, tag)
+
+    def _start(self, iteration, trigger, tag):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._prof = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self._prof.start()
+        self._remaining = self.steps
+        self._tag = f'{tag}-' if tag else ''
+        self._tag += f'iter_{iteration:06d}'
+        print(f'=> profiling {self.steps} steps from iteration {iteration} ({trigger})')
+
+    def _stop(self):
+        prof, self._prof = self._prof, None
+        prof.stop()
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        trace_path = os.path.join(self.profile_dir, f'{self._tag}.trace.json')
+        prof.export_chrome_trace(trace_path)
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        with open(os.path.join(self.profile_dir, f'{self._tag}.ops.txt'), 'w') as f:
+            f.write(prof.key_averages().table(sort_by=sort_by, row_limit=100))
+            f.write('\n')
+            f.write(prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=50))
+        print(f'saving profile to {trace_path}')
+
+    def close(self):
+        if self._prof is not None:
+            self._stop()
@@ -108,7 +108,7 @@ class Discriminator64(nn.Module):
         h = self.c1(x)
         h = self.c2(h)
         h = self.c3(h)
-        h = h.view(bs, self.top*4*self.bottom_size*self.bottom_size)
+        h = h.reshape(bs, self.top*4*self.bottom_size*self.bottom_size)
         h = self.l1(h)
         return h
 
@@ -219,6 +219,6 @@ class Discriminator128(nn.Module):
         h = self.c1(x)
         h = self.c2(h)
         h = self.c3(h)
-        h = h.view(bs, self.top*4*self.bottom_size*self.bottom_size)
+        h = h.reshape(bs, self.top*4*self.bottom_size*self.bottom_size)
         h = self.l1(h)
         return h
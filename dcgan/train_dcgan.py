@@ -17,6 +17,15 @@ from common.dataset.dataset import FaceDataset
 from common.utils.config import Config
 from common.utils.poly_lr_scheduler import poly_lr_scheduler
 from common.functions.gradient_penalty import gradient_penalty
+from common.utils.checkpoint import CheckpointManager
+from common.utils.ema import EMA
+from common.utils.compile import compile_options, compile_model
+from common.utils.distributed import Distributed
+from common.utils.accumulation import GradientAccumulation
+from common.utils.batchsize import BatchSizeFinder, gan_trial
+from common.utils.memory_format import memory_format_from_cfg
+from common.utils.metrics import StepMetrics, LossMeter
+from common.utils.profiler import ProfilerWindow
 
 def parse_args():
     parser = argparse.ArgumentParser(description='DCGAN')
@@ -31,43 +40,55 @@ def main():
     global device, cfg
     args = parse_args()
     cfg = Config.from_file(args.config)
+    # one process per device when launched with torchrun; only rank 0 writes files
+    dist = Distributed(args.gpu)
 
     out = cfg.train.out
-    if not os.path.exists(out):
+    if dist.is_main and not os.path.exists(out):
         os.makedirs(out)
 
     loss_type = cfg.train.loss_type
 
     # save config and command
-    commands = sys.argv
-    with open(f'{out}/command.txt', 'w') as f:
-        f.write('## Command ################\n\n')
-        f.write(f'python {commands[0]} ')
-        for command in commands[1:]:
-            f.write(command + ' ')
-        f.write('\n\n\n')
-        f.write('## Args ###################\n\n')
-        for name in vars(args):
-            f.write(f'{name} = {getattr(args, name)}\n')
-
-    shutil.copy(args.config, f'./{out}')
+    if dist.is_main:
+        commands = sys.argv
+        with open(f'{out}/command.txt', 'w') as f:
+            f.write('## Command ################\n\n')
+            f.write(f'python {commands[0]} ')
+            for command in commands[1:]:
+                f.write(command + ' ')
+            f.write('\n\n\n')
+            f.write('## Args ###################\n\n')
+            for name in vars(args):
+                f.write(f'{name} = {getattr(args, name)}\n')
+
+        shutil.copy(args.config, f'./{out}')
 
     # Set device
-    cuda = torch.cuda.is_available()
-    if cuda and args.gpu >= 0:
+    device = dist.device
+    if device.type == 'cuda':
         print('# cuda available! #')
-        device = torch.device(f'cuda:{args.gpu}')
-    else:
-        device = 'cpu'
 
-    gen = getattr(dcgan, cfg.models.generator.name)(z_dim=cfg.models.generator.z_dim, norm=cfg.models.generator.norm).to(device)
-    dis = getattr(dcgan, cfg.models.discriminator.name)(norm=cfg.models.discriminator.norm, use_sigmoid=cfg.models.discriminator.use_sigmoid).to(device)
+    # optional: channels-last (NHWC) models, and batches converted as they arrive
+    memory_format = memory_format_from_cfg(cfg)
+    gen = getattr(dcgan, cfg.models.generator.name)(z_dim=cfg.models.generator.z_dim, norm=cfg.models.generator.norm).to(device, memory_format=memory_format)
+    dis = getattr(dcgan, cfg.models.discriminator.name)(norm=cfg.models.discriminator.norm, use_sigmoid=cfg.models.discriminator.use_sigmoid).to(device, memory_format=memory_format)
+
+    # optional: the largest batch size that fits cfg.train.auto_batchsize['budget_mb'] on this device,
+    # probed for one micro-batch (cached in <out>/batchsize.json per config and device)
+    finder = BatchSizeFinder.from_cfg(cfg, device, [gen, dis])
+    if finder is not None:
+        trial = gan_trial(lambda z, y: gen(z), lambda x, y: dis(x), [gen, dis], cfg.models.generator.z_dim, cfg.train.target_size, device,
+                          n_classes=0, gp=loss_type == 'wgan-gp')
+        cfg.train.batchsize = finder.find(trial, [gen, dis], dist=dist) * GradientAccumulation.from_cfg(cfg).steps
 
     train_dataset = FaceDataset(cfg, cfg.train.dataset)
+    train_sampler = dist.sampler(train_dataset)
     train_loader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=cfg.train.batchsize,
-            shuffle=True,
+            shuffle=train_sampler is None,
+            sampler=train_sampler,
             num_workers=16,
             pin_memory=True,
             drop_last=True)
@@ -75,68 +96,116 @@ def main():
 
     opt_gen = Adam(gen.parameters(), lr=cfg.train.parameters.g_lr, betas=(0.5, 0.999))
     opt_dis = Adam(dis.parameters(), lr=cfg.train.parameters.d_lr, betas=(0.5, 0.999))
+    ema = EMA.from_cfg(cfg, gen) if dist.is_main else None
+    # DDP-wrapped, compiled views of the models for the training forwards; state dicts
+    # and the gradient penalty (a double backward) keep going through the plain modules
+    compile_opts = compile_options(cfg)
+    gen_fwd = compile_model(dist.wrap(gen), compile_opts)
+    dis_fwd = compile_model(dist.wrap(dis), compile_opts)
+    # reuse the D step's fake batch, with its graph, for the G step
+    fused_g_forward = cfg.train.fused_g_forward if hasattr(cfg.train, 'fused_g_forward') else False
+    # virtual batches: cfg.train.batchsize images per step, in accumulation_steps micro-batches
+    accumulation = GradientAccumulation.from_cfg(cfg)
+    accumulation.adjust_batchnorm(gen, dis)
+    if fused_g_forward and accumulation.enabled:
+        # it would keep the G graphs of all micro-batches alive
+        print('fused_g_forward is ignored with accumulation_steps > 1')
+        fused_g_forward = False
 
     if loss_type == 'ls':
         criterion = torch.nn.MSELoss().to(device)
     elif loss_type == 'hinge':
         criterion = torch.nn.ReLU().to(device)
 
+    metrics_file = cfg.train.metrics_file if hasattr(cfg.train, 'metrics_file') else 'metrics.jsonl'
+    metrics_interval = cfg.train.metrics_interval if hasattr(cfg.train, 'metrics_interval') else cfg.train.print_interval
+    metrics = StepMetrics(os.path.join(out, metrics_file), device=device, enabled=dist.is_main)
+    profiler = ProfilerWindow.from_cfg(cfg, out, enabled=dist.is_main)
+    checkpoints = CheckpointManager.from_cfg(cfg, os.path.join(out, 'checkpoint'))
+    losses = LossMeter()
+    loss_means = {}
+
     iteration = 0
     batchsize = cfg.train.batchsize
+    micro_batchsize = accumulation.micro_batchsize(batchsize)
     iterations_per_epoch = len(train_loader)
     epochs = cfg.train.iterations // iterations_per_epoch
     for epoch in range(epochs):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         gen.train()
         dis.train()
 
-        y_real = Variable(torch.ones(batchsize, 1)).to(device)
-        y_fake = Variable(torch.zeros(batchsize, 1)).to(device)
-
-        for i, batch in enumerate(train_loader):
+        y_real = Variable(torch.ones(micro_batchsize, 1)).to(device)
+        y_fake = Variable(torch.zeros(micro_batchsize, 1)).to(device)
 
-            x_real = Variable(batch).to(device)
-            z = Variable(torch.randn((batchsize, cfg.models.generator.z_dim))).to(device)
+        for i, batch in enumerate(metrics.iterate(train_loader)):
 
-            x_fake = gen(z)
-
-            d_fake = dis(x_fake.detach())
-            d_real = dis(x_real)
- 
-            if loss_type == 'ls':
-                d_loss_fake = criterion(d_fake, y_fake)
-                d_loss_real = criterion(d_real, y_real)
-            elif loss_type == 'wgan-gp':
-                d_loss_fake = torch.mean(d_fake)
-                d_loss_real = - torch.mean(d_real)
-            elif loss_type == 'hinge':
-                d_loss_fake = criterion(1.0 + d_fake).mean()
-                d_loss_real = criterion(1.0 - d_real).mean()
-
-            d_loss = d_loss_fake + d_loss_real
-
-            if loss_type == 'wgan-gp':
-               d_loss_gp = gradient_penalty(x_real, x_fake, dis)
-               d_loss += cfg.train.parameters.lambda_gp * d_loss_gp + 0.1 * torch.mean(d_real * d_real)
+            with metrics.phase('data'):
+                x_batch = Variable(batch).to(device, memory_format=memory_format)
 
             opt_gen.zero_grad()
             opt_dis.zero_grad()
-            d_loss.backward()
-            opt_dis.step()
-
-            z = Variable(torch.randn((batchsize, cfg.models.generator.z_dim))).to(device)
-            x_fake = gen(z)
-            d_fake = dis(x_fake)
-            if loss_type == 'ls':
-                g_loss = criterion(d_fake, y_real)
-            elif loss_type == 'wgan-gp':
-                g_loss = - torch.mean(d_fake)
-            elif loss_type == 'hinge':
-                g_loss = - torch.mean(d_fake)
+            for k, (x_real,) in enumerate(accumulation.split(x_batch)):
+                with accumulation.no_sync(k, dis_fwd):
+                    with metrics.phase('d_fwd_bwd'):
+                        z = Variable(torch.randn((micro_batchsize, cfg.models.generator.z_dim))).to(device)
+
+                        if fused_g_forward:
+                            x_fake = gen_fwd(z)
+                        else:
+                            with torch.no_grad():
+                                x_fake = gen_fwd(z)
+
+                        d_fake = dis_fwd(x_fake.detach())
+                        d_real = dis_fwd(x_real)
+ 
+                        if loss_type == 'ls':
+                            d_loss_fake = criterion(d_fake, y_fake)
+                            d_loss_real = criterion(d_real, y_real)
+                        elif loss_type == 'wgan-gp':
+                            d_loss_fake = torch.mean(d_fake)
+                            d_loss_real = - torch.mean(d_real)
+                        elif loss_type == 'hinge':
+                            d_loss_fake = criterion(1.0 + d_fake).mean()
+                            d_loss_real = criterion(1.0 - d_real).mean()
+
+                        d_loss = d_loss_fake + d_loss_real
+
+                    if loss_type == 'wgan-gp':
+                        with metrics.phase('gp'):
+                            d_loss_gp = gradient_penalty(x_real, x_fake, dis, device)
+                            d_loss += cfg.train.parameters.lambda_gp * d_loss_gp + 0.1 * torch.mean(d_real * d_real)
+                            losses.update(dis_gp=d_loss_gp)
+
+                    with metrics.phase('d_fwd_bwd'):
+                        accumulation.scale(d_loss).backward()
+                losses.update(dis=d_loss)
+            with metrics.phase('optim'):
+                opt_dis.step()
 
             opt_gen.zero_grad()
             opt_dis.zero_grad()
-            g_loss.backward()
-            opt_gen.step()
+            for k in range(accumulation.steps):
+                with accumulation.no_sync(k, gen_fwd, dis_fwd), metrics.phase('g_fwd_bwd'):
+                    if not fused_g_forward:
+                        z = Variable(torch.randn((micro_batchsize, cfg.models.generator.z_dim))).to(device)
+                        x_fake = gen_fwd(z)
+                    d_fake = dis_fwd(x_fake)
+                    if loss_type == 'ls':
+                        g_loss = criterion(d_fake, y_real)
+                    elif loss_type == 'wgan-gp':
+                        g_loss = - torch.mean(d_fake)
+                    elif loss_type == 'hinge':
+                        g_loss = - torch.mean(d_fake)
+
+                    accumulation.scale(g_loss).backward()
+                losses.update(gen=g_loss)
+            with metrics.phase('optim'):
+                opt_gen.step()
+                dist.sync_states(gen, dis)
+                if ema is not None:
+                    ema.update(iteration)
 
             g_lr = poly_lr_scheduler(opt_gen, cfg.train.parameters.g_lr, iteration, lr_decay_iter=10, max_iter=cfg.train.iterations)
             d_lr = poly_lr_scheduler(opt_dis, cfg.train.parameters.d_lr, iteration, lr_decay_iter=10, max_iter=cfg.train.iterations)
@@ -144,28 +213,42 @@ def main():
             iteration += 1
 
             if iteration % cfg.train.print_interval == 0:
+                loss_means = dist.average(losses.means())
+            if iteration % cfg.train.print_interval == 0 and dist.is_main:
                 if loss_type == 'wgan-gp':
-                    print(f'Epoch:[{epoch}][{iteration}/{cfg.train.iterations}]  Loss dis:{d_loss:.5f} dis-gp:{d_loss_gp} gen:{g_loss:.5f}')
+                    print(f'Epoch:[{epoch}][{iteration}/{cfg.train.iterations}]  Loss dis:{loss_means["dis"]:.5f} dis-gp:{loss_means["dis_gp"]:.5f} gen:{loss_means["gen"]:.5f}')
                 else:
-                    print(f'Epoch:[{epoch}][{iteration}/{cfg.train.iterations}]  Loss dis:{d_loss:.5f} gen:{g_loss:.5f}')
-
-            if iteration % cfg.train.save_interval == 0: 
-                if not os.path.exists(os.path.join(out, 'checkpoint')):
-                    os.makedirs(os.path.join(out, 'checkpoint'))
-                path = os.path.join(out, 'checkpoint', f'iter_{iteration:04d}.pth.tar')
-                state = {'gen_state_dict':gen.state_dict(),
-                         'dis_state_dict':dis.state_dict(),
-                         'opt_gen_state_dict':opt_gen.state_dict(),
-                         'opt_dis_state_dict':opt_dis.state_dict(),
-                         'iteration':iteration,
-                        }
-                torch.save(state, path)
-
-            if iteration % cfg.train.preview_interval == 0:
-                if not os.path.exists(os.path.join(out, 'preview')):
-                    os.makedirs(os.path.join(out, 'preview'))
-                x_fake = (x_fake[:min(16, batchsize),:,:,:] + 1.0) * 0.5
-                save_image(x_fake.data.cpu(), os.path.join(out, 'preview', f'iter_{iteration:04d}.png'))
+                    print(f'Epoch:[{epoch}][{iteration}/{cfg.train.iterations}]  Loss dis:{loss_means["dis"]:.5f} gen:{loss_means["gen"]:.5f}')
+
+            if iteration % cfg.train.save_interval == 0 and dist.is_main: 
+                with metrics.phase('checkpoint'):
+                    state = {'gen_state_dict':gen.state_dict(),
+                             'dis_state_dict':dis.state_dict(),
+                             'opt_gen_state_dict':opt_gen.state_dict(),
+                             'opt_dis_state_dict':opt_dis.state_dict(),
+                             'iteration':iteration,
+                            }
+                    if ema is not None:
+                        state['gen_ema_state_dict'] = ema.state_dict()
+                    checkpoints.save(state, f'iter_{iteration:04d}.pth.tar', step=iteration)
+
+            if iteration % cfg.train.preview_interval == 0 and dist.is_main:
+                with metrics.phase('preview'):
+                    if not os.path.exists(os.path.join(out, 'preview')):
+                        os.makedirs(os.path.join(out, 'preview'))
+                    x_fake = (x_fake[:min(16, batchsize),:,:,:] + 1.0) * 0.5
+                    save_image(x_fake.data.cpu(), os.path.join(out, 'preview', f'iter_{iteration:04d}.png'))
+
+            metrics.step(batchsize)
+            if iteration % metrics_interval == 0:
+                metrics.flush(iteration, epoch=epoch, **loss_means)
+            profiler.step(iteration)
+
+    # stop and export a capture window still open at the end
+    profiler.close()
+    # the last writes run in the background; close() waits and re-raises a failed one
+    checkpoints.close()
+    dist.close()
 
 
 if __name__ == '__main__':
@@ -5,19 +5,20 @@ import numpy as np
 from PIL import Image
 
 import torch
-from torch.autograd import Variable
 from torchvision.utils import save_image
 
 sys.path.append(os.pardir)
 from common.utils.config import Config
 from utils.randomnoisegenerator import RandomNoiseGenerator
-from models import model, old_model
+from models import old_model
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('config', type=str)
     parser.add_argument('--gen', type=str, required=True)
-    parser.add_argument('--gpu', default=0, type=int, help='gpu to use.')
+    parser.add_argument('--ema', action='store_true', help='use the EMA generator weights')
+    parser.add_argument('--gpu', default=0, type=int, help='gpu to use (-1: cpu).')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads of a cpu run (default: torch\'s choice)')
     parser.add_argument('--noise', choices=['random', 'morphing'], default='random')
     parser.add_argument('--row', type=int, default=5)
     parser.add_argument('--N', type=int, default=1)
@@ -34,17 +35,24 @@ def train():
     # Use sigmoid activation for the last layer?
     cfg.models.discriminator.sigmoid_at_end = cfg.train.loss_type in ['ls', 'gan']
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
-
+    device = torch.device(f'cuda:{args.gpu}') if args.gpu >= 0 and torch.cuda.is_available() else torch.device('cpu')
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
 
     # Load model
     assert os.path.exists(args.gen)
-    G_state = torch.load(args.gen)
+    G_state = torch.load(args.gen, map_location='cpu')
+    if 'G' in G_state:
+        assert not args.ema or 'G_ema' in G_state, f'no EMA weights in {args.gen}'
+        G_state = G_state['G_ema' if args.ema else 'G']
     if 'toRGB.1.0.weight' in G_state.keys():
-        G = model.Generator(model_cfg=cfg.models.generator, target_size=cfg.train.target_size).cuda()
+        # models.model does not import in this tree; only its checkpoints need it
+        from models import model
+        G = model.Generator(model_cfg=cfg.models.generator, target_size=cfg.train.target_size)
     else:
-        G = old_model.Generator(model_cfg=cfg.models.generator, target_size=cfg.train.target_size).cuda()
+        G = old_model.Generator(model_cfg=cfg.models.generator, target_size=cfg.train.target_size)
     G.load_state_dict(G_state)
+    G.to(device)
     print(f'load G from {args.gen}')
 
     # arrange path
@@ -62,14 +70,16 @@ def train():
     z_generator = RandomNoiseGenerator(cfg.models.generator.z_dim, 'gaussian')
 
     ## inference ##
-    for i in range(args.N):
-        out_file = os.path.join(out_dir, gen_name + f'_{args.noise}_{i}')
-        if args.noise == 'random':
-            inference(G, args, cfg, out_file, resol, z_generator)
-        elif args.noise == 'morphing':
-            inference_gif(G, args, cfg, out_file, resol, z_generator)
-
-def inference(G, args, cfg, out_file, resol, z_generator):
+    # no autograd graph and no version counters (no_grad on torch without inference_mode)
+    with getattr(torch, 'inference_mode', torch.no_grad)():
+        for i in range(args.N):
+            out_file = os.path.join(out_dir, gen_name + f'_{args.noise}_{i}')
+            if args.noise == 'random':
+                inference(G, args, cfg, out_file, resol, z_generator, device)
+            elif args.noise == 'morphing':
+                inference_gif(G, args, cfg, out_file, resol, z_generator, device)
+
+def inference(G, args, cfg, out_file, resol, z_generator, device):
     # make noise
     if args.noise == 'random':
         z = z_generator(args.row**2)
@@ -83,7 +93,7 @@ def inference(G, args, cfg, out_file, resol, z_generator):
             alpha = (i // args.row) / args.row
             beta = (i % args.row) / args.row
             z = z0 if i == 0 else np.concatenate((z, (1.0 - alpha) * (1.0 - beta) * z0 + (1.0 - alpha) * beta * z1 + alpha * (1.0 - beta) * z2 + alpha * beta * z3), axis=0)
-    z = Variable(torch.from_numpy(z)).cuda()
+    z = torch.from_numpy(z).to(device)
 
     G.eval()
     cur_level = int(np.log2(resol)) - 1
@@ -92,7 +102,7 @@ def inference(G, args, cfg, out_file, resol, z_generator):
     print(f'saving image to {out_file}.png')
     save_image((fake.data.cpu() + 1.0) * 0.5, out_file+'.png', nrow=args.row, padding=0)
 
-def inference_gif(G, args, cfg, out_file, resol, z_generator, frame_nums=8, fps=20):
+def inference_gif(G, args, cfg, out_file, resol, z_generator, device, frame_nums=8, fps=20):
     G.eval()
     cur_level = int(np.log2(resol)) - 1
 
@@ -105,7 +115,7 @@ def inference_gif(G, args, cfg, out_file, resol, z_generator, frame_nums=8, fps=
         for i in range(fps):
             alpha = i / fps
             z = (1 - alpha) * z0 + alpha * z1
-            z = Variable(torch.from_numpy(z)).cuda()
+            z = torch.from_numpy(z).to(device)
             fake = G(z, cur_level=cur_level)
             fake_image = torch.cat((torch.cat((fake[0,:,:,:], fake[1,:,:,:]), dim=1), torch.cat((fake[2,:,:,:], fake[3,:,:,:]), dim=1)), dim=2).permute(1,2,0)
             fake_image = np.clip((fake_image.data.cpu().numpy() + 1.0) * 0.5 * 255, 0, 255)
@@ -4,13 +4,31 @@ import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 from torch.autograd import Variable
 from torch.nn.parameter import Parameter
 from torch.nn import functional as F
 from torch.nn.init import kaiming_normal_, calculate_gain
+from common.modules.activation_checkpoint import checkpointed
+from common.utils.memory_format import like
+from common.functions.gdrop import gdrop_noise
+from common.functions.pggan_layers import pixel_norm, minibatch_stddev, wscaled_conv
 if sys.version_info.major == 3:
     from functools import reduce
 
+def set_fused_layers(model, enabled=True):
+    """Switch the PixelNorm, equalized learning rate and minibatch stddev layers
+    of `model` between the fused implementations (the default: one reduction
+    for PixelNorm, the wscale folded into the conv, one statistics pass
+    for the stddev) and the original ones. Returns the number of layers."""
+    count = 0
+    for module in model.modules():
+        if isinstance(module, (PixelNormLayer, WScaleLayer, MinibatchStatConcatLayer)):
+            module.fused = enabled
+            count += 1
+    return count
+
+
 class PixelNormLayer(nn.Module):
     """
     Pixelwise feature vector normalization.
@@ -18,9 +36,12 @@ class PixelNormLayer(nn.Module):
     def __init__(self, eps=1e-8):
         super(PixelNormLayer, self).__init__()
         self.eps = eps
+        self.fused = True
     
     def forward(self, x):
-        return x / torch.sqrt(torch.mean(x ** 2, dim=1, keepdim=True) + 1e-8)
+        if self.fused:
+            return pixel_norm(x, self.eps)
+        return x / torch.sqrt(torch.mean(x ** 2, dim=1, keepdim=True) + self.eps)
 
     def __repr__(self):
         return self.__class__.__name__ + '(eps = %s)' % (self.eps)
@@ -28,7 +49,9 @@ class PixelNormLayer(nn.Module):
 
 class WScaleLayer(nn.Module):
     """
-    Applies equalized learning rate to the preceding layer.
+    Applies equalized learning rate to the incoming conv layer, which it runs:
+    the scale multiplies the weight or the output, whichever is smaller, at
+    forward time (see `wscaled_conv`) instead of two more passes over the output.
     """
     def __init__(self, incoming):
         super(WScaleLayer, self).__init__()
@@ -36,13 +59,17 @@ class WScaleLayer(nn.Module):
         scale = (torch.mean(self.incoming.weight.data ** 2)) ** 0.5
         self.incoming.weight.data.copy_(self.incoming.weight.data / scale)
         self.bias = None
-        self.scale = scale.cuda()
+        # a buffer: saved with the weights it belongs to, and moved with the model
+        self.register_buffer('scale', scale.reshape(()))
+        self.fused = True
         if self.incoming.bias is not None:
             self.bias = self.incoming.bias
             self.incoming.bias = None
 
     def forward(self, x):
-        x = self.scale * x
+        if self.fused:
+            return wscaled_conv(self.incoming, x, self.scale, self.bias)
+        x = self.scale * self.incoming(x)
         if self.bias is not None:
             x += self.bias.view(1, self.bias.size()[0], 1, 1)
         return x
@@ -63,44 +90,59 @@ def mean(tensor, axis, **kwargs):
 class MinibatchStatConcatLayer(nn.Module):
     """Minibatch stat concatenation layer.
     - averaging tells how much averaging to use ('all', 'spatial', 'none')
+    - across_ranks computes the statistics over the global minibatch of a
+      data-parallel run (in training mode) instead of over the local one
     """
-    def __init__(self, averaging='all'):
+    def __init__(self, averaging='all', across_ranks=False):
         super(MinibatchStatConcatLayer, self).__init__()
         self.averaging = averaging.lower()
+        self.across_ranks = across_ranks
+        self.fused = True
         if 'group' in self.averaging:
             self.n = int(self.averaging[5:])
         else:
             assert self.averaging in ['all', 'flat', 'spatial', 'none', 'gpool'], 'Invalid averaging mode'%self.averaging
         self.adjusted_std = lambda x, **kwargs: torch.sqrt(torch.mean((x - torch.mean(x, **kwargs)) ** 2, **kwargs) + 1e-8) #Tstdeps in the original implementation
 
+    def minibatch_std(self, x):
+        if not (self.across_ranks and self.training and dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1):
+            return minibatch_stddev(x) if self.fused else self.adjusted_std(x, dim=0, keepdim=True)
+        # every rank holds an equal share of the minibatch; the collectives are differentiable
+        # (twice, for the gradient penalty), so each rank's gradient also sees the other shards
+        from torch.distributed.nn.functional import all_reduce
+        n = x.size(0) * dist.get_world_size()
+        mu = all_reduce(torch.sum(x, dim=0, keepdim=True)) / n
+        var = all_reduce(torch.sum((x - mu) ** 2, dim=0, keepdim=True)) / n
+        return torch.sqrt(var + 1e-8)
+
     def forward(self, x):
         shape = list(x.size())
         target_shape = shape.copy()
-        vals = self.adjusted_std(x, dim=0, keepdim=True)# per activation, over minibatch dim
+        vals = self.minibatch_std(x)# per activation, over minibatch dim
         if self.averaging == 'all':  # average everything --> 1 value per minibatch
             target_shape[1] = 1
             vals = torch.mean(vals, dim=1, keepdim=True)#vals = torch.mean(vals, keepdim=True)
 
         elif self.averaging == 'spatial':  # average spatial locations
             if len(shape) == 4:
-                vals = mean(vals, axis=[2,3], keepdim=True)  # torch.mean(torch.mean(vals, 2, keepdim=True), 3, keepdim=True)
+                vals = torch.mean(vals, dim=[2,3], keepdim=True)
         elif self.averaging == 'none':  # no averaging, pass on all information
             target_shape = [target_shape[0]] + [s for s in target_shape[1:]]
         elif self.averaging == 'gpool':  # EXPERIMENTAL: compute variance (func) over minibatch AND spatial locations.
             if len(shape) == 4:
-                vals = mean(x, [0,2,3], keepdim=True)  # torch.mean(torch.mean(torch.mean(x, 2, keepdim=True), 3, keepdim=True), 0, keepdim=True)
+                vals = torch.mean(x, dim=[0,2,3], keepdim=True)
         elif self.averaging == 'flat':  # variance of ALL activations --> 1 value per minibatch
             target_shape[1] = 1
-            vals = torch.FloatTensor([self.adjusted_std(x)])
+            vals = self.adjusted_std(x).view([1] * len(shape))
         else:  # self.averaging == 'group'  # average everything over n groups of feature maps --> n values per minibatch
             target_shape[1] = self.n
             vals = vals.view(self.n, self.shape[1]/self.n, self.shape[2], self.shape[3])
             vals = mean(vals, axis=0, keepdim=True).view(1, self.n, 1, 1)
         vals = vals.expand(*target_shape)
-        return torch.cat([x, vals], 1) # feature-map concatanation
+        return like(torch.cat([x, vals], 1), x) # feature-map concatanation
 
     def __repr__(self):
-        return self.__class__.__name__ + '(averaging = %s)' % (self.averaging)
+        return self.__class__.__name__ + '(averaging = %s, across_ranks = %s)' % (self.averaging, self.across_ranks)
 
 
 class MinibatchDiscriminationLayer(nn.Module):
@@ -125,27 +167,14 @@ class GDropLayer(nn.Module):
         self.axes = [axes] if isinstance(axes, int) else list(axes)
         self.normalize = normalize
         self.gain = None
+        # None: the default torch generator of the input's device (see common.functions.gdrop.seed_gdrop)
+        self.generator = None
 
     def forward(self, x, deterministic=False):
-        if deterministic or not self.strength:
+        # a tensor strength (set on the device by the trainer) is not tested on the host
+        if deterministic or (not torch.is_tensor(self.strength) and not self.strength):
             return x
-
-        rnd_shape = [s if axis in self.axes else 1 for axis, s in enumerate(x.size())]  # [x.size(axis) for axis in self.axes]
-        if self.mode == 'drop':
-            p = 1 - self.strength
-            rnd = np.random.binomial(1, p=p, size=rnd_shape) / p
-        elif self.mode == 'mul':
-            rnd = (1 + self.strength) ** np.random.normal(size=rnd_shape)
-        else:
-            coef = self.strength * x.size(1) ** 0.5
-            rnd = np.random.normal(size=rnd_shape) * coef + 1
-
-        if self.normalize:
-            rnd = rnd / np.linalg.norm(rnd, keepdims=True)
-        rnd = Variable(torch.from_numpy(rnd).type(x.data.type()))
-        if x.is_cuda:
-            rnd = rnd.cuda()
-        return x * rnd
+        return x * gdrop_noise(x, self.mode, self.strength, self.axes, self.normalize, self.generator)
 
     def __repr__(self):
         param_str = '(mode = %s, strength = %s, axes = %s, normalize = %s)' % (self.mode, self.strength, self.axes, self.normalize)
@@ -186,6 +215,7 @@ def resize_activations(v, so):
     :param v:
     :param so:
     """
+    x = v
     si = list(v.size())
     so = list(so)
     assert len(si) == len(so) and si[0] == so[0]
@@ -206,8 +236,8 @@ def resize_activations(v, so):
 
     # Increase feature maps.
     if si[1] < so[1]:
-        z = torch.zeros((v.shape[0], so[1] - si[1]) + so[2:])
-        v = torch.cat([v, z], 1)
+        z = v.new_zeros([v.shape[0], so[1] - si[1]] + so[2:])
+        v = like(torch.cat([v, z], 1), x)
     return v
 
 
@@ -237,9 +267,9 @@ class GSelectLayer(nn.Module):
         out = {}
         for level in range(_from, _to, _step):
             if level == insert_y_at:
-                x = self.chain[level](x, y)
+                x = checkpointed(self.chain[level], x, y)
             else:
-                x = self.chain[level](x)
+                x = checkpointed(self.chain[level], x)
 
             if level == min_level:
                 out['min_level'] = self.post[level](x)
@@ -278,30 +308,30 @@ class DSelectLayer(nn.Module):
         if max_level == min_level:
             x = self.inputs[max_level](x)
             if max_level == insert_y_at:
-                x = self.chain[max_level](x, y)
+                x = checkpointed(self.chain[max_level], x, y)
             else:
-                x = self.chain[max_level](x)
+                x = checkpointed(self.chain[max_level], x)
         else:
             out = {}
             tmp = self.inputs[max_level](x)
             if max_level == insert_y_at:
-                tmp = self.chain[max_level](tmp, y)
+                tmp = checkpointed(self.chain[max_level], tmp, y)
             else:
-                tmp = self.chain[max_level](tmp)
+                tmp = checkpointed(self.chain[max_level], tmp)
             out['max_level'] = tmp
             out['min_level'] = self.inputs[min_level](x)
             x = resize_activations(out['min_level'], out['max_level'].size()) * min_level_weight + \
                                 out['max_level'] * max_level_weight
             if min_level == insert_y_at:
-                x = self.chain[min_level](x, y)
+                x = checkpointed(self.chain[min_level], x, y)
             else:
-                x = self.chain[min_level](x)
+                x = checkpointed(self.chain[min_level], x)
 
         for level in range(_from, _to, _step):
             if level == insert_y_at:
-                x = self.chain[level](x, y)
+                x = checkpointed(self.chain[level], x, y)
             else:
-                x = self.chain[level](x)
+                x = checkpointed(self.chain[level], x)
         return x
 
 
@@ -323,6 +353,13 @@ class ReshapeLayer(nn.Module):
         return x.view(-1, *self.new_shape)
 
 
+def wscaled_conv2d(in_channels, out_channels, kernel_size, stride=1, padding=0, init='conv2d', param=None):
+    """A He-initialized conv with equalized learning rate (see `WScaleLayer`)."""
+    conv = nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=stride, padding=padding)
+    he_init(conv, init, param)
+    return WScaleLayer(conv)
+
+
 def he_init(layer, nonlinearity='conv2d', param=None):
     nonlinearity = nonlinearity.lower()
     #if nonlinearity not in ['linear', 'conv1d', 'conv2d', 'conv3d', 'relu', 'leaky_relu', 'sigmoid', 'tanh']:
@@ -7,6 +7,8 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.autograd import Variable
 from torch.nn.init import kaiming_normal, calculate_gain
+from common.functions.gdrop import gdrop_noise
+from common.functions.pggan_layers import pixel_norm, minibatch_stddev, wscaled_conv
 
 # same function as ConcatTable container in Torch7.
 class ConcatTable(nn.Module):
@@ -57,25 +59,25 @@ class minibatch_std_concat_layer(nn.Module):
     def forward(self, x):
         shape = list(x.size())
         target_shape = copy.deepcopy(shape)
-        vals = self.adjusted_std(x, dim=0, keepdim=True)
+        vals = minibatch_stddev(x)
         if self.averaging == 'all':
             target_shape[1] = 1
             vals = torch.mean(vals, dim=1, keepdim=True)
         elif self.averaging == 'spatial':
             if len(shape) == 4:
-                vals = mean(vals, axis=[2,3], keepdim=True)             # torch.mean(torch.mean(vals, 2, keepdim=True), 3, keepdim=True)
+                vals = torch.mean(vals, dim=[2,3], keepdim=True)
         elif self.averaging == 'none':
             target_shape = [target_shape[0]] + [s for s in target_shape[1:]]
         elif self.averaging == 'gpool':
             if len(shape) == 4:
-                vals = mean(x, [0,2,3], keepdim=True)                   # torch.mean(torch.mean(torch.mean(x, 2, keepdim=True), 3, keepdim=True), 0, keepdim=True)
+                vals = torch.mean(x, dim=[0,2,3], keepdim=True)
         elif self.averaging == 'flat':
             target_shape[1] = 1
-            vals = torch.FloatTensor([self.adjusted_std(x)])
+            vals = self.adjusted_std(x).view([1] * len(shape))
         else:                                                           # self.averaging == 'group'
             target_shape[1] = self.n
             vals = vals.view(self.n, self.shape[1]/self.n, self.shape[2], self.shape[3])
-            vals = mean(vals, axis=0, keepdim=True).view(1, self.n, 1, 1)
+            vals = torch.mean(vals, dim=0, keepdim=True).view(1, self.n, 1, 1)
         vals = vals.expand(*target_shape)
         return torch.cat([x, vals], 1)
 
@@ -89,10 +91,12 @@ class pixelwise_norm_layer(nn.Module):
         self.eps = 1e-8
 
     def forward(self, x):
-        return x / (torch.mean(x**2, dim=1, keepdim=True) + self.eps) ** 0.5
+        return pixel_norm(x, self.eps)
 
 
-# for equaliaeed-learning rate.
+# for equaliaeed-learning rate. The scale (a buffer, saved with the weights) multiplies the
+# weight (or the conv output, if smaller) at forward time instead of the input, and the
+# bias goes into that pass.
 class equalized_conv2d(nn.Module):
     def __init__(self, c_in, c_out, k_size, stride, pad, initializer='kaiming', bias=False):
         super(equalized_conv2d, self).__init__()
@@ -102,12 +106,11 @@ class equalized_conv2d(nn.Module):
         
         conv_w = self.conv.weight.data.clone()
         self.bias = torch.nn.Parameter(torch.FloatTensor(c_out).fill_(0))
-        self.scale = (torch.mean(self.conv.weight.data ** 2)) ** 0.5
+        self.register_buffer('scale', ((torch.mean(self.conv.weight.data ** 2)) ** 0.5).reshape(()))
         self.conv.weight.data.copy_(self.conv.weight.data/self.scale)
 
     def forward(self, x):
-        x = self.conv(x.mul(self.scale))
-        return x + self.bias.view(1,-1,1,1).expand_as(x)
+        return wscaled_conv(self.conv, x, self.scale, self.bias)
         
  
 class equalized_deconv2d(nn.Module):
@@ -119,11 +122,10 @@ class equalized_deconv2d(nn.Module):
         
         deconv_w = self.deconv.weight.data.clone()
         self.bias = torch.nn.Parameter(torch.FloatTensor(c_out).fill_(0))
-        self.scale = (torch.mean(self.deconv.weight.data ** 2)) ** 0.5
+        self.register_buffer('scale', ((torch.mean(self.deconv.weight.data ** 2)) ** 0.5).reshape(()))
         self.deconv.weight.data.copy_(self.deconv.weight.data/self.scale)
     def forward(self, x):
-        x = self.deconv(x.mul(self.scale))
-        return x + self.bias.view(1,-1,1,1).expand_as(x)
+        return F.conv_transpose2d(x, self.deconv.weight * self.scale, self.bias, self.deconv.stride, self.deconv.padding)
 
 
 class equalized_linear(nn.Module):
@@ -135,12 +137,11 @@ class equalized_linear(nn.Module):
         
         linear_w = self.linear.weight.data.clone()
         self.bias = torch.nn.Parameter(torch.FloatTensor(c_out).fill_(0))
-        self.scale = (torch.mean(self.linear.weight.data ** 2)) ** 0.5
+        self.register_buffer('scale', ((torch.mean(self.linear.weight.data ** 2)) ** 0.5).reshape(()))
         self.linear.weight.data.copy_(self.linear.weight.data/self.scale)
         
     def forward(self, x):
-        x = self.linear(x.mul(self.scale))
-        return x + self.bias.view(1,-1).expand_as(x)
+        return F.linear(x, self.linear.weight * self.scale, self.bias)
 
 
 # ref: https://github.com/github-pengge/PyTorch-progressive_growing_of_gans/blob/master/models/base_model.py
@@ -153,27 +154,14 @@ class generalized_drop_out(nn.Module):
         self.axes = [axes] if isinstance(axes, int) else list(axes)
         self.normalize = normalize
         self.gain = None
+        # None: the default torch generator of the input's device (see common.functions.gdrop.seed_gdrop)
+        self.generator = None
 
     def forward(self, x, deterministic=False):
-        if deterministic or not self.strength:
+        # a tensor strength (set on the device by the trainer) is not tested on the host
+        if deterministic or (not torch.is_tensor(self.strength) and not self.strength):
             return x
-
-        rnd_shape = [s if axis in self.axes else 1 for axis, s in enumerate(x.size())]  # [x.size(axis) for axis in self.axes]
-        if self.mode == 'drop':
-            p = 1 - self.strength
-            rnd = np.random.binomial(1, p=p, size=rnd_shape) / p
-        elif self.mode == 'mul':
-            rnd = (1 + self.strength) ** np.random.normal(size=rnd_shape)
-        else:
-            coef = self.strength * x.size(1) ** 0.5
-            rnd = np.random.normal(size=rnd_shape) * coef + 1
-
-        if self.normalize:
-            rnd = rnd / np.linalg.norm(rnd, keepdims=True)
-        rnd = Variable(torch.from_numpy(rnd).type(x.data.type()))
-        if x.is_cuda:
-            rnd = rnd.cuda()
-        return x * rnd
+        return x * gdrop_noise(x, self.mode, self.strength, self.axes, self.normalize, self.generator)
 
     def __repr__(self):
         param_str = '(mode = %s, strength = %s, axes = %s, normalize = %s)' % (self.mode, self.strength, self.axes, self.normalize)
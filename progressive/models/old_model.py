@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 from models.base_model import *
 from models.custom_layers import *
+from common.functions.gdrop import gdrop_layers
 
 device = 'cpu'
 
 def G_conv(incoming, in_channels, out_channels, kernel_size, padding, activation, init, param=None, to_sequential=True, use_wscale=True, use_batchnorm=False, use_pixelnorm=True):
     layers = incoming
     if use_wscale:
-        layers += [wscaled_conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=1, padding=padding)]
+        layers += [wscaled_conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=1, padding=padding, init=init, param=param)]
     else:
         layers += [nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=1, padding=padding)]
         he_init(layers[-1], init, param)  # init layers
@@ -26,7 +27,7 @@ def NINLayer(incoming, in_channels, out_channels, activation, init, param=None,
             to_sequential=True, use_wscale=True):
     layers = incoming
     if use_wscale:
-        layers += [wscaled_conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=1, stride=1, padding=0)]
+        layers += [wscaled_conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=1, stride=1, padding=0, init=init, param=param)]
     else:
         layers += [nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=1, stride=1, padding=0)]  # NINLayer in lasagne
         he_init(layers[-1], init, param)  # init layers
@@ -89,6 +90,10 @@ class Generator(nn.Module):
     def get_nf(self, stage):
         return min(int(self.z_dim * (4 ** 2) / (2.0 ** (stage * 1.))), 512)
 
+    def checkpoint_blocks(self):
+        # level I outputs 2**(I+2) px
+        return [(2 ** (I+2), block) for I, block in enumerate(self.output_layer.chain)]
+
     def forward(self, x, y=None, cur_level=None, insert_y_at=None):
         return self.output_layer(x, y, cur_level, insert_y_at)
 
@@ -99,7 +104,7 @@ def D_conv(incoming, in_channels, out_channels, kernel_size, padding, activation
     if use_gdrop:
         layers += [GDropLayer(**gdrop_param)]
     if use_wscale:
-        layers += [wscaled_conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=1, padding=padding)]
+        layers += [wscaled_conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=1, padding=padding, init=init, param=param)]
     else:
         layers += [nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=1, padding=padding)]
         he_init(layers[-1], init, param)  # init layers
@@ -124,6 +129,8 @@ class Discriminator(nn.Module):
         self.use_gdrop = self.model_cfg.use_gdrop
         self.use_layernorm = self.model_cfg.use_layernorm
         self.sigmoid_at_end = self.model_cfg.sigmoid_at_end
+        # minibatch stddev over all ranks of a data-parallel run, or over each rank's own share
+        self.mbstat_across_ranks = self.model_cfg.mbstat_across_ranks if hasattr(self.model_cfg, 'mbstat_across_ranks') else False
 
         R = int(np.log2(target_size))
         assert target_size == 2**R and target_size >= 4
@@ -160,7 +167,7 @@ class Discriminator(nn.Module):
         net = []
         in_ch = out_ch = self.get_nf(1)
         if self.mbstat_avg is not None:
-            net += [MinibatchStatConcatLayer(averaging=self.mbstat_avg)]
+            net += [MinibatchStatConcatLayer(averaging=self.mbstat_avg, across_ranks=self.mbstat_across_ranks)]
             in_ch += 1
         net = D_conv(net, in_ch, out_ch, 3, 1, act, init_act, negative_slope, False, 
                     self.use_wscale, self.use_gdrop, self.use_layernorm, gdrop_param)
@@ -176,12 +183,18 @@ class Discriminator(nn.Module):
         lods.append(NINLayer(net, self.get_nf(0), out_ch, output_act, output_init_act, None, True, self.use_wscale))
 
         self.output_layer = DSelectLayer(pre, lods, nins)
+        # collected once rather than searched for on every forward
+        self.gdrop_layers = gdrop_layers(self)
 
     def get_nf(self, stage):
         return min(int(self.model_cfg.initial_f_map / (2.0 ** (stage * 1.0))), 512)
 
+    def checkpoint_blocks(self):
+        # the chain runs from the target resolution down to 4x4
+        return [(self.target_size // 2 ** I, block) for I, block in enumerate(self.output_layer.chain)]
+
     def forward(self, x, y=None, cur_level=None, insert_y_at=None, gdrop_strength=0.0):
-        for module in self.modules():
-            if hasattr(module, 'strength'):
-                module.strength = gdrop_strength
+        # a float, or a 0-dim tensor on the device that the noise is scaled by without a sync
+        for layer in self.gdrop_layers:
+            layer.strength = gdrop_strength
         return self.output_layer(x, y, cur_level, insert_y_at)
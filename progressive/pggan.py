@@ -1,16 +1,27 @@
 # -*- coding: utf-8 -*-
 import sys, os, time
 import numpy as np
-from scipy.misc import imsave
 
 import torch
 import torch.optim as optim
 from torch.autograd import Variable
 from utils.logger import Logger
+from common.utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+from common.utils.ema import EMA
+from common.utils.compile import compile_options, LevelCompiled
+from common.utils.distributed import Distributed
+from common.utils.accumulation import GradientAccumulation
+from common.utils.batchsize import BatchSizeFinder, gan_trial
+from common.utils.freezing import LevelFreezing
+from common.modules.activation_checkpoint import checkpoint_from_cfg
+from common.functions.gdrop import seed_gdrop
+from common.utils.memory_format import memory_format_from_cfg
+from common.utils.metrics import StepMetrics, LossMeter
+from common.utils.profiler import ProfilerWindow
 from torchvision.utils import save_image
 
 class PGGAN():
-    def __init__(self, G, D, dataset, z_generator, xpu, cfg, G_resume=None):
+    def __init__(self, G, D, dataset, z_generator, xpu, cfg, G_resume=None, dist=None):
         self.G = G
         self.G_resume = G_resume
         self.D = D
@@ -18,55 +29,128 @@ class PGGAN():
         self.cfg = cfg
         self.z_generator = z_generator
         self.current_time = time.strftime('%Y-%m-%d %H%M%S')
-        self.logger = Logger('./logs/' + self.current_time + "/")
-        os.environ['CUDA_VISIBLE_DEVICES'] = str(xpu)
-        self.use_cuda = xpu >= 0
-
-        self.bs_map = {2**R: self.get_bs(2**R) for R in range(2, 11)} # batch size map keyed by resolution_level
-        self.rows_map = {32: 8, 16: 4, 8: 4, 4: 2, 2: 2}
+        # data parallel under torchrun: every rank trains on its share of each global batch
+        self.dist = dist if dist is not None else Distributed(xpu)
+        self.device = self.dist.device
+        self.use_cuda = self.device.type == 'cuda'
+        # optional: channels-last (NHWC) models, and real batches converted as they arrive
+        self.memory_format = memory_format_from_cfg(cfg)
+        self.logger = Logger('./logs/' + self.current_time + "/") if self.dist.is_main else None
+
+        self.bs_map = {2**R: self.split_bs(2**R) for R in range(2, 11)} # global batch size map keyed by resolution_level
+        self.rows_map = {32: 8, 16: 4, 8: 4, 4: 2, 2: 2, 1: 1}
+        self.accumulation = GradientAccumulation()
 
         self.restore_model()
 
+        metrics_file = cfg.train.metrics_file if hasattr(cfg.train, 'metrics_file') else 'metrics.jsonl'
+        self.metrics_interval = cfg.train.metrics_interval if hasattr(cfg.train, 'metrics_interval') else cfg.train.print_interval
+        self.metrics = StepMetrics(os.path.join(cfg.train.out, metrics_file), device=self.device if self.use_cuda else None,
+                                   enabled=self.dist.is_main)
+        # `it` restarts in every phase, so profiler windows are keyed by the iterations run by this process
+        self.profiler = ProfilerWindow.from_cfg(cfg, cfg.train.out, enabled=self.dist.is_main)
+        self.global_it = 0
+        self.losses = LossMeter()
+        self.loss_means = {}
+        self._loss_means_it = None
+        self._d_real_means = []
+
     def restore_model(self):
         self.current_time = time.strftime('%Y-%m-%d %H%M%S')
         self.time = self.current_time
+        self.sample_dir = os.path.join(self.cfg.train.out, 'samples')
+        self.checkpoint_dir = os.path.join(self.cfg.train.out, 'checkpoint')
+        self.checkpoints = CheckpointManager.from_cfg(self.cfg, self.checkpoint_dir)
+        self._resume_state = None
         if self.G_resume is not None:
-            pattern = os.path.split(self.G_resume)[1].split('-')
-            self._from_resol = int(pattern[0].split('x')[0])
-            self._phase = pattern[1]
-            self._epoch = int(pattern[2])
-            G_model = self.G_resume
-            D_model = self.G_resume.replace('G','D')
-            assert os.path.exists(G_model) and os.path.exists(D_model)
-            self.G.load_state_dict(torch.load(G_model))
-            self.D.load_state_dict(torch.load(D_model))
+            checkpoint_path = self.checkpoints.resolve(self.G_resume)
+            assert checkpoint_path is not None, f'no checkpoint found for {self.G_resume}'
+            state = torch.load(checkpoint_path, map_location='cpu')
+            if 'G' in state:
+                self._phase = state['phase']
+                # a fade-in checkpoint counts as the higher resolution, see train()
+                self._from_resol = 2 ** (state['level'] + (2 if self._phase == 'fade_in' else 1)) if 'level' in state else state['resolution']
+                self._epoch = state['it']
+                self.G.load_state_dict(state['G'])
+                self.D.load_state_dict(state['D'])
+                # optimizers, schedule position and RNG are applied by train() once the optimizers exist
+                if 'optim_G' in state:
+                    self._resume_state = state
+            else:
+                # separate -G.pth/-D.pth files, with the position encoded in the file name
+                pattern = os.path.split(checkpoint_path)[1].split('-')
+                self._from_resol = int(pattern[0].split('x')[0])
+                self._phase = pattern[1]
+                self._epoch = int(pattern[2])
+                D_model = checkpoint_path.replace('G','D')
+                assert os.path.exists(D_model)
+                self.G.load_state_dict(state)
+                self.D.load_state_dict(torch.load(D_model, map_location='cpu'))
             self.is_restored = True
-            print(f'Restored from {G_model}')
+            print(f'Restored from {checkpoint_path}')
         else:
             self._from_resol = 4
             self._phase = 'stabilize'
             self._epoch = 0
             self.is_restored = False
-        self.sample_dir = os.path.join(self.cfg.train.out, 'samples')
-        self.checkpoint_dir = os.path.join(self.cfg.train.out, 'checkpoint')
-        if not os.path.exists(self.sample_dir):
+        if self.dist.is_main and not os.path.exists(self.sample_dir):
             os.makedirs(self.sample_dir)
-        if not os.path.exists(self.checkpoint_dir):
-            os.makedirs(self.checkpoint_dir)
         return 
 
     def get_bs(self, resolution):
+        # global batch size; cfg.train.batch_sizes lists them from 4x4 up
         R = int(np.log2(resolution))
+        if hasattr(self.cfg.train, 'batch_sizes') and R-2 < len(self.cfg.train.batch_sizes):
+            return int(self.cfg.train.batch_sizes[R-2])
         if R < 7:
             bs = 32 / 2**(max(0, R-4))
         else:
             bs = 8 / 2**(min(2, R-6))
         return int(bs)
 
+    def get_accumulation_steps(self, resolution):
+        # micro-batches per step; cfg.train.accumulation_steps is one number or a list from 4x4 up
+        steps = self.cfg.train.accumulation_steps if hasattr(self.cfg.train, 'accumulation_steps') else 1
+        if isinstance(steps, (list, tuple)):
+            R = int(np.log2(resolution))
+            steps = steps[R-2] if R-2 < len(steps) else 1
+        return int(steps)
+
+    def split_bs(self, resolution):
+        # every rank takes an equal share, so the global batch is rounded to a multiple of the world size
+        bs = self.get_bs(resolution)
+        local_bs = max(1, bs // self.dist.world_size)
+        if local_bs * self.dist.world_size != bs and resolution <= self.cfg.train.target_size and self.dist.is_main:
+            print(f'{resolution}x{resolution}: batch size {bs} does not split across {self.dist.world_size} ranks, using {local_bs * self.dist.world_size}')
+        return local_bs * self.dist.world_size
+
+    def auto_batch_sizes(self):
+        # optional: per-level batch sizes that fit cfg.train.auto_batchsize['budget_mb'], probed for one
+        # micro-batch per rank on this device (cached in <out>/batchsize.json per config and device)
+        finder = BatchSizeFinder.from_cfg(self.cfg, self.device, [self.G, self.D])
+        if finder is None:
+            return
+        # rank 0 probes alone, so the minibatch stddev cannot wait for the other ranks
+        mbstat = [m for m in self.D.modules() if getattr(m, 'across_ranks', False)]
+        for m in mbstat:
+            m.across_ranks = False
+        max_level = int(np.log2(self.cfg.train.target_size)) - 1
+        for R in range(1, max_level + 1):
+            resol = 2 ** (R+1)
+            # a phase's batch size also covers the fade-in to the next resolution
+            levels = [R, R + 0.5] if R < max_level else [R]
+            trial = gan_trial(lambda z, y, cur_level: self.G(z, cur_level=cur_level),
+                              lambda x, y, cur_level: self.D(x, cur_level=cur_level),
+                              [self.G, self.D], self.cfg.models.generator.z_dim, lambda level: 2 ** int(np.ceil(level + 1)),
+                              self.device, gp=self.cfg.train.loss_type == 'wgan-gp', levels=levels)
+            bs = finder.find(trial, [self.G, self.D], name='%dx%d' % (resol, resol), dist=self.dist)
+            self.bs_map[resol] = bs * self.get_accumulation_steps(resol) * self.dist.world_size
+        for m in mbstat:
+            m.across_ranks = True
+
     def register_on_gpu(self):
-        if self.use_cuda:
-            self.G.cuda()
-            self.D.cuda()
+        self.G.to(self.device, memory_format=self.memory_format)
+        self.D.to(self.device, memory_format=self.memory_format)
 
     def create_optimizer(self):
         self.optim_G = optim.Adam(self.G.parameters(), lr=self.cfg.train.parameters.g_lr, betas=(self.cfg.train.parameters.beta1, self.cfg.train.parameters.beta2))
@@ -92,14 +176,15 @@ class PGGAN():
     def compute_additional_d_loss(self, cur_level):
         # drifting loss and gradient penalty, weighting inside this function
         if self.cfg.train.loss_type == 'wgan-gp':
-            d_loss_gp = self.gradient_penalty(cur_level)
+            with self.metrics.phase('gp'):
+                d_loss_gp = self.gradient_penalty(cur_level)
             d_loss_drift = 0.001 # TODO
             return d_loss_drift * torch.mean(self.d_real ** 2) + d_loss_gp * self.cfg.train.parameters.lambda_gp
         else:
             return 0.
 
     def gradient_penalty(self, cur_level):
-        epsilon = torch.rand(self.real.shape[0], 1, 1, 1).cuda().expand_as(self.real)
+        epsilon = torch.rand(self.real.shape[0], 1, 1, 1, device=self.real.device).expand_as(self.real)
         x_hat = torch.autograd.Variable(epsilon * self.real.data + (1 - epsilon) * self.fake.data, requires_grad=True)
 
         d_hat = self.D(x_hat, cur_level=cur_level)
@@ -109,21 +194,21 @@ class PGGAN():
 
         grad = torch.autograd.grad(outputs=d_hat,
                                    inputs=x_hat,
-                                   grad_outputs=torch.ones(d_hat.shape).cuda(),
+                                   grad_outputs=torch.ones_like(d_hat),
                                    retain_graph=True,
                                    create_graph=True,
                                    only_inputs=True)[0]
 
         #wscale_mul = self.D.get_wscale_mul(2)
 
-        grad = grad.view(grad.shape[0], -1)
+        grad = grad.reshape(grad.shape[0], -1)
         grad_norm = torch.sqrt(torch.sum(grad ** 2, dim=1))
         d_loss_gp = torch.mean((grad_norm - 1) ** 2)
 
         return d_loss_gp
 
     def _get_data(self, d):
-        return d.data[0] if isinstance(d, Variable) else d
+        return d.detach() if torch.is_tensor(d) else d
 
     def compute_G_loss(self):
         g_adv_loss = self.compute_adv_loss(self.d_fake, True, 1)
@@ -159,24 +244,22 @@ class PGGAN():
     '''Update Learning rate
     '''
     def update_lr(self, cur_nimg):
+        # a Python float: the optimizer state is checkpointed, and torch.load (weights_only) rejects NumPy scalars
         for param_group in self.optim_G.param_groups:
             lrate_coef = self._rampup(cur_nimg / 1000.0, self.cfg.train.rampup_kimg)
             lrate_coef *= self._rampdown_linear(cur_nimg / 1000.0, self.cfg.train.total_kimg, self.cfg.train.rampdown_kimg)
-            param_group['lr'] = lrate_coef * self.cfg.train.parameters.g_lr
+            param_group['lr'] = float(lrate_coef * self.cfg.train.parameters.g_lr)
         for param_group in self.optim_D.param_groups:
             lrate_coef = self._rampup(cur_nimg / 1000.0, self.cfg.train.rampup_kimg)
             lrate_coef *= self._rampdown_linear(cur_nimg / 1000.0, self.cfg.train.total_kimg, self.cfg.train.rampdown_kimg)
-            param_group['lr'] = lrate_coef * self.cfg.train.parameters.d_lr
+            param_group['lr'] = float(lrate_coef * self.cfg.train.parameters.d_lr)
 
     def postprocess(self):
         # TODO: weight cliping or others
         pass
 
     def _numpy2var(self, x):
-        var = Variable(torch.from_numpy(x))
-        if self.use_cuda:
-            var = var.cuda()
-        return var
+        return torch.from_numpy(x).to(self.device)
 
     def _var2numpy(self, var):
         if self.use_cuda:
@@ -187,55 +270,83 @@ class PGGAN():
         if not self.cfg.models.discriminator.add_noise:
             return 0
 
-        if hasattr(self, '_d_'):
-            self._d_ = self._d_ * 0.9 + np.clip(torch.mean(self.d_real).data[0], 0.0, 1.0) * 0.1
-        else:
-            self._d_ = 0.0
-        strength = 0.2 * max(0, self._d_ - 0.5)**2
+        # kept on the device: the GDrop layers scale their noise by the tensor, no .item() sync
+        if not hasattr(self, '_d_'):
+            self._d_ = torch.zeros((), device=self.device)
+        strength = 0.2 * (self._d_ - 0.5).clamp(min=0)**2
         return strength
 
+    def update_noise_level(self):
+        # once per optimizer step, from the mean D(real) of its micro-batches (equal sizes,
+        # so that of the whole batch): the same schedule with or without accumulation
+        if not self.cfg.models.discriminator.add_noise:
+            return
+        d_real, self._d_real_means = torch.stack(self._d_real_means).mean(), []
+        self._d_ = self._d_ * 0.9 + d_real.clamp(0.0, 1.0) * 0.1
+
     def preprocess(self, z, real):
         self.z = self._numpy2var(z)
-        self.real = Variable(real).cuda()
+        self.real = real.to(self.device, memory_format=self.memory_format)
         #self.real = self._numpy2var(real)
 
     def forward_G(self, cur_level):
-        self.d_fake = self.D(self.fake, cur_level=cur_level)
+        self.d_fake = self.D_fwd(self.fake, cur_level=cur_level)
     
     def forward_D(self, cur_level, detach=True):
-        self.fake = self.G(self.z, cur_level=cur_level)
+        self.fake = self.G_fwd(self.z, cur_level=cur_level)
         strength = self.compute_noise_strength()
-        self.d_real = self.D(self.real, cur_level=cur_level, gdrop_strength=strength)
-        self.d_fake = self.D(self.fake.detach() if detach else self.fake, cur_level=cur_level)
+        self.d_real = self.D_fwd(self.real, cur_level=cur_level, gdrop_strength=strength)
+        if self.cfg.models.discriminator.add_noise:
+            self._d_real_means.append(torch.mean(self.d_real.detach()))
+        self.d_fake = self.D_fwd(self.fake.detach() if detach else self.fake, cur_level=cur_level)
 
     def backward_G(self):
         g_loss = self.compute_G_loss()
-        g_loss.backward()
-        self.optim_G.step()
+        with self.metrics.phase('g_fwd_bwd'):
+            self.accumulation.scale(g_loss).backward()
         self.g_loss = self._get_data(g_loss)
+        self.losses.update(G_loss=self.g_loss, G_adv_loss=self.g_adv_loss, G_add_loss=self.g_add_loss)
+
+    def step_G(self):
+        with self.metrics.phase('optim'):
+            self.optim_G.step()
+            # data parallel: buffers and parameters without gradients back in step
+            self.dist.sync_states(self.G, self.D)
+            if self.ema is not None:
+                self.ema.update(self.global_it)
 
     def backward_D(self, cur_level, retain_graph=False):
         d_loss = self.compute_D_loss(cur_level)
-        d_loss.backward(retain_graph=retain_graph)
-        self.optim_D.step()
+        with self.metrics.phase('d_fwd_bwd'):
+            self.accumulation.scale(d_loss).backward(retain_graph=retain_graph)
         self.d_loss = self._get_data(d_loss)
+        self.losses.update(D_loss=self.d_loss, D_adv_loss=self.d_adv_loss, D_add_loss=self.d_add_loss,
+                           D_adv_loss_fake=self._get_data(self.d_adv_loss_fake),
+                           D_adv_loss_real=self._get_data(self.d_adv_loss_real))
+
+    def step_D(self):
+        with self.metrics.phase('optim'):
+            self.optim_D.step()
+
+    def read_losses(self):
+        # running means since the last read, copied to the host (and averaged over ranks) once per
+        # logging iteration; every rank has to read at the same iterations
+        if self._loss_means_it != self.global_it:
+            self.loss_means = self.dist.average(self.losses.means())
+            self._loss_means_it = self.global_it
+        return self.loss_means
 
     def report(self, it, num_it, phase, resol):
         formation = 'Iter[%d|%d], %s, %s, G: %.3f, D: %.3f, G_adv: %.3f, G_add: %.3f, D_adv: %.3f, D_add: %.3f'
-        values = (it, num_it, phase, resol, self.g_loss, self.d_loss, self.g_adv_loss, self.g_add_loss, self.d_adv_loss, self.d_add_loss)
-        print(formation % values)
+        losses = self.read_losses()
+        values = (it, num_it, phase, resol, losses['G_loss'], losses['D_loss'], losses['G_adv_loss'], losses['G_add_loss'], losses['D_adv_loss'], losses['D_add_loss'])
+        if self.dist.is_main:
+            print(formation % values)
 
     def tensorboard(self, it, num_it, phase, resol, samples):
         # (1) Log the scalar values
         prefix = str(resol)+'/'+phase+'/'
-        info = {prefix + 'G_loss': self.g_loss,
-                prefix + 'G_adv_loss': self.g_adv_loss,
-                prefix + 'G_add_loss': self.g_add_loss,
-                prefix + 'D_loss': self.d_loss,
-                prefix + 'D_adv_loss': self.d_adv_loss,
-                prefix + 'D_add_loss': self.d_add_loss,
-                prefix + 'D_adv_loss_fake': self._get_data(self.d_adv_loss_fake),
-                prefix + 'D_adv_loss_real': self._get_data(self.d_adv_loss_real)}
+        info = {prefix + tag: value for tag, value in self.read_losses().items()}
 
         for tag, value in info.items():
             self.logger.scalar_summary(tag, value, it)
@@ -243,65 +354,109 @@ class PGGAN():
         # (2) Log values and gradients of the parameters (histogram)
         for tag, value in self.G.named_parameters():
             tag = tag.replace('.', '/')
-            self.logger.histo_summary('G/' + prefix +tag, self._var2numpy(value), it)
+            self.logger.histo_summary('G/' + prefix +tag, value, it)
             if value.grad is not None:
-                self.logger.histo_summary('G/' + prefix +tag + '/grad', self._var2numpy(value.grad), it)
+                self.logger.histo_summary('G/' + prefix +tag + '/grad', value.grad, it)
 
         for tag, value in self.D.named_parameters():
             tag = tag.replace('.', '/')
-            self.logger.histo_summary('D/' + prefix + tag, self._var2numpy(value), it)
+            self.logger.histo_summary('D/' + prefix + tag, value, it)
             if value.grad is not None:
-                self.logger.histo_summary('D/' + prefix + tag + '/grad',
-                                          self._var2numpy(value.grad), it)
+                self.logger.histo_summary('D/' + prefix + tag + '/grad', value.grad, it)
 
         # (3) Log the images
         # info = {'images': samples[:10]}
         # for tag, images in info.items():
         #     logger.image_summary(tag, images, it)
 
-    def train_phase(self, R, phase, batch_size, cur_nimg, from_it, total_it):
+    def train_phase(self, R, phase, batch_size, cur_nimg, from_it, total_it, phase_start=None):
         assert total_it >= from_it
-
-        self.dataset.shuffle()
+        # a resumed phase starts at from_it, but the fade-in still ramps over the whole phase
+        phase_start = from_it if phase_start is None else phase_start
+
+        dataset_order, self._dataset_order = self._dataset_order, None
+        if from_it == total_it:
+            return
+        if dataset_order is not None:
+            self.dataset.image_paths = list(dataset_order)
+        else:
+            self.dataset.shuffle()
+            # one order for all ranks, which then read disjoint slices of every global batch
+            self.dataset.image_paths = self.dist.broadcast_object(self.dataset.image_paths)
         dataset_len = len(self.dataset)
+        # batch_size is global; this rank's share starts at offset
+        local_batch_size = batch_size // self.dist.world_size
+        offset = self.dist.rank * local_batch_size
+        # the share is forwarded in micro-batches whose gradients add up to those of the whole batch
+        self.accumulation = GradientAccumulation(self.get_accumulation_steps(2 ** (R+1)))
+        self.accumulation.micro_batchsize(local_batch_size)
+        self.accumulation.adjust_batchnorm(self.G, self.D)
+        if self.freezing is not None and self.dist.is_main:
+            # the fade-in trains at the next resolution
+            limit = self.freezing.frozen_resolution(2 ** (R+1) if phase == 'stabilize' else 2 ** (R+2))
+            print(f'frozen levels: {"up to %dx%d" % (limit, limit) if limit else "none"}')
 
         for it in range(from_it, total_it):
+            # `it` advances in lockstep on every rank, so the fade-in alpha is the same everywhere
             if phase == 'stabilize':
                 cur_level = R
             else:
-                cur_level = R + (it - from_it) / float(total_it - from_it) 
+                cur_level = R + (it - phase_start) / float(total_it - phase_start)
             cur_resol = 2 ** int(np.ceil(cur_level+1))
 
             # set current image size
             self.dataset.setsize([cur_resol, cur_resol])
 
             # get a batch noise and real images
-            z = self.z_generator(batch_size)
-
-            for b in range(batch_size):
-                if b == 0:
-                    one = self.dataset[it * batch_size % dataset_len]
-                    x = one.view(1, -1, one.shape[1], one.shape[2])
-                else:
-                    x = torch.cat((x, self.dataset[(it * batch_size + b) % dataset_len].view(1, x.shape[1], x.shape[2], x.shape[3])), dim=0)
-
-            # ===preprocess===
-            self.preprocess(z, real=x)
+            with self.metrics.phase('data'):
+                z = self.z_generator(local_batch_size)
+
+                for b in range(local_batch_size):
+                    if b == 0:
+                        one = self.dataset[(it * batch_size + offset) % dataset_len]
+                        x = one.view(1, -1, one.shape[1], one.shape[2])
+                    else:
+                        x = torch.cat((x, self.dataset[(it * batch_size + offset + b) % dataset_len].view(1, x.shape[1], x.shape[2], x.shape[3])), dim=0)
+
+                # ===preprocess===
+                self.preprocess(z, real=x)
             self.update_lr(cur_nimg)
 
+            z_batch, real_batch = self.z, self.real
+            if self.freezing is not None:
+                # the same on every rank: it depends on the level and the step only
+                self.freezing.apply(self.G, self.D, cur_resol, self.global_it)
+            micro_batches = self.accumulation.split(z_batch, real_batch)
+
             # ===update D===
             self.optim_G.zero_grad()
             self.optim_D.zero_grad()
-            self.forward_D(cur_level, detach=True)
-            self.backward_D(cur_level)
+            for k, (self.z, self.real) in enumerate(micro_batches):
+                with self.accumulation.no_sync(k, self.D_fwd):
+                    with self.metrics.phase('d_fwd_bwd'):
+                        self.forward_D(cur_level, detach=True)
+                    self.backward_D(cur_level)
+            self.step_D()
+            self.update_noise_level()
 
             # ===update G===
             self.optim_G.zero_grad()
             self.optim_D.zero_grad()
-            self.forward_G(cur_level)
-            self.backward_G()
+            for k, (self.z, self.real) in enumerate(micro_batches):
+                with self.accumulation.no_sync(k, self.G_fwd, self.D_fwd):
+                    with self.metrics.phase('g_fwd_bwd'):
+                        if self.accumulation.enabled:
+                            # only the last micro-batch of the D step kept its fakes (and their graph)
+                            self.fake = self.G_fwd(self.z, cur_level=cur_level)
+                        self.forward_G(cur_level)
+                    self.backward_G()
+            self.step_G()
+            self.z, self.real = z_batch, real_batch
 
             # ===report ===
+            preview = (it % self.cfg.train.preview_interval == 0) or it == total_it-1
+            if it % self.cfg.train.print_interval == 0 or it % self.metrics_interval == 0 or preview:
+                self.read_losses()
             if it % self.cfg.train.print_interval == 0:
                 self.report(it, total_it, phase, cur_resol)
 
@@ -309,28 +464,71 @@ class PGGAN():
 
             # ===generate sample images===
             samples = []
-            if (it % self.cfg.train.preview_interval == 0) or it == total_it-1:
-                samples = self.sample()
-                #imsave(os.path.join(self.sample_dir,
-                #                    '%dx%d-%s-%s.png' % (cur_resol, cur_resol, phase, str(it).zfill(6))), samples)
-                save_image((self.fake.data.cpu() + 1.0) * 0.5, os.path.join(self.sample_dir, '%dx%d-%s-%s.png' % (cur_resol, cur_resol, phase, str(it).zfill(6))), padding=0)
-
-            if it == from_it:
+            if preview and self.dist.is_main:
+                with self.metrics.phase('preview'):
+                    samples = self.sample()
+                    #imsave(os.path.join(self.sample_dir,
+                    #                    '%dx%d-%s-%s.png' % (cur_resol, cur_resol, phase, str(it).zfill(6))), samples)
+                    save_image((self.fake.data.cpu() + 1.0) * 0.5, os.path.join(self.sample_dir, '%dx%d-%s-%s.png' % (cur_resol, cur_resol, phase, str(it).zfill(6))), padding=0)
+
+            if it == from_it and self.dist.is_main:
                 save_image((self.real.data.cpu() + 1.0) * 0.5, os.path.join(self.sample_dir, '%dx%d_real.png' % (cur_resol, cur_resol)), padding=0)
 
             # ===tensorboard visualization===
-            if (it % self.cfg.train.preview_interval == 0) or it == total_it - 1:
-                self.tensorboard(it, total_it, phase, cur_resol, samples)
+            if preview and self.dist.is_main:
+                with self.metrics.phase('preview'):
+                    self.tensorboard(it, total_it, phase, cur_resol, samples)
 
             # ===save model===
-            if (it % self.cfg.train.save_interval == 0 and it > 0) or it == total_it-1:
-                self.save(os.path.join(self.checkpoint_dir, '%dx%d-%s-%s' % (cur_resol, cur_resol, phase, str(it).zfill(6))))
+            if ((it % self.cfg.train.save_interval == 0 and it > 0) or it == total_it-1) and self.dist.is_main:
+                with self.metrics.phase('checkpoint'):
+                    self.save(cur_resol, phase, it, cur_nimg, R)
+
+            self.metrics.step(batch_size)
+            if it % self.metrics_interval == 0:
+                self.metrics.flush(it, phase=phase, resolution=cur_resol, cur_nimg=cur_nimg, **self.read_losses())
+            self.global_it += 1
+            self.profiler.step(self.global_it, tag='%dx%d-%s' % (cur_resol, cur_resol, phase))
         
     def train(self):
         # prepare
         self.register_on_gpu()
+        # optional: recompute the activations of the high-resolution levels in the backward
+        checkpoint_from_cfg(self.cfg, self.G, self.D)
+        # optional: a seeded generator of its own for D's GDrop noise (one stream per rank)
+        self.gdrop_generator = None
+        if hasattr(self.cfg.train, 'gdrop_seed') and self.cfg.train.gdrop_seed is not None:
+            self.gdrop_generator = seed_gdrop(self.D, self.cfg.train.gdrop_seed + self.dist.rank, self.device)
+        self.auto_batch_sizes()
         self.create_optimizer()
         self.create_criterion()
+        self.ema = EMA.from_cfg(self.cfg, self.G) if self.dist.is_main else None
+        # optional: stop training the stabilized lower levels (after the EMA took every parameter)
+        self.freezing = LevelFreezing.from_cfg(self.cfg)
+        # compiled per resolution level; the gradient penalty's double backward uses self.D (neither
+        # compiled graphs nor DDP support it) and joins d_loss, whose single backward DDP all-reduces.
+        # The inactive levels get no gradients, hence find_unused_parameters
+        compile_opts = compile_options(self.cfg)
+        self.G_fwd = LevelCompiled(self.dist.wrap(self.G, find_unused_parameters=True), compile_opts)
+        self.D_fwd = LevelCompiled(self.dist.wrap(self.D, find_unused_parameters=True), compile_opts)
+        self._dataset_order = None
+        resume_nimg = None
+        if self._resume_state is not None:
+            state, self._resume_state = self._resume_state, None
+            self.optim_G.load_state_dict(state['optim_G'])
+            self.optim_D.load_state_dict(state['optim_D'])
+            if self.ema is not None and 'G_ema' in state:
+                self.ema.load_state_dict(state['G_ema'])
+            if '_d_' in state:
+                self._d_ = torch.as_tensor(state['_d_'], dtype=torch.float32).to(self.device)
+            if self.gdrop_generator is not None and 'gdrop_rng' in state:
+                self.gdrop_generator.set_state(state['gdrop_rng'])
+            self.global_it = state['global_it']
+            self._dataset_order = state['dataset_order']
+            resume_nimg = state['cur_nimg']
+            # the other ranks keep their own noise streams
+            if self.dist.is_main:
+                set_rng_state(state['rng'])
 
         to_level = int(np.log2(self.cfg.train.target_size))
         from_level = int(np.log2(self._from_resol))
@@ -346,20 +544,32 @@ class PGGAN():
             batch_size = self.bs_map[2 ** (R+1)]
 
             phases = {'stabilize':[0, train_kimg//batch_size], 'fade_in':[train_kimg//batch_size+1, (transition_kimg+train_kimg)//batch_size]}
+            phase_starts = {phase: _range[0] for phase, _range in phases.items()}
             if self.is_restored and R == from_level-1:
                 phases[self._phase][0] = self._epoch + 1
                 if self._phase == 'fade_in':
                     del phases['stabilize']
+            if R == to_level - 1:
+                # the target resolution is the last level: nothing to fade into
+                phases.pop('fade_in', None)
 
             for phase in ['stabilize', 'fade_in']:
-                print(self._phase, phase, from_level, R)
+                if self.dist.is_main:
+                    print(self._phase, phase, from_level, R)
                 if phase in phases:
                     _range = phases[phase]
-                    self.train_phase(R, phase, batch_size, _range[0]*batch_size, _range[0], _range[1])
+                    cur_nimg = _range[0]*batch_size
+                    if resume_nimg is not None and self.is_restored and R == from_level-1 and phase == self._phase:
+                        # the learning rate ramps are a function of cur_nimg, so this also restores the schedule
+                        cur_nimg = resume_nimg
+                    self.train_phase(R, phase, batch_size, cur_nimg, _range[0], _range[1], phase_starts[phase])
+        self.profiler.close()
+        self.checkpoints.close()
 
     def sample(self):
-        batch_size = self.z.size(0)
-        n_row = self.rows_map[batch_size]
+        # with accumulation, the fakes are those of the last micro-batch
+        batch_size = self.fake.size(0)
+        n_row = self.rows_map.get(batch_size, 1)
         n_col = int(np.ceil(batch_size / float(n_row)))
         samples = []
         i = j = 0
@@ -383,9 +593,26 @@ class PGGAN():
         #samples[:, half:, :] = samples[:, half:, :] / np.max(samples[:, half:, :])
         return samples
 
-    def save(self, file_name):
-        g_file = file_name + '-G.pth'
-        d_file = file_name + '-D.pth'
-        torch.save(self.G.state_dict(), g_file)
-        torch.save(self.D.state_dict(), d_file)
+    def save(self, resol, phase, it, cur_nimg, level):
+        state = {'G': self.G.state_dict(),
+                 'D': self.D.state_dict(),
+                 'optim_G': self.optim_G.state_dict(),
+                 'optim_D': self.optim_D.state_dict(),
+                 # plain Python values throughout, which torch.load's weights_only unpickler accepts
+                 'resolution': int(resol),
+                 'level': int(level),
+                 'phase': phase,
+                 'it': int(it),
+                 'cur_nimg': int(cur_nimg),
+                 'global_it': self.global_it + 1,
+                 'dataset_order': list(self.dataset.image_paths),
+                 'rng': rng_state(),
+                }
+        if hasattr(self, '_d_'):
+            state['_d_'] = self._d_
+        if self.gdrop_generator is not None:
+            state['gdrop_rng'] = self.gdrop_generator.get_state()
+        if self.ema is not None:
+            state['G_ema'] = self.ema.state_dict()
+        self.checkpoints.save(state, '%dx%d-%s-%s.pth' % (resol, resol, phase, str(it).zfill(6)), step=self.global_it)
 
@@ -8,6 +8,7 @@ import torch
 sys.path.append(os.pardir)
 from pggan import PGGAN
 from common.utils.config import Config
+from common.utils.distributed import Distributed
 from dataset.dataset import FaceDataset
 from utils.randomnoisegenerator import RandomNoiseGenerator
 from models.model import Generator, Discriminator
@@ -16,7 +17,7 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('config', type=str)
     parser.add_argument('--gpu', default=0, type=int, help='gpu to use.')
-    parser.add_argument('--resume', default=None)
+    parser.add_argument('--resume', default=None, help='checkpoint path, file name in <out>/checkpoint or "latest"')
     args = parser.parse_args()
     return args
 
@@ -30,19 +31,27 @@ def train():
     # Use sigmoid activation for the last layer?
     cfg.models.discriminator.sigmoid_at_end = cfg.train.loss_type in ['ls', 'gan']
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+    # one process per rank under torchrun, e.g. torchrun --nproc_per_node 2 train.py <config> --gpu -1
+    dist = Distributed(args.gpu)
 
     G = Generator(model_cfg=cfg.models.generator, target_size=cfg.train.target_size)
     D = Discriminator(model_cfg=cfg.models.discriminator, target_size=cfg.train.target_size)
+    if dist.enabled:
+        # DDP broadcasts rank 0's weights and buffers (the WScaleLayer scales among them);
+        # every rank draws its own noise stream
+        torch.manual_seed(1 + dist.rank)
+        np.random.seed(1 + dist.rank)
     #print(G)
     #print(D)
     dataset = FaceDataset(cfg.train.dataset)
     assert len(dataset) > 0
-    print(f'train dataset contains {len(dataset)} images.')
+    if dist.is_main:
+        print(f'train dataset contains {len(dataset)} images.')
     clip = cfg.models.generator.z_clipping if hasattr(cfg.models.generator, 'z_zlipping') else None
     z_generator = RandomNoiseGenerator(cfg.models.generator.z_dim, 'gaussian', clip=clip)
-    pggan = PGGAN(G, D, dataset, z_generator, args.gpu, cfg, args.resume)
+    pggan = PGGAN(G, D, dataset, z_generator, args.gpu, cfg, args.resume, dist=dist)
     pggan.train()
+    dist.close()
 
 if __name__ == '__main__':
     train()
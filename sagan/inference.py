@@ -17,12 +17,14 @@ sys.path.append(os.pardir)
 from models import sagan 
 from common.dataset.dataset import FaceDataset
 from common.utils.config import Config
+from common.utils.checkpoint import load_checkpoint
 
 def parse_args():
     parser = argparse.ArgumentParser(description='MultiClassGAN')
     parser.add_argument('config', type=str)
     parser.add_argument('--gpu', type=int, default=0)
     parser.add_argument('--gen', type=str, required=True)
+    parser.add_argument('--ema', action='store_true', help='use the EMA generator weights')
     parser.add_argument('--N', type=int, default=16)
     parser.add_argument('--row', type=int, default=4)
     parser.add_argument('--mode', choices=['random', 'morphing', 'attention'], default='random')
@@ -49,15 +51,17 @@ def main():
         device = 'cpu'
 
 
-    gen = getattr(sagan, cfg.models.generator.name)(z_dim=cfg.models.generator.z_dim, norm=cfg.models.generator.norm).to(device)
-
-    # restore
-    if args.gen is not None:
-        if os.path.isfile(args.gen):
-            gen.load_state_dict(torch.load(args.gen)['gen_state_dict'])
-        else:
-            print(f'=> no checkpoint found at {args.gen}')
-            sys.exit()
+    # restore (a generator artifact or a full training checkpoint, memory-mapped)
+    if not os.path.isfile(args.gen):
+        print(f'=> no checkpoint found at {args.gen}')
+        sys.exit()
+    state = load_checkpoint(args.gen)
+    model_cfg = state['model_cfg'] if 'model_cfg' in state else cfg.models.generator
+    gen = getattr(sagan, model_cfg['name'])(z_dim=model_cfg['z_dim'], norm=model_cfg['norm']).to(device)
+    if args.ema and 'gen_ema_state_dict' not in state:
+        print(f'=> no EMA weights in {args.gen}')
+        sys.exit()
+    gen.load_state_dict(state['gen_ema_state_dict' if args.ema else 'gen_state_dict'])
 
     # arrange path
     top, gen_file = os.path.split(args.gen)
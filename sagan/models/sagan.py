@@ -8,6 +8,7 @@ from torch.nn.utils import spectral_norm
 from common.modules.resblocks import ResGenBlock, ResDisBlock, OptimizedBlock
 from common.modules.self_attension import Attension_Layer
 from common.modules.spectral_norm import SpectralNorm
+from common.modules.activation_checkpoint import checkpointed
 
 class ResNetGenerator128(torch.nn.Module):
     def __init__(self, base=64, z_dim=128, bottom_width=4, activation=F.relu, norm=None, n_classes=0):
@@ -32,6 +33,11 @@ class ResNetGenerator128(torch.nn.Module):
         torch.nn.init.zeros_(self.l7.bias)
         self.l7 = SpectralNorm(self.l7)
 
+    def checkpoint_blocks(self):
+        w = self.bottom_width
+        return [(w * 2, self.block2), (w * 4, self.block3), (w * 8, self.block4), (w * 8, self.attn),
+                (w * 16, self.block5), (w * 32, self.block6)]
+
     def forward(self, z, y=None):
         if self.n_classes > 0 and y is None:
             print('#!#!#!#!#!#! input y have to be input to conditional Generator. #!#!#!#!#!#!')
@@ -39,12 +45,12 @@ class ResNetGenerator128(torch.nn.Module):
         h = z
         h = self.l1(h)
         h = h.view(h.shape[0], -1, self.bottom_width, self.bottom_width)
-        h = self.block2(h, y)
-        h = self.block3(h, y)
-        h = self.block4(h, y)
-        h, attention = self.attn(h)
-        h = self.block5(h, y)
-        h = self.block6(h, y)
+        h = checkpointed(self.block2, h, y)
+        h = checkpointed(self.block3, h, y)
+        h = checkpointed(self.block4, h, y)
+        h, attention = checkpointed(self.attn, h)
+        h = checkpointed(self.block5, h, y)
+        h = checkpointed(self.block6, h, y)
         h = self.b7(h)
         h = self.activation(h)
         h = torch.tanh(self.l7(h))
@@ -73,16 +79,21 @@ class ResNetProjectionDiscriminator128(torch.nn.Module):
             torch.nn.init.xavier_uniform_(self.l_y.weight)
             self.l_y = SpectralNorm(self.l_y)
 
+    def checkpoint_blocks(self):
+        # resolution of the block inputs
+        return [(128, self.block1), (64, self.block2), (32, self.attn), (32, self.block3),
+                (16, self.block4), (8, self.block5), (4, self.block6)]
+
     def forward(self, x, y=None):
         assert not(self.n_classes > 0 and y is None)
         h = x
-        h = self.block1(h)
-        h = self.block2(h)
-        h, attention = self.attn(h)
-        h = self.block3(h)
-        h = self.block4(h)
-        h = self.block5(h)
-        h = self.block6(h)
+        h = checkpointed(self.block1, h)
+        h = checkpointed(self.block2, h)
+        h, attention = checkpointed(self.attn, h)
+        h = checkpointed(self.block3, h)
+        h = checkpointed(self.block4, h)
+        h = checkpointed(self.block5, h)
+        h = checkpointed(self.block6, h)
         h = self.activation(h)
         h = h.sum([2, 3])  #global pooling
         output = self.l7(h)
@@ -23,6 +23,7 @@ train = dict(
      batchsize = 32,
      iterations = 1000000,
      dataset_list = '/home/watanabe/M1/illustGAN/data/danbooru/face/more-1girl_hair_tag.txt',
+     dataset_index_cache = True,
      n_classes = 10,
      transform = dict(
         rotation = (-10, 10),
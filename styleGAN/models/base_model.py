@@ -8,6 +8,7 @@ from torch.autograd import Variable
 from torch.nn.parameter import Parameter
 from torch.nn import functional as F
 from torch.nn.init import kaiming_normal_, calculate_gain
+from common.functions.gdrop import gdrop_noise
 if sys.version_info.major == 3:
     from functools import reduce
 
@@ -64,7 +65,7 @@ class MinibatchStatConcatLayer(nn.Module):
                 vals = mean(x, [0,2,3], keepdim=True)  # torch.mean(torch.mean(torch.mean(x, 2, keepdim=True), 3, keepdim=True), 0, keepdim=True)
         elif self.averaging == 'flat':  # variance of ALL activations --> 1 value per minibatch
             target_shape[1] = 1
-            vals = torch.FloatTensor([self.adjusted_std(x)])
+            vals = self.adjusted_std(x).view([1] * len(shape))
         else:  # self.averaging == 'group'  # average everything over n groups of feature maps --> n values per minibatch
             target_shape[1] = self.n
             vals = vals.view(self.n, self.shape[1]/self.n, self.shape[2], self.shape[3])
@@ -98,27 +99,13 @@ class GDropLayer(nn.Module):
         self.axes = [axes] if isinstance(axes, int) else list(axes)
         self.normalize = normalize
         self.gain = None
+        # None: the default torch generator of the input's device (see common.functions.gdrop.seed_gdrop)
+        self.generator = None
 
     def forward(self, x, deterministic=False):
-        if deterministic or not self.strength:
+        if deterministic or (not torch.is_tensor(self.strength) and not self.strength):
             return x
-
-        rnd_shape = [s if axis in self.axes else 1 for axis, s in enumerate(x.size())]  # [x.size(axis) for axis in self.axes]
-        if self.mode == 'drop':
-            p = 1 - self.strength
-            rnd = np.random.binomial(1, p=p, size=rnd_shape) / p
-        elif self.mode == 'mul':
-            rnd = (1 + self.strength) ** np.random.normal(size=rnd_shape)
-        else:
-            coef = self.strength * x.size(1) ** 0.5
-            rnd = np.random.normal(size=rnd_shape) * coef + 1
-
-        if self.normalize:
-            rnd = rnd / np.linalg.norm(rnd, keepdims=True)
-        rnd = Variable(torch.from_numpy(rnd).type(x.data.type()))
-        if x.is_cuda:
-            rnd = rnd.cuda()
-        return x * rnd
+        return x * gdrop_noise(x, self.mode, self.strength, self.axes, self.normalize, self.generator)
 
     def __repr__(self):
         param_str = '(mode = %s, strength = %s, axes = %s, normalize = %s)' % (self.mode, self.strength, self.axes, self.normalize)
@@ -179,7 +166,7 @@ def resize_activations(v, so):
 
     # Increase feature maps.
     if si[1] < so[1]:
-        z = torch.zeros((v.shape[0], so[1] - si[1]) + so[2:])
+        z = v.new_zeros([v.shape[0], so[1] - si[1]] + so[2:])
         v = torch.cat([v, z], 1)
     return v
 
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import sys, os, time
 import numpy as np
-from scipy.misc import imsave
 
 import torch
 import torch.optim as optim
@@ -19,8 +18,8 @@ class PGGAN():
         self.z_generator = z_generator
         self.current_time = time.strftime('%Y-%m-%d %H%M%S')
         self.logger = Logger('./logs/' + self.current_time + "/")
-        os.environ['CUDA_VISIBLE_DEVICES'] = str(xpu)
-        self.use_cuda = xpu >= 0
+        self.device = torch.device(f'cuda:{xpu}') if xpu >= 0 and torch.cuda.is_available() else torch.device('cpu')
+        self.use_cuda = self.device.type == 'cuda'
 
         self.bs_map = {2**R: self.get_bs(2**R) for R in range(2, 11)} # batch size map keyed by resolution_level
         self.rows_map = {32: 8, 16: 4, 8: 4, 4: 2, 2: 2}
@@ -38,8 +37,8 @@ class PGGAN():
             G_model = self.G_resume
             D_model = self.G_resume.replace('G','D')
             assert os.path.exists(G_model) and os.path.exists(D_model)
-            self.G.load_state_dict(torch.load(G_model))
-            self.D.load_state_dict(torch.load(D_model))
+            self.G.load_state_dict(torch.load(G_model, map_location='cpu'))
+            self.D.load_state_dict(torch.load(D_model, map_location='cpu'))
             self.is_restored = True
             print(f'Restored from {G_model}')
         else:
@@ -64,9 +63,8 @@ class PGGAN():
         return int(bs)
 
     def register_on_gpu(self):
-        if self.use_cuda:
-            self.G.cuda()
-            self.D.cuda()
+        self.G.to(self.device)
+        self.D.to(self.device)
 
     def create_optimizer(self):
         self.optim_G = optim.Adam(self.G.parameters(), lr=self.cfg.train.parameters.g_lr, betas=(self.cfg.train.parameters.beta1, self.cfg.train.parameters.beta2))
@@ -99,7 +97,7 @@ class PGGAN():
             return 0.
 
     def gradient_penalty(self, cur_level):
-        epsilon = torch.rand(self.real.shape[0], 1, 1, 1).cuda().expand_as(self.real)
+        epsilon = torch.rand(self.real.shape[0], 1, 1, 1, device=self.real.device).expand_as(self.real)
         x_hat = torch.autograd.Variable(epsilon * self.real.data + (1 - epsilon) * self.fake.data, requires_grad=True)
 
         d_hat = self.D(x_hat, cur_level=cur_level)
@@ -109,7 +107,7 @@ class PGGAN():
 
         grad = torch.autograd.grad(outputs=d_hat,
                                    inputs=x_hat,
-                                   grad_outputs=torch.ones(d_hat.shape).cuda(),
+                                   grad_outputs=torch.ones_like(d_hat),
                                    retain_graph=True,
                                    create_graph=True,
                                    only_inputs=True)[0]
@@ -173,10 +171,7 @@ class PGGAN():
         pass
 
     def _numpy2var(self, x):
-        var = Variable(torch.from_numpy(x))
-        if self.use_cuda:
-            var = var.cuda()
-        return var
+        return torch.from_numpy(x).to(self.device)
 
     def _var2numpy(self, var):
         if self.use_cuda:
@@ -188,7 +183,7 @@ class PGGAN():
             return 0
 
         if hasattr(self, '_d_'):
-            self._d_ = self._d_ * 0.9 + np.clip(torch.mean(self.d_real).data[0], 0.0, 1.0) * 0.1
+            self._d_ = self._d_ * 0.9 + np.clip(torch.mean(self.d_real).item(), 0.0, 1.0) * 0.1
         else:
             self._d_ = 0.0
         strength = 0.2 * max(0, self._d_ - 0.5)**2
@@ -196,7 +191,7 @@ class PGGAN():
 
     def preprocess(self, z, real):
         self.z = self._numpy2var(z)
-        self.real = Variable(real).cuda()
+        self.real = real.to(self.device)
         #self.real = self._numpy2var(real)
 
     def forward_G(self, cur_level):
@@ -243,16 +238,15 @@ class PGGAN():
         # (2) Log values and gradients of the parameters (histogram)
         for tag, value in self.G.named_parameters():
             tag = tag.replace('.', '/')
-            self.logger.histo_summary('G/' + prefix +tag, self._var2numpy(value), it)
+            self.logger.histo_summary('G/' + prefix +tag, value, it)
             if value.grad is not None:
-                self.logger.histo_summary('G/' + prefix +tag + '/grad', self._var2numpy(value.grad), it)
+                self.logger.histo_summary('G/' + prefix +tag + '/grad', value.grad, it)
 
         for tag, value in self.D.named_parameters():
             tag = tag.replace('.', '/')
-            self.logger.histo_summary('D/' + prefix + tag, self._var2numpy(value), it)
+            self.logger.histo_summary('D/' + prefix + tag, value, it)
             if value.grad is not None:
-                self.logger.histo_summary('D/' + prefix + tag + '/grad',
-                                          self._var2numpy(value.grad), it)
+                self.logger.histo_summary('D/' + prefix + tag + '/grad', value.grad, it)
 
         # (3) Log the images
         # info = {'images': samples[:10]}
@@ -15,7 +15,7 @@ from models.model import Generator, Discriminator
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('config', type=str)
-    parser.add_argument('--gpu', default=0, type=int, help='gpu to use.')
+    parser.add_argument('--gpu', default=0, type=int, help='gpu to use (-1: cpu).')
     parser.add_argument('--resume', default=None)
     args = parser.parse_args()
     return args
@@ -30,8 +30,6 @@ def train():
     # Use sigmoid activation for the last layer?
     cfg.models.discriminator.sigmoid_at_end = cfg.train.loss_type in ['ls', 'gan']
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
-
     G = Generator(model_cfg=cfg.models.generator, target_size=cfg.train.target_size)
     D = Discriminator(model_cfg=cfg.models.discriminator, target_size=cfg.train.target_size)
     #print(G)